@@ -13,6 +13,7 @@ from urllib.parse import urlparse
 
 from . import cached_requests
 from . import feed_parser
+from .negative_cache import FailureKind
 from .downloader import download
 from .win_find_prog_for_mimetype import prog_for_mimetype
 
@@ -425,15 +426,24 @@ def factory__ssh_cmd(ssh_hostname, ssh_cmd,
 # Not serializable
 def get_item_for_url(feed, url, settings):
     if True:  # if not feed.items:
+        failure = cached_requests.get_failure(feed.url)
+        if failure:
+            logger.error("Skip recently failed feed '{}': {}".format(
+                feed.url, failure))
+            return (None, None)
+
         (cEl, code) = cached_requests.fetch_file(feed.url)
-        if not cEl or not cEl.byte_str:
+        if not cEl or not cEl.data():
             logger.error("Fetching uncached feed '{}' failed.".format(feed.url))
             return (None, None)
 
         if len(feed.context)>0:
             logger.debug("Skip parsing of feed and re-use previous")
         else:
-            feed_parser.parse_feed(feed, cEl.byte_str)
+            if not feed_parser.parse_feed(feed, cEl.data()):
+                cached_requests.add_failure(feed.url, FailureKind.PARSE)
+                return (None, None)
+            cached_requests.register_feed_context(feed)
         for entry in feed.context["entries"]:
             for enclosure in entry["enclosures"]:
                 #logger.info("Compare {} with {}".format(
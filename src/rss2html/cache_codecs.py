@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Compression codecs for cached feed xml files.
+#
+# Each compressed cache element is tagged with the name of its codec.
+# Thus, CACHE_COMPRESSION_CODEC can be changed without losing the
+# already stored elements.
+#
+# • brotli, zlib, lzma: Always available.
+# • zstd: Requires the 'zstandard' package.
+# • zstd-dict: Feeds of the same publisher share most of their markup.
+#   A zstd dictionary trained on the current cache contents captures
+#   this redundancy across documents. The dictionaries are kept in the
+#   cache store. The id of the dictionary is part of the codec tag,
+#   e.g. 'zstd-dict:1234'.
+#
+# benchmark() reports ratio and speed of all codecs for given samples.
+#
+
+import zlib
+import lzma
+from time import perf_counter
+from threading import Lock
+
+try:
+    import brotlicffi as brotli
+except ImportError:
+    import brotli
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import default_settings as settings  # Overriden in load_config()
+
+DEFAULT_CODEC = "brotli"
+BROTLI_QUALITY = 7       # Range 0(fastest) … 11(best/default)
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+ZSTD_LEVEL = 10
+ZSTD_DICT_SIZE = 2**17   # 128 kB
+ZSTD_DICT_MIN_SAMPLES = 8
+
+
+class CodecUnavailable(Exception):
+    pass
+
+
+class BrotliCodec:
+    name = "brotli"
+
+    def compress(self, data):
+        return brotli.compress(data, mode=brotli.MODE_TEXT,
+                               quality=BROTLI_QUALITY)
+
+    def decompress(self, data):
+        return brotli.decompress(data)
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def compress(self, data):
+        return zlib.compress(data, ZLIB_LEVEL)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec:
+    name = "lzma"
+
+    def compress(self, data):
+        return lzma.compress(data, preset=LZMA_PRESET)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self, dictionary=None):
+        # dictionary: zstandard.ZstdCompressionDict or None
+        if zstandard is None:
+            raise CodecUnavailable("Package 'zstandard' not installed.")
+
+        self.dictionary = dictionary
+        if dictionary is not None:
+            self.name = "zstd-dict:{}".format(dictionary.dict_id())
+
+        # Compressor objects are not thread safe.
+        self._lock = Lock()
+        self._compressor = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, dict_data=dictionary)
+        self._decompressor = zstandard.ZstdDecompressor(
+            dict_data=dictionary)
+
+    def compress(self, data):
+        with self._lock:
+            return self._compressor.compress(data)
+
+    def decompress(self, data):
+        with self._lock:
+            return self._decompressor.decompress(data)
+
+
+_LOCK = Lock()
+_CODECS = {
+    "brotli": BrotliCodec(),
+    "zlib": ZlibCodec(),
+    "lzma": LzmaCodec(),
+}
+if zstandard is not None:
+    _CODECS["zstd"] = ZstdCodec()
+
+_CURRENT_DICT_CODEC = None  # Codec with newest trained dictionary
+
+
+def available():
+    # Names of usable codecs (without dictionary variants)
+    names = list(_CODECS.keys())
+    names = [name for name in names if not name.startswith("zstd-dict:")]
+    if zstandard is not None:
+        names.append("zstd-dict")
+    return names
+
+
+def get_codec(tag):
+    # Returns codec for tag of compressed element.
+    # Raises CodecUnavailable if the codec (or dictionary) is missing.
+    codec = _CODECS.get(tag or DEFAULT_CODEC)
+    if codec is None:
+        raise CodecUnavailable("Unknown compression codec '{}'".format(tag))
+    return codec
+
+
+def default_codec():
+    # Codec for new compressed elements (CACHE_COMPRESSION_CODEC).
+    # Falls back on brotli if the codec is not available.
+    name = settings.CACHE_COMPRESSION_CODEC
+    if name == "zstd-dict":
+        return _CURRENT_DICT_CODEC or _CODECS.get("zstd") \
+                or _CODECS[DEFAULT_CODEC]
+
+    return _CODECS.get(name) or _CODECS[DEFAULT_CODEC]
+
+
+def register_dictionary(dict_data, current=True):
+    # Makes trained dictionary available for (de-)compression.
+    # Returns codec tag.
+    global _CURRENT_DICT_CODEC
+    if zstandard is None:
+        raise CodecUnavailable("Package 'zstandard' not installed.")
+
+    codec = ZstdCodec(zstandard.ZstdCompressionDict(dict_data))
+    with _LOCK:
+        _CODECS[codec.name] = codec
+        if current:
+            _CURRENT_DICT_CODEC = codec
+
+    return codec.name
+
+
+def train_dictionary(samples, dict_size=ZSTD_DICT_SIZE):
+    # Trains zstd dictionary on samples (list of bytes).
+    # Returns (codec tag, dictionary data) or None.
+    if zstandard is None:
+        raise CodecUnavailable("Package 'zstandard' not installed.")
+
+    if len(samples) < ZSTD_DICT_MIN_SAMPLES:
+        logger.debug("Too few samples for training of dictionary.")
+        return None
+
+    try:
+        dictionary = zstandard.train_dictionary(dict_size, samples)
+    except zstandard.ZstdError as e:
+        logger.error("Training of dictionary failed. Error was: {}"
+                     "".format(e))
+        return None
+
+    dict_data = dictionary.as_bytes()
+    tag = register_dictionary(dict_data)
+    logger.info("Trained compression dictionary '{}' on {} samples"
+                "".format(tag, len(samples)))
+    return (tag, dict_data)
+
+
+def benchmark(samples, names=None):
+    # Compresses and decompresses all samples with each codec.
+    #
+    # samples: List of (uncompressed) bytes
+    # names: Codecs to test. Default: available()
+    #
+    # Note: The dictionary of 'zstd-dict' is trained on the
+    #       samples itself. This is optimistic for new documents.
+    results = {}
+    total = sum((len(s) for s in samples))
+    if total == 0:
+        return results
+
+    for name in (names or available()):
+        try:
+            if name == "zstd-dict":
+                dictionary = zstandard.train_dictionary(ZSTD_DICT_SIZE,
+                                                        samples)
+                codec = ZstdCodec(dictionary)
+            else:
+                codec = get_codec(name)
+        except Exception as e:
+            results[name] = {"error": str(e)}
+            continue
+
+        start = perf_counter()
+        compressed = [codec.compress(s) for s in samples]
+        t_compress = perf_counter() - start
+
+        start = perf_counter()
+        for c in compressed:
+            codec.decompress(c)
+        t_decompress = perf_counter() - start
+
+        size = sum((len(c) for c in compressed))
+        results[name] = {
+            "ratio": total / size if size else None,
+            "bytes": size,
+            "compress_mb_s": total / 1E6 / t_compress if t_compress else None,
+            "decompress_mb_s": (total / 1E6 / t_decompress
+                                if t_decompress else None),
+        }
+
+    return results
@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Single-file store for cached feed xml files (sqlite3).
+#
+# Replaces the previous approach of one pickle file per feed:
+# • Body, headers, timestamp and hash are stored in separate columns.
+#   Thus metadata can be read without loading the body and no
+#   pickle data (arbitrary code) will be loaded.
+# • Multiple elements can be written in one transaction.
+# • The sum of all body sizes (including parsed feeds and compression
+#   dictionaries) is tracked on every write/deletion and an index on
+#   mtime allows the removal of the oldest elements without a scan
+#   over all elements.
+# • The WAL mode makes writes atomic. The recovery after a crash just
+#   replays the WAL. Regular checkpoints keep it short.
+# • Compressed bodies are tagged with their codec (see cache_codecs.py).
+#   Trained compression dictionaries are stored in a separate table.
+# • Parsed feeds (see feed_parser.serialize_context()) are stored in
+#   the table 'contexts'. The version of a row consists of the content
+#   hash of the element and a fingerprint of the parser settings.
+#   Rows are removed together with their element.
+#
+
+import os.path
+import sqlite3
+import json
+from time import time
+from threading import Lock
+
+import logging
+logger = logging.getLogger(__name__)
+
+STORE_FILENAME = "cache.sqlite3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    body BLOB,
+    compressed INTEGER NOT NULL DEFAULT 0,
+    headers TEXT,
+    timestamp INTEGER NOT NULL DEFAULT 0,
+    hash TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    mtime REAL NOT NULL DEFAULT 0,
+    meta TEXT
+);
+CREATE INDEX IF NOT EXISTS cache_mtime ON cache (mtime);
+CREATE TABLE IF NOT EXISTS contexts (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    data BLOB NOT NULL,
+    codec TEXT,
+    mtime REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS dictionaries (
+    tag TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    created REAL NOT NULL DEFAULT 0
+);
+"""
+
+# Columns added after the first version of the table
+_ADDED_COLUMNS = [
+    ("meta", "TEXT"),
+    ("codec", "TEXT"),  # NULL for uncompressed bodies and legacy brotli
+]
+
+_COLUMNS = ("key, body, compressed, headers, timestamp, hash,"
+            " size, mtime, meta, codec")
+_META_COLUMNS = _COLUMNS.replace("body", "NULL")
+
+
+class StoreRecord:
+    # Row of the cache table. body is None if only the
+    # metadata was requested.
+    # meta: Dict with further (JSON serializable) information.
+    # codec: Tag of compression codec, see cache_codecs.get_codec()
+    __slots__ = ("key", "body", "compressed", "headers",
+                 "timestamp", "hash", "size", "mtime", "meta", "codec")
+
+    def __init__(self, key, body=None, compressed=False, headers=None,
+                 timestamp=0, hash=None, size=0, mtime=0.0, meta=None,
+                 codec=None):
+        self.key = key
+        self.body = body
+        self.compressed = compressed
+        self.headers = headers if headers is not None else {}
+        self.timestamp = timestamp
+        self.hash = hash
+        self.size = size
+        self.mtime = mtime
+        self.meta = meta if meta is not None else {}
+        self.codec = codec
+
+
+class CacheStore:
+
+    def __init__(self, dirname):
+        self.path = os.path.join(dirname, STORE_FILENAME)
+        self._lock = Lock()
+        self._con = None
+        self._disk_footprint = 0  # Sum of body sizes of all tables
+
+    def open(self):
+        with self._lock:
+            if self._con is not None:
+                return
+
+            # One connection shared by all threads. Access is
+            # serialized by self._lock.
+            self._con = sqlite3.connect(self.path, check_same_thread=False,
+                                        isolation_level=None)
+            # auto_vacuum needs to be set before the table is created.
+            self._con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._con.execute("PRAGMA journal_mode = WAL")
+            self._con.execute("PRAGMA synchronous = NORMAL")
+            self._con.executescript(_SCHEMA)
+            self._migrate()
+            (self._disk_footprint,) = self._con.execute(
+                "SELECT (SELECT COALESCE(SUM(size), 0) FROM cache)"
+                " + (SELECT COALESCE(SUM(LENGTH(data)), 0) FROM contexts)"
+                " + (SELECT COALESCE(SUM(LENGTH(data)), 0)"
+                " FROM dictionaries)").fetchone()
+
+        logger.debug("Opened cache store '{}'".format(self.path))
+
+    def close(self):
+        with self._lock:
+            if self._con is None:
+                return
+
+            self._con.close()
+            self._con = None
+
+    def get(self, key):
+        with self._lock:
+            row = self._con.execute(
+                "SELECT " + _COLUMNS + " FROM cache WHERE key = ?",
+                (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return self._record(row)
+
+    def get_metadata(self, key):
+        # Like get(), but without reading the body.
+        with self._lock:
+            row = self._con.execute(
+                "SELECT " + _META_COLUMNS + " FROM cache WHERE key = ?",
+                (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return self._record(row)
+
+    def put(self, record):
+        self.put_many([record])
+
+    def put_many(self, records):
+        # Writes all records in one transaction.
+        now = time()
+        rows = list({r.key: (r.key, r.body, int(r.compressed),
+                             json.dumps(r.headers), r.timestamp, r.hash,
+                             len(r.body), now, json.dumps(r.meta),
+                             r.codec if r.compressed else None)
+                     for r in records}.values())
+        if not rows:
+            return
+
+        with self._lock:
+            with self._transaction():
+                diff = sum((row[6] for row in rows)) \
+                    - self._sizes([row[0] for row in rows])
+                self._con.executemany(
+                    "INSERT OR REPLACE INTO cache (" + _COLUMNS + ")"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._disk_footprint += diff
+
+    def update_metadata(self, records):
+        # Writes headers, timestamp, hash and meta of
+        # already stored elements. The body is not touched.
+        rows = [(json.dumps(r.headers), r.timestamp, r.hash,
+                 json.dumps(r.meta), r.key) for r in records]
+        if not rows:
+            return
+
+        with self._lock:
+            with self._transaction():
+                self._con.executemany(
+                    "UPDATE cache SET headers = ?, timestamp = ?, hash = ?,"
+                    " meta = ? WHERE key = ?", rows)
+
+    def delete(self, key):
+        with self._lock:
+            with self._transaction():
+                diff = self._sizes([key]) + self._context_sizes([key])
+                self._con.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._con.execute("DELETE FROM contexts WHERE key = ?",
+                                  (key,))
+            self._disk_footprint -= diff
+
+    def get_context(self, key, version):
+        # Returns (data, codec) or None
+        with self._lock:
+            return self._con.execute(
+                "SELECT data, codec FROM contexts"
+                " WHERE key = ? AND version = ?", (key, version)).fetchone()
+
+    def put_contexts(self, rows):
+        # rows: List of (key, version, data, codec)
+        now = time()
+        if not rows:
+            return
+
+        with self._lock:
+            with self._transaction():
+                diff = sum((len(row[2]) for row in rows)) \
+                    - self._context_sizes([row[0] for row in rows])
+                self._con.executemany(
+                    "INSERT OR REPLACE INTO contexts"
+                    " (key, version, data, codec, mtime)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [row + (now,) for row in rows])
+            self._disk_footprint += diff
+
+    def metadata(self, keys=None):
+        # List of records without body.
+        query = "SELECT " + _META_COLUMNS + " FROM cache"
+        with self._lock:
+            rows = self._con.execute(query).fetchall()
+
+        records = [self._record(row) for row in rows]
+        if keys is not None:
+            keys = set(keys)
+            records = [r for r in records if r.key in keys]
+
+        return records
+
+    def checkpoint(self):
+        # Transfers the WAL into the database file (with fsync).
+        with self._lock:
+            self._con.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def put_dictionary(self, tag, data):
+        with self._lock:
+            with self._transaction():
+                diff = len(data) - self._dictionary_sizes([tag])
+                self._con.execute(
+                    "INSERT OR REPLACE INTO dictionaries (tag, data, created)"
+                    " VALUES (?, ?, ?)", (tag, data, time()))
+            self._disk_footprint += diff
+
+    def dictionaries(self):
+        # List of (tag, data), oldest first.
+        with self._lock:
+            return self._con.execute(
+                "SELECT tag, data FROM dictionaries"
+                " ORDER BY created ASC").fetchall()
+
+    def delete_unused_dictionaries(self, keep=()):
+        # Removes dictionaries which are not referenced by any
+        # element or parsed feed. Tags in keep are never removed.
+        with self._lock:
+            used = set((row[0] for row in self._con.execute(
+                "SELECT codec FROM cache WHERE codec IS NOT NULL"
+                " UNION SELECT codec FROM contexts WHERE codec IS NOT NULL")))
+            tags = [row[0] for row in self._con.execute(
+                "SELECT tag FROM dictionaries")]
+            unused = [(tag,) for tag in tags
+                      if tag not in used and tag not in keep]
+            if unused:
+                with self._transaction():
+                    freed = self._dictionary_sizes(
+                        [tag for (tag,) in unused])
+                    self._con.executemany(
+                        "DELETE FROM dictionaries WHERE tag = ?", unused)
+                self._disk_footprint -= freed
+
+        return len(unused)
+
+    def disk_footprint(self):
+        # Sum of body sizes of elements, parsed feeds and
+        # dictionaries. No query needed.
+        return self._disk_footprint
+
+    def reduce_disk_footprint(self, upper_bound, batch_size=32):
+        # Delete least recently written elements (and their
+        # parsed feeds) until the sum of body sizes is below
+        # upper_bound.
+        #
+        # Just the removed rows are visited (mtime index).
+        n_removed = 0
+        with self._lock:
+            while self._disk_footprint > upper_bound:
+                rows = self._con.execute(
+                    "SELECT cache.key, cache.size"
+                    " + COALESCE(LENGTH(contexts.data), 0)"
+                    " FROM cache LEFT JOIN contexts"
+                    " ON contexts.key = cache.key"
+                    " ORDER BY cache.mtime ASC LIMIT ?",
+                    (batch_size,)).fetchall()
+                if not rows:
+                    # Just parsed feeds without element are left.
+                    with self._transaction():
+                        (freed,) = self._con.execute(
+                            "SELECT COALESCE(SUM(LENGTH(data)), 0)"
+                            " FROM contexts").fetchone()
+                        self._con.execute("DELETE FROM contexts")
+                    self._disk_footprint -= freed
+                    break
+
+                to_remove = []
+                freed = 0
+                for (key, size) in rows:
+                    if self._disk_footprint - freed <= upper_bound:
+                        break
+                    to_remove.append((key,))
+                    freed += size
+
+                with self._transaction():
+                    self._con.executemany(
+                        "DELETE FROM cache WHERE key = ?", to_remove)
+                    self._con.executemany(
+                        "DELETE FROM contexts WHERE key = ?", to_remove)
+                self._disk_footprint -= freed
+                n_removed += len(to_remove)
+
+            if n_removed:
+                self._con.execute("PRAGMA incremental_vacuum")
+
+        return n_removed
+
+    def _sizes(self, keys):
+        # Sum of sizes of the given keys. Lock is already hold by caller.
+        return self._sum(
+            "SELECT size FROM cache WHERE key = ?", keys)
+
+    def _context_sizes(self, keys):
+        # Lock is already hold by caller.
+        return self._sum(
+            "SELECT LENGTH(data) FROM contexts WHERE key = ?", keys)
+
+    def _dictionary_sizes(self, tags):
+        # Lock is already hold by caller.
+        return self._sum(
+            "SELECT LENGTH(data) FROM dictionaries WHERE tag = ?", tags)
+
+    def _sum(self, query, keys):
+        size = 0
+        for key in keys:
+            row = self._con.execute(query, (key,)).fetchone()
+            if row:
+                size += row[0]
+        return size
+
+    def _migrate(self):
+        # Lock is already hold by caller
+        columns = [row[1] for row in
+                   self._con.execute("PRAGMA table_info(cache)")]
+        for (name, declaration) in _ADDED_COLUMNS:
+            if name not in columns:
+                logger.info("Add column '{}' to cache store".format(name))
+                self._con.execute("ALTER TABLE cache ADD COLUMN {} {}"
+                                  "".format(name, declaration))
+
+    def _transaction(self):
+        return _Transaction(self._con)
+
+    @staticmethod
+    def _record(row):
+        (key, body, compressed, headers, timestamp, hash, size, mtime,
+         meta, codec) = row
+        try:
+            headers = json.loads(headers) if headers else {}
+        except ValueError:
+            headers = {}
+        try:
+            meta = json.loads(meta) if meta else {}
+        except ValueError:
+            meta = {}
+
+        return StoreRecord(key, body, bool(compressed), headers,
+                           timestamp, hash, size, mtime, meta, codec)
+
+
+class _Transaction:
+    # Explicit transaction because connection runs in autocommit mode.
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        self.con.execute("BEGIN")
+        return self.con
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.con.execute("COMMIT")
+        else:
+            self.con.execute("ROLLBACK")
@@ -2,15 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import time
-import ssl
+from threading import Lock, Thread
+from weakref import WeakSet
 from sys import getsizeof
 import os.path
+import re
 from os import mkdir
-try:
-    import brotlicffi as brotli
-except ImportError:
-    import brotli
-
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,30 +19,100 @@ from urllib.parse import urlparse
 
 import certifi
 from urllib3 import PoolManager, Timeout, Retry
-from urllib3.exceptions import HTTPError, TimeoutError, ResponseError,\
-        MaxRetryError, SSLError
-from io import BytesIO
+from urllib3.util import make_headers
+from urllib3.exceptions import TimeoutError, ResponseError,\
+        MaxRetryError, SSLError, ProtocolError, ReadTimeoutError, DecodeError,\
+        NewConnectionError
 # from ssl import SSLError
 
 # For storage
-from hashlib import sha1
-from pickle import loads, dumps
+from hashlib import sha1, blake2b
 from pathlib import Path
 from .feed import Feed, Group, bytes_str, gen_hash
+from .cache_store import CacheStore, StoreRecord
+from .single_flight import SingleFlight
+from .memory_cache import MemoryCache
+from . import freshness
+from .host_limiter import HostLimiter, HostUnavailable
+from . import deadline
+from . import dns_cache
+from . import delta
+from . import feed_parser
+from .redirects import RedirectMap
+from .negative_cache import NegativeCache, FailureKind
+from .write_behind import WriteBehind
+# Modules imported just by their classes need to be attributes of
+# this module. Otherwise, settings_helper.update_submodules() does
+# not replace their settings.
+from . import host_limiter, redirects, negative_cache, write_behind
+from . import cache_codecs
 
 from . import default_settings as settings
 
 CACHE_DIR_NAME = "rss_server_cache"
 
-_CACHE = {}
+_CACHE = MemoryCache()
+_STORE = None  # CacheStore, opened by get_store()
+_STORE_LOCK = Lock()
 _HTTP = None
 _HTTP = PoolManager(
+    # Connections kept per host. Should match
+    # FETCH_MAX_CONNECTIONS_PER_HOST, but settings are not
+    # loaded yet.
+    maxsize=4,
     cert_reqs='CERT_REQUIRED',
     # cert_reqs='CERT_NONE',
     ca_certs=certifi.where()
 )
+# Name resolution with cache and respect of fetch deadlines.
+# (Also used by actions for downloads.)
+dns_cache.install(_HTTP)
+
+# Concurrency limits, backoff and circuit breaker per host
+_HOSTS = HostLimiter()
+
+# Transfered bytes and bytes saved by early termination of downloads.
+_TRANSFERS = delta.TransferStatistic()
+
+# Compressions accepted for feed requests, e.g. 'gzip,deflate,br'
+_ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+
+# Permanent and temporary redirects of feed urls
+_REDIRECTS = RedirectMap()
+
+# Recently failed feed urls, e.g. 404 or invalid xml
+_FAILURES = NegativeCache()
+
+# Origins ignoring conditional requests
+_CONDITIONALS = delta.ConditionalStatistic()
+
+# Assumed duration of a request if it was not measured yet.
+# See CacheElement.cost()
+_DEFAULT_FETCH_TIME_S = 1.0
+
+# Decay of access counts for the order of the warm-up.
+_ACCESS_HALF_LIFE_S = 7 * 86400
 
-_BROTLI_COMPRESSION_RATE=7  # Range 0(fastest) … 11(best/default)
+# Content hashes (used as ETag) are computed over the whole
+# (decompressed) body while it is read. Hashes of other length were
+# generated by older versions from samples of the body.
+_HASH_DIGEST_SIZE = 16
+
+
+def content_hasher(byte_str=b""):
+    return blake2b(byte_str, digest_size=_HASH_DIGEST_SIZE)
+
+
+# Concurrent requests of the same url waiting on the first one.
+_FETCH_FLIGHTS = SingleFlight("fetch_file")
+
+# Feeds with parsed content of a cache element. Their context
+# will be cleared if the element is removed from _CACHE.
+_CONTEXT_OWNERS = {}  # key -> WeakSet of Feed objects
+_CONTEXT_OWNERS_LOCK = Lock()
+
+# State of parsed contexts in the store, see store_feed_contexts()
+_STORED_CONTEXTS = {}  # key -> (version, number of prepared pages)
 
 class CacheElement:
     # Putting this into _CACHE avoids copy of big underlying
@@ -55,45 +122,158 @@ class CacheElement:
         self.headers = dict() if headers is None else headers
         self.timestamp = int(time.time())
         self.bSaved = False
+        self.bMetaSaved = True  # Only relevant if bSaved is True
         self.bCompressed = False
+        self.codec = None  # Tag of codec if bCompressed, see cache_codecs
+        self.freshness = {}  # See freshness.update()
         self._hash = None
+        self._lock = Lock()  # For (de-)compression
+        self._size_listener = None
+        self._store_key = None  # For lazy loading of body
+        self._store_mtime = None
+        self.bytes_spliced = 0  # Bytes taken from previous version
+        self.last_read = time.time()  # See idle_seconds()
+        self.fetch_time = None  # Duration of request in seconds
+        self.parse_time = None  # Duration of parsing in seconds
+        self.access_count = 0   # Views by users, see record_access()
+        self.last_access = None
+        self.bReloaded = False  # Body was not in memory on lookup
+
+    def to_record(self, key):
+        # Compress before serialization. The element itself keeps
+        # its state. Idle elements are compressed by
+        # compress_idle_elements() in the background.
+        with self._lock:
+            (body, bCompressed, codec) = (self.byte_str, self.bCompressed,
+                                          self.codec)
+
+        if body is not None and bCompressed != settings.CACHE_COMPRESSION:
+            if bCompressed:
+                body = cache_codecs.get_codec(codec).decompress(body)
+                codec = None
+            else:
+                (body, codec) = _compress(body)
+            bCompressed = not bCompressed
+
+        return StoreRecord(key, body, bCompressed,
+                           self.headers, self.timestamp, self._hash,
+                           meta=self.meta(), codec=codec)
+
+    def meta(self):
+        # Further information for the cache store.
+        return {"freshness": self.freshness,
+                "cost": {"fetch": self.fetch_time, "parse": self.parse_time},
+                "access": {"count": self.access_count,
+                           "last": self.last_access}}
+
+    def record_access(self, now=None):
+        # Counts view of feed. The counters are persisted with the
+        # metadata and order the warm-up after a restart.
+        self.access_count += 1
+        self.last_access = now or time.time()
+        self.bMetaSaved = False
+
+    def idle_seconds(self, now=None):
+        # Seconds since the last view by a user. Reads by the
+        # scheduler or the warm-up do not count. Elements which
+        # were never viewed fall back on the last read of the body.
+        return (now or time.time()) - (self.last_access or self.last_read)
+
+    def hotness(self, now=None):
+        # Access count, halved every _ACCESS_HALF_LIFE_S since
+        # the last access.
+        if not self.last_access:
+            return 0.0
+        age = max((now or time.time()) - self.last_access, 0.0)
+        return self.access_count * 0.5 ** (age / _ACCESS_HALF_LIFE_S)
+
+    def cost(self):
+        # Estimated seconds to fetch and parse this feed again.
+        # Used by the 'gdsf' eviction policy (see memory_cache.py).
+        return ((self.fetch_time or _DEFAULT_FETCH_TIME_S)
+                + (self.parse_time or 0.0))
 
-    def __getstate__(self):
-        # Compress before serialization.
-        if self.bCompressed != settings.CACHE_COMPRESSION:
-            self.decompress() if self.bCompressed else self.compress()
-
-        state = self.__dict__.copy()
-        # del state[...]
-        return state
-
-    def __setstate__(self, d):
-        # Objects initialized by pickle.loads are
-        # tagged as already saved
-
-        # add new member variables for backward compatibility
-        self.bCompressed = False
-        self._hash = None
-
-        self.__dict__.update(d)
-        self.bSaved = True
-
-        # Note the de-serialized object will not decompressed
+    @classmethod
+    def from_record(cls, record):
+        # Elements of the store are tagged as already saved.
+        #
+        # Note the loaded object will not decompressed
         # here, and has to be triggered later if needed.
         # This reduces memory footprint of cache and often this
         # data is alerady out-dated and didn't need to be decompressed at all.
-        # if self.bCompressed:
-        #     self.decompress()
+        #
+        # If the record contains only the metadata, the body will
+        # be loaded by load_body() on first access.
+        cEl = cls("", record.headers)
+        cEl.byte_str = record.body
+        cEl.bCompressed = record.compressed
+        cEl.codec = record.codec
+        cEl.timestamp = record.timestamp
+        if record.hash and len(record.hash) == 2 * _HASH_DIGEST_SIZE:
+            cEl._hash = record.hash
+        cEl._store_key = record.key
+        cEl._store_mtime = record.mtime
+        cEl.freshness = record.meta.get("freshness", {})
+        cost = record.meta.get("cost", {})
+        cEl.fetch_time = cost.get("fetch")
+        cEl.parse_time = cost.get("parse")
+        access = record.meta.get("access", {})
+        cEl.access_count = access.get("count", 0)
+        cEl.last_access = access.get("last")
+        cEl.bSaved = True
+        return cEl
+
+    def is_loaded(self):
+        return self.byte_str is not None
+
+    def load_body(self):
+        # Reads body of an element created from metadata only.
+        # Returns False if the body is not available anymore.
+        with self._lock:
+            if self.byte_str is not None:
+                return True
+
+            store = get_store()
+            try:
+                record = store.get(self._store_key) if store else None
+            except Exception as e:
+                logger.debug("Reading of '{}' failed. "
+                        "Error was: {}".format(self._store_key, e))
+                record = None
+
+            if (record is None or record.body is None
+                    or record.mtime != self._store_mtime):
+                # Removed or replaced in the meantime.
+                return False
+
+            self.byte_str = record.body
+            self.bCompressed = record.compressed
+            self.codec = record.codec
+
+        logger.debug("Loaded body of '{}'".format(self._store_key))
+        self._size_changed()
+        return True
 
     def memory_footprint(self):
         # Estimation of memory footprint of this object.
         return getsizeof(self.byte_str)
 
+    def set_size_listener(self, listener):
+        # The listener will be called if memory_footprint() changes.
+        self._size_listener = listener
+
+    def _size_changed(self):
+        listener = self._size_listener
+        if listener:
+            listener()
+
     def store(self, filename):
-        dirname = gen_cache_dirname()
+        store = get_store()
+        if store is None:
+            return
+
         try:
-            with open(os.path.join(dirname,filename), 'wb') as f:
-                f.write(dumps(self))
+            store.put(self.to_record(filename))
         except Exception as e:
             logger.debug("Writing of '{}' failed. "
             "Error was: {}".format(filename, e))
@@ -104,180 +284,224 @@ class CacheElement:
 
     # Returns (uncompressed) data
     def data(self, decompress=True):
-        if decompress and self.bCompressed:
-            self.decompress()
+        if self.byte_str is None:
+            self.load_body()
+
+        if decompress:
+            # Idleness of elements without views, see idle_seconds()
+            self.last_read = time.time()
+            return self.decompress()
 
         return self.byte_str
 
     # For etag generation
+    # Normally, the hash was computed while reading the body. Just
+    # elements of older versions of the cache store need the data.
     def hash(self):
         if self._hash:
             return self._hash
 
-        if self.bCompressed:
-            self.decompress()
-
-        l = len(self.byte_str)
-        if self.byte_str is None:
-            self._hash = sha1("").hexdigest()
-        elif l < 10000:
-            self._hash = sha1(self.byte_str).hexdigest()
-        else:
-            s = self.byte_str[:2000] \
-                    + self.byte_str[(l>>1)-1000:(l>>1)+1000] \
-                    + self.byte_str[l-2000:]
-            self._hash = sha1(s).hexdigest()
-
+        data = self.data()
+        self._hash = content_hasher(data or b"").hexdigest()
+        self.bMetaSaved = False  # Persist new hash
         logger.debug("Generated hash: {}".format(self._hash))
         return self._hash
 
-    def compress(self):
-        if self.bCompressed:
-            return
+    def compress(self, idle_time=None, now=None):
+        # idle_time: Just compress if the feed was not viewed for
+        #            idle_time seconds, see idle_seconds().
+        # Returns True if the data was compressed.
+        with self._lock:
+            if self.bCompressed or self.byte_str is None:
+                return False
 
-        len_compressed = len(self.byte_str)
+            if (idle_time is not None
+                    and self.idle_seconds(now) < idle_time):
+                return False  # Viewed in the meantime
 
-        self.byte_str = brotli.compress(
-            self.byte_str,
-            mode=brotli.MODE_TEXT,
-            quality=_BROTLI_COMPRESSION_RATE)
-        self.bCompressed = True
+            len_compressed = len(self.byte_str)
+
+            (self.byte_str, self.codec) = _compress(self.byte_str)
+            self.bCompressed = True
+
+            len_decompressed = len(self.byte_str)
 
-        len_decompressed = len(self.byte_str)
         logger.debug("Compress data. Ratio {}/{} = {:.3f} ".format(
             len_compressed, len_decompressed, len_compressed/len_decompressed))
+        self._size_changed()
+        return True
 
     def decompress(self):
-        if not self.bCompressed:
-            return
+        # Returns the uncompressed data. (Reading self.byte_str after
+        # this call could already see compressed data again.)
+        with self._lock:
+            if not self.bCompressed:
+                return self.byte_str
 
-        len_decompressed = len(self.byte_str)
+            len_decompressed = len(self.byte_str)
 
-        self.byte_str = brotli.decompress(self.byte_str)
-        self.bCompressed = False
+            self.byte_str = cache_codecs.get_codec(self.codec).decompress(
+                self.byte_str)
+            self.bCompressed = False
+            self.codec = None
+
+            data = self.byte_str
+            len_compressed = len(data)
 
-        len_compressed = len(self.byte_str)
         logger.debug("Decompress data. Ratio {}/{} = {:.3f} ".format(
             len_compressed, len_decompressed, len_compressed/len_decompressed))
+        self._size_changed()
+        return data
 
 
     @classmethod
-    def load(cls, filename):
-        dirname = gen_cache_dirname()
+    def load(cls, filename, load_body=True):
+        # load_body: If False, only the metadata is read and the
+        #            body will be loaded by load_body() on demand.
+        store = get_store()
+        if store is None:
+            return None
+
         try:
-            with open(os.path.join(dirname,filename), 'rb') as f:
-                cEl = loads(f.read(-1))
-                # cEl.bSaved is now True
+            if load_body:
+                record = store.get(filename)
+            else:
+                record = store.get_metadata(filename)
         except Exception as e:
-            #logger.debug("Reading of '{}' failed. "
-            #        "Error was: {}".format(filename, e))
+            logger.debug("Reading of '{}' failed. "
+                    "Error was: {}".format(filename, e))
             return None
-        else:
-            # logger.debug("Reading of '{}' succeeded. ".format(filename))
-            pass
 
-        return cEl
+        if record is None or (load_body and record.body is None):
+            return None
+
+        return cls.from_record(record)
 
     @classmethod
     def from_bytes(cls, byte_str, headers=None):
         cEl = cls("", headers)
         cEl.byte_str = byte_str
+        cEl._hash = content_hasher(byte_str).hexdigest()
         return cEl
 
     @classmethod
     def from_file(cls, filename, headers=None):
-        cEl = cls("", headers)
         with open(filename, 'rb',) as f:
-            cEl.byte_str = f.read(-1)
-            return cEl
+            return cls.from_bytes(f.read(-1), headers)
 
         return None
 
     @classmethod
     def from_response(cls, res):
         cEl = cls("", dict(res.getheaders()))
-        cEl.byte_str = res.data  # urllib3 style of response
+        # urllib3 style of response. Data is decompressed while reading.
+        hasher = content_hasher()
+        cEl.byte_str = delta.read_all(res, settings.MAX_FEED_BYTE_SIZE,
+                                      hasher=hasher)
+        cEl._hash = hasher.hexdigest()
+        return cEl
+
+    @classmethod
+    def from_partial_response(cls, res, partial_data, prev_data):
+        # Merges reply of 'A-IM: feed' request (226 IM Used)
+        # with the previous version. Returns None on failure.
+        merged = delta.merge_partial_feed(prev_data, partial_data)
+        if merged is None or len(merged) > settings.MAX_FEED_BYTE_SIZE:
+            return None
+
+        # Headers describing the partial response are dropped.
+        headers = {k: v for (k, v) in res.getheaders().items()
+                   if k.lower() not in ("im", "content-length",
+                                        "content-encoding",
+                                        "transfer-encoding")}
+        cEl = cls.from_bytes(merged, headers)
+        cEl.bytes_spliced = max(len(merged) - len(partial_data), 0)
         return cEl
 
     @classmethod
     def from_response_streamed(cls, res, prev_data):
+        # Content-Length can only be used to verify the spliced
+        # data if it is not the length of encoded data. Without
+        # verification the whole response is read.
+        if res.getheader("Content-Encoding"):
+            return cls.from_response(res)
+        try:
+            content_len = int(res.getheader("Content-Length"))
+        except (TypeError, ValueError):
+            return cls.from_response(res)
+
         cEl = cls("", dict(res.getheaders()))
-        # initial_buffer_len = int(res.getheader("Content-Length", 0))
-        f = BytesIO()
-        read_chunk_size = 2**16
-        search_chunk_size = 2**12  # <= read_chunk_size
-        # Do not use too small search_chunk_size! A false positive
-        # would be fatal.
-
-        # Read bytes from response and compare last bytes of this
-        # chunk with cached values. Break up reading if we can assume
-        # that the tail of the response matches the cached value.
-        num_new_bytes = f.write(res.read(read_chunk_size))
-        while num_new_bytes > 0:
-            search_len = search_chunk_size \
-                    if search_chunk_size < num_new_bytes \
-                    else num_new_bytes
-            f.seek(-search_len, 2)
-            pos_in_cache = prev_data.find(f.read(search_len))
-            if -1 < pos_in_cache:
-                # Fill data with previous value.
-                logger.debug("Fill up response after {} bytes with cached "
-                             "file. Position in cache: {}."\
-                             .format(f.tell(), pos_in_cache))
-                f.write(prev_data[pos_in_cache+search_len:])
-                break
 
-            num_new_bytes = f.write(res.read(read_chunk_size))
+        # Read bytes from response and break up reading if the
+        # tail of the response matches the cached value.
+        hasher = content_hasher()
+        (cEl.byte_str, cEl.bytes_spliced) = delta.read_with_delta(
+            res, prev_data, content_len, settings.MAX_FEED_BYTE_SIZE,
+            hasher=hasher)
+        cEl._hash = hasher.hexdigest()
+
+        if cEl.bytes_spliced:
+            # Unread data would disturb next request of this connection.
+            res.close()
 
-        f.seek(0, 0)  # go back to start of file
-        cEl.byte_str = f.read(-1)
         return cEl
 
 
-def update_cache(key, cEl, bFromDisk=False):
+def _compress(byte_str):
+    # Returns (compressed bytes, codec tag)
+    codec = cache_codecs.default_codec()
+    return (codec.compress(byte_str), codec.name)
+
+
+def update_cache(key, cEl, bFromDisk=False, partial=None):
+    # partial: New items (feed xml) if cEl was created by merging them
+    #          with the previous element. Parsed contexts of the
+    #          previous element will be updated instead of cleared.
     if key == "":
         return
 
     if cEl is None:
         # Omit adding empty values, but remove key
-        try:
-            del _CACHE[key]
-        except KeyError:
-            pass
+        _CACHE.pop(key)
+        release_feed_contexts(key)
         return
 
     #logger.debug("update_cache for {}, {}".format(key, bFromDisk))
     if not bFromDisk:
         cEl.bSaved = False
+
+    prev = _CACHE.peek(key)
     _CACHE[key] = cEl
+    if not bFromDisk:
+        _WRITE_BEHIND.add(key, cEl)
+    if prev is not None and prev is not cEl:
+        # Parsed content of previous element is outdated.
+        if partial is not None:
+            merge_feed_contexts(key, partial)
+        else:
+            update_feed_contexts(key, cEl)
 
-    trim_cache()  # called too often here?!
+    trim_cache()
 
 
-__trim_cache_counter = 0
 def trim_cache(force_memory=None, force_disk=None):
     # Unload data if maximal memory footprint is exceeded
     #
     # force_memory: None|False|True
     # force_disk: None|False|True
     #
-    # If force_* value isn't set. trim_cache() will decide on
+    # If force_memory isn't set. trim_cache() will decide on
     # its own if the trimming will be started.
+    # The disk footprint is only reduced if force_disk is set.
+    # Otherwise, this is left to the housekeeping thread.
 
-    trim_cache_interval_memory = 10
-    trim_cache_interval_disk = 24
-
-    global __trim_cache_counter
-    __trim_cache_counter += 1
-
+    # The footprint of _CACHE is updated incrementally. Thus, this
+    # check is cheap and can be done at every call.
+    _CACHE.set_policy(settings.CACHE_EVICTION_POLICY)
     if force_memory is None and \
-            (__trim_cache_counter % trim_cache_interval_memory) == 0:
+            cache_memory_footprint() > settings.CACHE_MEMORY_LIMIT:
         force_memory = True
 
-    if force_memory is None and \
-            (__trim_cache_counter % trim_cache_interval_disk) == 0:
-        force_disk = True
-
     if force_memory:
         footprint = cache_memory_footprint()
         if footprint  > settings.CACHE_MEMORY_LIMIT:
@@ -287,49 +511,382 @@ def trim_cache(force_memory=None, force_disk=None):
                         bytes_str(settings.CACHE_MEMORY_LIMIT)))
             cache_reduce_memory_footprint(int(2/3 * settings.CACHE_MEMORY_LIMIT))
 
-    if force_disk:
+    if force_disk and settings.CACHE_DIR:
         cache_reduce_disk_footprint(settings.CACHE_DISK_LIMIT)
 
 
-def fetch_from_cache(feed):
+def register_feed_context(feed, cache_key=None):
+    # Marks feed.context as derived from the cache element
+    # of the feed url. The context will be cleared if this
+    # element is removed from the cache.
+    key = cache_key or gen_hash(_REDIRECTS.resolve(feed.url))
+    with _CONTEXT_OWNERS_LOCK:
+        _CONTEXT_OWNERS.setdefault(key, WeakSet()).add(feed)
+
+    # Parsing time is part of the eviction cost of the element.
+    parse_time = feed.context.get("parse_time")
+    cEl = _CACHE.peek(key)
+    if cEl is not None and parse_time is not None:
+        cEl.parse_time = parse_time
+        cEl.bMetaSaved = False
+        _WRITE_BEHIND.add(key, cEl)
+
+
+def release_feed_contexts(key):
+    with _CONTEXT_OWNERS_LOCK:
+        feeds = _CONTEXT_OWNERS.pop(key, ())
+
+    for feed in feeds:
+        logger.debug("Clean feed {} ".format(feed.name))
+        feed.context = {}
+
+
+def move_cache_element(key, new_key):
+    # Feed url has changed. Cache element and parsed
+    # contexts are moved to the new key.
+    cEl = _CACHE.peek(key)
+    if cEl is None or key == new_key:
+        return
+
+    _CACHE.pop(key)
+    # The body of a stub could not be found under the new key.
+    if cEl.load_body():
+        update_cache(new_key, cEl)
+        with _CONTEXT_OWNERS_LOCK:
+            feeds = _CONTEXT_OWNERS.pop(key, ())
+            _CONTEXT_OWNERS.setdefault(new_key, WeakSet()).update(feeds)
+    else:
+        release_feed_contexts(key)
+
+    store = get_store()
+    if store is not None:
+        try:
+            store.delete(key)
+        except Exception as e:
+            logger.debug("Removing of '{}' failed. "
+                         "Error was: {}".format(key, e))
+
+
+def moved_url(url):
+    # New url of permanently moved feed or None.
+    return _REDIRECTS.moved_to(url)
+
+
+def merge_feed_contexts(key, partial):
+    # Adds the entries of a partial feed document to the parsed
+    # contexts derived from the cache element. Feeds where this
+    # fails are cleared.
+    with _CONTEXT_OWNERS_LOCK:
+        feeds = list(_CONTEXT_OWNERS.get(key, ()))
+
+    for feed in feeds:
+        if feed.context and feed_parser.merge_feed(feed, partial):
+            logger.debug("Merged new entries into feed {} ".format(
+                feed.name))
+            continue
+
+        with _CONTEXT_OWNERS_LOCK:
+            _CONTEXT_OWNERS.get(key, set()).discard(feed)
+        feed.context = {}
+
+
+def update_feed_contexts(key, cEl):
+    # Parses new version of the feed in merge mode. Known entries
+    # of the parsed contexts are reused (see feed_parser.update_feed()).
+    # Feeds where this fails are cleared.
+    with _CONTEXT_OWNERS_LOCK:
+        feeds = list(_CONTEXT_OWNERS.get(key, ()))
+
+    if not feeds:
+        return
+
+    text = cEl.data()
+    for feed in feeds:
+        if feed.context and feed_parser.update_feed(feed, text):
+            continue
+
+        with _CONTEXT_OWNERS_LOCK:
+            _CONTEXT_OWNERS.get(key, set()).discard(feed)
+        feed.context = {}
+
+
+def has_current_context(feed, cache_key=None):
+    # True if feed.context was derived from the current
+    # cache element of the feed url.
+    key = cache_key or gen_hash(_REDIRECTS.resolve(feed.url))
+    with _CONTEXT_OWNERS_LOCK:
+        return feed in _CONTEXT_OWNERS.get(key, ())
+
+
+def _context_version(cEl):
+    return "{}:{}".format(cEl.hash(), feed_parser.context_fingerprint())
+
+
+def load_feed_context(feed, cEl, cache_key=None):
+    # Restores parsed context of cEl from the store. Returns False if
+    # no context for the current content and settings is stored.
+    store = get_store()
+    if store is None or not settings.CACHE_PARSED_FEEDS:
+        return False
+
+    key = cache_key or gen_hash(_REDIRECTS.resolve(feed.url))
+    version = _context_version(cEl)
     try:
-        filename = feed.cache_name()
-        cEl = _CACHE[filename]
-        return cEl
-    except KeyError:
-        pass
+        row = store.get_context(key, version)
+        if row is None:
+            return False
+
+        (data, codec) = row
+        if codec:
+            data = cache_codecs.get_codec(codec).decompress(data)
+    except Exception as e:
+        logger.debug("Reading of parsed feed '{}' failed. "
+                     "Error was: {}".format(key, e))
+        return False
+
+    if not feed_parser.restore_context(feed, data):
+        return False
+
+    with _CONTEXT_OWNERS_LOCK:
+        _STORED_CONTEXTS[key] = (
+            version, len(feed.context.get("prepared_pages", [])))
+    return True
+
+
+def store_feed_contexts(feeds):
+    # Writes parsed contexts of feeds which were changed since the
+    # last call, e.g. new prepared pages. One transaction for all.
+    store = get_store()
+    if store is None or not settings.CACHE_PARSED_FEEDS:
+        return 0
+
+    # Feed object with most prepared pages for each element
+    candidates = {}
+    for feed in feeds:
+        key = gen_hash(_REDIRECTS.resolve(feed.url))
+        if not feed.context or not has_current_context(feed, key):
+            continue
+
+        n_pages = len(feed.context.get("prepared_pages", []))
+        if n_pages >= candidates.get(key, (None, -1))[1]:
+            candidates[key] = (feed, n_pages)
+
+    rows = []
+    states = {}
+    for (key, (feed, n_pages)) in candidates.items():
+        cEl = _CACHE.peek(key)
+        if cEl is None or not cEl.is_loaded():
+            continue
+
+        state = (_context_version(cEl), n_pages)
+        with _CONTEXT_OWNERS_LOCK:
+            if _STORED_CONTEXTS.get(key) == state:
+                continue
+
+        try:
+            (data, codec) = _compress(
+                feed_parser.serialize_context(feed.context))
+        except Exception as e:
+            logger.debug("Serialization of parsed feed '{}' failed. "
+                         "Error was: {}".format(key, e))
+            continue
+
+        rows.append((key, state[0], data, codec))
+        states[key] = state
 
-    return None
+    try:
+        store.put_contexts(rows)
+    except Exception as e:
+        logger.error("Writing of {} parsed feeds failed. "
+                     "Error was: {}".format(len(rows), e))
+        return 0
 
+    with _CONTEXT_OWNERS_LOCK:
+        _STORED_CONTEXTS.update(states)
+
+    if rows:
+        logger.debug("Stored {} parsed feeds".format(len(rows)))
+    return len(rows)
+
+
+def record_access(url, cEl):
+    # Counts view of feed by an user. The counters are
+    # written by the write-behind.
+    #
+    # Only this function changes the order and frequencies of the
+    # eviction policies (see memory_cache.py). Lookups of the
+    # scheduler and other internal lookups do not count.
+    key = gen_hash(_REDIRECTS.resolve(url))
+    cEl.record_access()
+    _CACHE.record_access(key, hit=not cEl.bReloaded)
+    cEl.bReloaded = False
+    _WRITE_BEHIND.add(key, cEl)
 
-def fetch_file(url, no_lookup_for_fresh=True, local_dir="rss_server-page/"):
-    logger.debug("Url: {}".format(url))
 
-    # Lockup im memory
-    # cEl = _CACHE.get(url)
+def fetch_from_cache(feed):
+    # Note: Does not count as access of the element.
+    return _CACHE.peek(feed.cache_name())
+
+
+def peek_file(url, load_body=True):
+    # Return cached value for url without any request to
+    # the external server. Returns None if url is not cached.
+    url = _REDIRECTS.resolve(url)
+    #
+    # load_body: If False, the returned element could contain
+    #            only the metadata (see load_cache()).
+    #
+    # Lockup im memory. This is not counted as access of the
+    # element, see record_access().
     filename = gen_hash(url)
-    cEl = _CACHE.get(filename)
+    cEl = _CACHE.peek(filename)
 
-    # Lookup on disk if not im memory
+    # Lookup on disk if not im memory. Evicted elements could
+    # still wait on their write.
     if not cEl:
-        cEl = CacheElement.load(filename)
+        cEl = _WRITE_BEHIND.pending(filename)
+        if not load_body:
+            # Metadata is sufficient, e.g. for the scheduler. Neither
+            # the body is read nor the memory cache is changed.
+            return cEl or CacheElement.load(filename, load_body=False)
+
+        cEl = cEl or CacheElement.load(filename)
         if cEl:
+            cEl.bReloaded = True
             update_cache(filename, cEl, bFromDisk=True)
 
-    headers={'User-Agent': 'Mozilla/5.0'}
-    # Prepare headers for lookup of modified content
-    # This allows the target server to decide if we had already
-    # the newest file version.
+    elif load_body and not cEl.is_loaded():
+        if not cEl.load_body():
+            update_cache(filename, None)
+            return None
+
+        cEl.bReloaded = True
+        trim_cache()
+
+    return cEl
+
+
+def host_blocked_until(url):
+    # Timestamp until requests for url will be rejected
+    # (see host_limiter.py)
+    return _HOSTS.blocked_until(urlparse(url).netloc)
+
+
+def is_expired(cEl, max_age=None, now=None):
+    # True if cached value is older than max_age seconds.
+    # (Default: Freshness lifetime of this feed, see freshness.py)
+    if now is None:
+        now = int(time.time())
+    if max_age is None:
+        max_age = freshness.lifetime(cEl, now)
+
+    return (now - cEl.timestamp) >= max_age
+
+
+def fetch_file(url, no_lookup_for_fresh=True, local_dir="rss_server-page/",
+               max_age=None):
+    # max_age: Overrides the freshness lifetime for the decision if
+    #          the cached value is fresh enough.
+    logger.debug("Url: {}".format(url))
+
+    url = _REDIRECTS.resolve(url)
+    filename = gen_hash(url)
+    cEl = peek_file(url)
 
     # Force return cached value without check of change on source
     # url if less time was
     now = int(time.time())
     if (cEl and no_lookup_for_fresh and
-            (now - cEl.timestamp) < settings.CACHE_EXPIRE_TIME_S):
+            not is_expired(cEl, max_age, now)):
         # We do not want hassle the target with a new request.
         logger.debug("Skip request because current data is fresh.")
         return (cEl, 304)
 
+    if cEl is None and no_lookup_for_fresh and _FAILURES.get(url):
+        logger.debug("Skip request because last request failed.")
+        return (None, 500)
+
+    # Concurrent callers for the same url wait on the already
+    # running request and share its result.
+    return _FETCH_FLIGHTS.do(filename, _request_file,
+                             url, filename, cEl,
+                             no_lookup_for_fresh, local_dir)
+
+
+def push_file(url, byte_str, headers=None):
+    # Stores content delivered by a WebSub hub (see websub.py).
+    # Hubs could push the whole feed or just the new items:
+    # • A document repeating items of the previous element (or
+    #   without any items) is the whole feed and replaces the element.
+    # • Otherwise, the new items are merged with the previous
+    #   element. The number of items is kept (or limited by
+    #   CONTENT_MAX_ENTRIES).
+    # Returns False if the data could not be used.
+    url = _REDIRECTS.resolve(url)
+    filename = gen_hash(url)
+    prev = peek_file(url)
+    now = int(time.time())
+
+    partial = None
+    if prev is not None and prev.load_body():
+        prev_data = prev.data()
+        prev_ids = delta.item_ids(prev_data)
+        new_ids = delta.item_ids(byte_str)
+        if new_ids and not (prev_ids & new_ids):
+            max_items = max(len(prev_ids), 1)
+            if settings.CONTENT_MAX_ENTRIES > -1:
+                max_items = settings.CONTENT_MAX_ENTRIES
+            merged = delta.merge_partial_feed(prev_data, byte_str, max_items)
+            if merged is not None:
+                (byte_str, partial) = (merged, byte_str)
+
+    if len(byte_str) > settings.MAX_FEED_BYTE_SIZE:
+        return False
+
+    # Validators of the previous element do not match the new content.
+    cEl = CacheElement.from_bytes(byte_str, headers)
+    freshness.update(cEl, prev, status=200, now=now)
+    update_cache(filename, cEl, partial=partial)
+    _FAILURES.remove(url)
+    return True
+
+
+def _request_file(url, filename, cEl, no_lookup_for_fresh, local_dir):
+    host_key = urlparse(url).netloc
+    try:
+        # Do not wait on a free slot if the cached copy can be returned.
+        slot = _HOSTS.acquire(host_key, timeout=0 if cEl
+                              else settings.FETCH_HOST_WAIT_TIMEOUT_S)
+    except HostUnavailable as e:
+        logger.debug(str(e))
+        if cEl:
+            return (cEl, 304)
+        return (None, 500)
+
+    # The deadline covers name resolution, connect, TLS handshake
+    # and the transfer of the body. (urllib3 timeouts are
+    # applied on each socket operation.)
+    with slot, deadline.Deadline(settings.FETCH_DEADLINE_S):
+        try:
+            return _request_file_from_host(url, host_key, filename, cEl,
+                                           no_lookup_for_fresh, local_dir)
+        except delta.SizeExceeded as e:
+            _FAILURES.add(url, FailureKind.TOO_LARGE, str(e))
+            raise
+
+
+def _request_file_from_host(url, host_key, filename, cEl,
+                            no_lookup_for_fresh, local_dir,
+                            allow_partial=True):
+    # allow_partial: Request just the new items if the server
+    #                supports RFC 3229 with 'A-IM: feed'.
+    headers={'User-Agent': 'Mozilla/5.0',
+             'Accept-Encoding': _ACCEPT_ENCODING}
+    # Prepare headers for lookup of modified content
+    # This allows the target server to decide if we had already
+    # the newest file version.
+    now = int(time.time())
+
     if cEl:
         # Give extern server enough information to decide
         # if we had already the newest version.
@@ -337,6 +894,9 @@ def fetch_file(url, no_lookup_for_fresh=True, local_dir="rss_server-page/"):
             headers['If-None-Match'] = cEl.headers.get('ETag')
             # req.add_header('If-None-Match',
             #                cEl.headers.get('ETag'))
+            if allow_partial and settings.FETCH_RFC3229:
+                # Servers ignoring this header reply as usual.
+                headers['A-IM'] = 'feed'
         if "Last-Modified" in cEl.headers:
             headers['If-Modified-Since'] = cEl.headers.get('Last-Modified')
             # req.add_header('If-Modified-Since',
@@ -369,72 +929,159 @@ def fetch_file(url, no_lookup_for_fresh=True, local_dir="rss_server-page/"):
 
 
         # Request new version
-        response = _HTTP.request('GET', url,
+        request_url = _REDIRECTS.location(url)
+        start = time.monotonic()
+        response = _HTTP.request('GET', request_url,
                                  headers=headers,
                                  timeout=Timeout(connect=5.2, read=60.0),
                                  # retries=1,
-                                 retries=Retry(3, redirect=20),
+                                 # 429/503 with Retry-After are handled
+                                 # by _HOSTS and not by sleeping here.
+                                 retries=Retry(3, redirect=20,
+                                     respect_retry_after_header=False),
                                  preload_content=False,
                                 )
-        # Note about timeout/MaxRetriesError: 
-        #    If the DNS resolving hangs, it does not count
-        #    into the timeout?! Thus it will hang longer than
-        #    expected. urllib3 suggests a second thread to abort
-        #    after fixed amout of time, if it hangs.
-        # TODO
+        # Note about timeout/MaxRetriesError:
+        #    DNS resolving and the whole transfer are bounded
+        #    by the Deadline of _request_file().
 
         try:
             # Content-Length header optional/not set in all cases…
             content_len = int(response.getheader("Content-Length", 0))
             if content_len > settings.MAX_FEED_BYTE_SIZE:
-                raise Exception("Feed file exceedes maximal size. {0} > {1}"
-                                "".format(content_len,
-                                          settings.MAX_FEED_BYTE_SIZE))
+                response.release_conn()
+                raise delta.SizeExceeded(
+                    "Feed file exceedes maximal size. {0} > {1}"
+                    "".format(content_len, settings.MAX_FEED_BYTE_SIZE))
         except ValueError:
             pass
 
     # urllib3
     except (TimeoutError, MaxRetryError, ResponseError, SSLError) as e:
         logger.debug('{}: {}'.format(type(e).__name__, str(e)))
+        _HOSTS.report_failure(host_key)
+        _FAILURES.add(url, _failure_kind(e), type(e).__name__)
         # raise e
-        if cEl:
-            # Our data is old, but the server connection failed.
-            # Do not hassle server directly again.
-            cEl.timestamp = now - settings.CACHE_EXPIRE_TIME_S/4
-            return (cEl, 304)
-        else:
-            return (None, 500)
+        return _request_failed(cEl, now)
 
     else:
-        if response.status == 304:  # Not modified => Return cached value
-            cEl.timestamp = now  # Our local data is still fresh
-            logger.debug("Extern server replies: No new data available. Return cached value")
+        if (response.status == 429 or (response.status == 503
+                and response.getheader("Retry-After"))):
+            _HOSTS.report_throttled(host_key,
+                                    response.getheader("Retry-After"))
+            response.release_conn()
             if cEl:
                 return (cEl, 304)
+            return (None, 500)
 
-        # everything is fine
+        _HOSTS.report_success(host_key)
+
+        new_url = _REDIRECTS.note(url, request_url,
+                                  response.retries.history
+                                  if response.retries else ())
+        if new_url != url:
+            # Following requests use the new url directly.
+            new_filename = gen_hash(new_url)
+            move_cache_element(filename, new_filename)
+            (url, filename) = (new_url, new_filename)
+
+        if response.status >= 400:
+            # Error pages are not stored as feed data.
+            logger.debug("Extern server replies with status {}".format(
+                response.status))
+            response.release_conn()
+            _FAILURES.add(url, FailureKind.HTTP_ERROR,
+                          "HTTP {}".format(response.status))
+            return _request_failed(cEl, now)
 
-        if (cEl and no_lookup_for_fresh and
-            len(cEl.byte_str) > (3000 if cEl.bCompressed else 10000)):
-            # We can only compare new and old data in from_response_streamed()
-            # if both is decompressed.
-            if cEl.bCompressed:
-                cEl.decompress()
+        if response.status == 304:  # Not modified => Return cached value
+            logger.debug("Extern server replies: No new data available. Return cached value")
+            if cEl:
+                response.release_conn()
+                _CONDITIONALS.record(host_key, "not_modified")
+                return _not_modified(url, filename, cEl, response, now)
 
-            cEl =  CacheElement.from_response_streamed(response, cEl.byte_str)
-        else:
-            cEl = CacheElement.from_response(response)
+        prev = cEl
+        partial = None
 
-        response.release_conn()  # preload_content=False requires this
+        # everything is fine
 
-        # This check is required for responses without Content-Length header
-        # and responses with wrong header vaules.
-        if len(cEl.byte_str) > settings.MAX_FEED_BYTE_SIZE:
-            raise Exception("Feed file exceedes maximal size. {0} > {1}"
-                            "".format(len(cEl.byte_str),
-                                      settings.MAX_FEED_BYTE_SIZE))
+        try:
+            if (response.status == 226 and prev
+                    and "feed" in (response.getheader("IM") or "")):
+                # RFC 3229: Response contains only the new items.
+                partial = delta.read_all(response,
+                                         settings.MAX_FEED_BYTE_SIZE)
+                cEl = CacheElement.from_partial_response(
+                    response, partial, prev.data())
+            elif (cEl and no_lookup_for_fresh and
+                len(cEl.byte_str) > (3000 if cEl.bCompressed else 10000)):
+                # We can only compare new and old data in
+                # from_response_streamed() if both is decompressed.
+                cEl =  CacheElement.from_response_streamed(
+                    response, cEl.data())
+            else:
+                cEl = CacheElement.from_response(response)
+
+            if deadline.current().expired:
+                # Socket was shut down. Data could be incomplete.
+                raise ReadTimeoutError(None, url, "Fetch deadline exceeded")
+
+        except (TimeoutError, ProtocolError, SSLError, DecodeError) as e:
+            logger.debug('{}: {}'.format(type(e).__name__, str(e)))
+            _HOSTS.report_failure(host_key)
+            _FAILURES.add(url, _failure_kind(e), type(e).__name__)
+            response.release_conn()
+            return _request_failed(prev, now)
+
+        except delta.SizeExceeded:
+            # MAX_FEED_BYTE_SIZE is checked while reading. This is
+            # required for responses without Content-Length header,
+            # with wrong header values or compressed data.
+            response.close()
+            response.release_conn()
+            raise
+
+        if cEl is None:
+            # Merge of partial response failed. Request whole feed.
+            logger.debug("Merge of partial feed failed for {}".format(url))
+            response.release_conn()
+            return _request_file_from_host(url, host_key, filename, prev,
+                                           no_lookup_for_fresh, local_dir,
+                                           allow_partial=False)
+
+        # Wire bytes could be compressed.
+        _TRANSFERS.record(url, response.tell(),
+                          len(cEl.byte_str) - cEl.bytes_spliced,
+                          cEl.bytes_spliced)
+        response.release_conn()  # preload_content=False requires this
 
-        update_cache(filename, cEl)
+        cEl.fetch_time = time.monotonic() - start
+        if partial is None and prev is not None:
+            if cEl.hash() == prev.hash():
+                # Server ignored If-None-Match/If-Modified-Since. Keep
+                # previous element. Thus, parsed contexts, prepared
+                # pages and ETags of the pages remain valid.
+                logger.debug("Extern server replies with unchanged data.")
+                _CONDITIONALS.record(host_key, "unchanged")
+                prev.fetch_time = cEl.fetch_time
+                return _not_modified(url, filename, prev, response, now,
+                                     validators=True)
+
+            _CONDITIONALS.record(host_key, "changed")
+
+        if prev is not None and partial is not None:
+            # Partial responses are cheaper than a fetch
+            # of the whole feed after an eviction.
+            cEl.fetch_time = max(cEl.fetch_time, prev.fetch_time or 0.0)
+        if prev is not None:
+            cEl.parse_time = prev.parse_time
+            cEl.access_count = prev.access_count
+            cEl.last_access = prev.last_access
+
+        freshness.update(cEl, prev, status=200, now=now)
+        update_cache(filename, cEl, partial=partial)
+        _FAILURES.remove(url)
 
         # Write file to disk
         # It is commented out because storing cache element at programm end
@@ -450,6 +1097,89 @@ def fetch_file(url, no_lookup_for_fresh=True, local_dir="rss_server-page/"):
     return (None, 404)
 
 
+def _not_modified(url, filename, cEl, response, now, validators=False):
+    # Keeps the cached element.
+    #
+    # validators: Take ETag and Last-Modified of the response, too.
+    #             (For 200 replies with unchanged data.)
+    cEl.timestamp = now  # Our local data is still fresh
+    # Lifetime announced by the reply replaces the previous one.
+    names = ("Cache-Control", "Expires", "Date")
+    if validators:
+        names += ("ETag", "Last-Modified")
+    for name in names:
+        value = response.getheader(name)
+        if value is not None:
+            cEl.headers[name] = value
+    freshness.update(cEl, status=304, now=now)
+    cEl.bMetaSaved = False
+    _WRITE_BEHIND.add(filename, cEl)
+    # Unchanged data would fail parsing again.
+    _FAILURES.remove(url, _TRANSFER_FAILURES)
+    return (cEl, 304)
+
+
+def _failure_kind(e):
+    reason = getattr(e, "reason", e)  # MaxRetryError wraps the cause
+    # Note: NewConnectionError is a subclass of TimeoutError
+    if isinstance(reason, NewConnectionError):
+        return FailureKind.NETWORK
+    if isinstance(e, TimeoutError) or isinstance(reason, TimeoutError):
+        return FailureKind.TIMEOUT
+    return FailureKind.NETWORK
+
+
+# Failures which are resolved by any reply of the server
+_TRANSFER_FAILURES = (FailureKind.HTTP_ERROR, FailureKind.TIMEOUT,
+                      FailureKind.NETWORK, FailureKind.TOO_LARGE)
+
+
+def add_failure(url, kind, detail=""):
+    # Marks url as failed, e.g. if the feed could not be parsed.
+    return _FAILURES.add(_REDIRECTS.resolve(url), kind, detail)
+
+
+def get_failure(url):
+    # Returns Failure if a recent request or parsing of url
+    # failed, otherwise None.
+    #
+    # Failed requests are ignored if a cached copy exists. It will
+    # be served instead (see _request_failed()).
+    url = _REDIRECTS.resolve(url)
+    failure = _FAILURES.get(url)
+    if (failure is not None and failure.kind in _TRANSFER_FAILURES
+            and peek_file(url, load_body=False) is not None):
+        return None
+
+    return failure
+
+
+def _request_failed(cEl, now):
+    if cEl:
+        # Our data is old, but the server connection failed.
+        # Do not hassle server directly again.
+        cEl.timestamp = int(now - freshness.lifetime(cEl, now)
+                            + 3/4 * settings.CACHE_EXPIRE_TIME_S)
+        return (cEl, 304)
+
+    return (None, 500)
+
+
+def statistic():
+    return {
+        "memory_cache": _CACHE.statistic(),
+        "disk_footprint": cache_disk_footprint(),
+        "requests": _FETCH_FLIGHTS.statistic(),
+        "hosts": _HOSTS.statistic(),
+        "dns": dns_cache.statistic(),
+        "transfers": _TRANSFERS.statistic(),
+        "conditional_requests": _CONDITIONALS.statistic(),
+        "redirects": _REDIRECTS.statistic(),
+        "failures": _FAILURES.statistic(),
+        "write_behind": _WRITE_BEHIND.statistic(),
+    }
+
+
 def gen_cache_filename(feed_name):
     s = sha1()
     s.update(feed_name.encode('utf-8'))
@@ -471,8 +1201,156 @@ def gen_cache_dirname(bCreateFolder=False):
     return dirname
 
 
+def get_store():
+    # Returns the on-disk store of cache elements. It will be
+    # opened at first call. Returns None if CACHE_DIR is not set.
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is not None:
+            return _STORE
+
+        dirname = gen_cache_dirname(True)
+        if not dirname:
+            return None
+
+        store = CacheStore(dirname)
+        try:
+            store.open()
+        except Exception as e:
+            logger.error("Opening of cache store '{}' failed. "
+                         "Error was: {}".format(store.path, e))
+            return None
+
+        _remove_legacy_cache_files(dirname)
+        _load_compression_dictionaries(store)
+        _STORE = store
+        return _STORE
+
+
+def _load_compression_dictionaries(store):
+    # Dictionaries are required to decompress elements of the store.
+    # The newest one is used for new elements.
+    try:
+        dictionaries = store.dictionaries()
+    except Exception as e:
+        logger.error("Reading of compression dictionaries failed. "
+                     "Error was: {}".format(e))
+        return
+
+    for (tag, data) in dictionaries:
+        try:
+            cache_codecs.register_dictionary(data)
+        except cache_codecs.CodecUnavailable as e:
+            logger.error("Compression dictionary '{}' not usable. "
+                         "Error was: {}".format(tag, e))
+            continue
+
+
+def close_store():
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is not None:
+            _STORE.close()
+            _STORE = None
+
+
+def _remove_legacy_cache_files(dirname):
+    # Previous versions had written one pickle file per feed. They
+    # are named by gen_cache_filename() and not read anymore.
+    n_removed = 0
+    for f in Path(dirname).glob('*'):
+        if f.is_file() and re.fullmatch("[0-9a-f]{16}", f.name):
+            f.unlink(True)
+            n_removed += 1
+
+    if n_removed:
+        logger.info("Removed {} files of old cache format.".format(
+            n_removed))
+
+
+def store_elements(elements):
+    # Save list of (key, cEl) pairs in one transaction.
+    # Returns the pairs which could not be written.
+    store = get_store()
+    if store is None or not elements:
+        return []
+
+    try:
+        store.put_many([cEl.to_record(key) for (key, cEl) in elements])
+    except Exception as e:
+        logger.error("Writing of {} cache elements failed. "
+                     "Error was: {}".format(len(elements), e))
+        return elements
+
+    for (key, cEl) in elements:
+        cEl.bSaved = True
+        cEl.bMetaSaved = True
+    return []
+
+
+def store_metadata(elements):
+    # Save metadata of list of (key, cEl) pairs whose
+    # body is already stored.
+    # Returns the pairs which could not be written.
+    store = get_store()
+    if store is None or not elements:
+        return []
+
+    try:
+        store.update_metadata([StoreRecord(key, None, cEl.bCompressed,
+                                           cEl.headers, cEl.timestamp,
+                                           cEl._hash, meta=cEl.meta())
+                               for (key, cEl) in elements])
+    except Exception as e:
+        logger.error("Writing of metadata of {} cache elements failed. "
+                     "Error was: {}".format(len(elements), e))
+        return elements
+
+    for (key, cEl) in elements:
+        cEl.bMetaSaved = True
+    return []
+
+
+def write_dirty_elements(elements):
+    # Save bodies of unsaved and metadata of changed elements
+    # of the list of (key, cEl) pairs.
+    # Returns the pairs which could not be written.
+    unsaved = [(key, cEl) for (key, cEl) in elements if not cEl.bSaved]
+    outdated_meta = [(key, cEl) for (key, cEl) in elements
+                     if cEl.bSaved and not cEl.bMetaSaved]
+    if not unsaved and not outdated_meta:
+        return []
+
+    failed = store_elements(unsaved) + store_metadata(outdated_meta)
+
+    # Keeps the WAL of the store short. Thus, recovery after
+    # a crash is cheap.
+    store = get_store()
+    if store is not None:
+        store.checkpoint()
+
+    return failed
+
+
+# Flushes dirty elements in background, see write_behind.py
+_WRITE_BEHIND = WriteBehind(write_dirty_elements)
+
+
+def start_write_behind():
+    if settings.CACHE_DIR:
+        _WRITE_BEHIND.start()
+
+
+def stop_write_behind():
+    # Writes all pending elements.
+    if _WRITE_BEHIND.is_running():
+        _WRITE_BEHIND.stop()
+
+
 def store_cache(*feed_lists):
     # Save all unsaved cache elements on disk
+    unsaved = {}
+    outdated_meta = {}
     for idx in range(len(feed_lists)):
         for group in feed_lists[idx]:
             if isinstance(group, Group):
@@ -482,22 +1360,31 @@ def store_cache(*feed_lists):
 
             for feed in _tmp:
                 cEl = fetch_from_cache(feed)
-                if not cEl or cEl.bSaved:
+                if not cEl:
                     continue
 
                 filename = feed.cache_name()
-                logger.info("Write {}".format(filename))
-                cEl.store(filename)
+                if not cEl.bSaved:
+                    logger.info("Write {}".format(filename))
+                    unsaved[filename] = cEl
+                elif not cEl.bMetaSaved:
+                    outdated_meta[filename] = cEl
+
+    store_elements(list(unsaved.items()))
+    store_metadata(list(outdated_meta.items()))
 
 
 def load_cache(*feed_lists):
-    # Load cache elements from disk
+    # Load metadata of cache elements from disk.
     #
-    # To respect the maximal memory consumption,
-    # the loading stops if the barrier is reaced.
-    # Not the best strategy (disrespect of timestamp),
-    # but simple...
-    footprint = cache_memory_footprint()
+    # The bodies are not loaded here. This is done on first
+    # access or by warm_up_cache(). Thus, startup time did
+    # not depend on the size of the cache.
+    store = get_store()
+    if store is None:
+        return
+
+    keys = set()
     for idx in range(len(feed_lists)):
         for group in feed_lists[idx]:
             if isinstance(group, Group):
@@ -506,138 +1393,270 @@ def load_cache(*feed_lists):
                 _tmp = [group]
 
             for feed in _tmp:
-                filename = feed.cache_name()
-                cEl = CacheElement.load(filename)
+                keys.add(feed.cache_name())
+
+    try:
+        records = store.metadata(keys)
+    except Exception as e:
+        logger.error("Reading of cache index failed. "
+                     "Error was: {}".format(e))
+        return
+
+    for record in records:
+        if record.key not in _CACHE:
+            update_cache(record.key, CacheElement.from_record(record),
+                         bFromDisk=True)
+
+
+def warm_up_cache(pause=0.05, parse=None, n_parse=0):
+    # Loads bodies of elements created by load_cache(). Most read
+    # elements first (see CacheElement.hotness()), then the newest.
+    # Stops if the memory limit would be exceeded.
+    #
+    # parse: Callable(key, cEl) to parse the first n_parse
+    #        elements before users request them.
+    #
+    # Intended to run in a background thread. The pause between
+    # two elements leaves the CPU/disk for the request handlers.
+    now = time.time()
+    n_loaded = 0
+    n_parsed = 0
+    elements = sorted(_CACHE.items(),
+                      key=lambda x: (x[1].hotness(now), x[1].timestamp),
+                      reverse=True)
+    for (key, cEl) in elements:
+        if _CACHE.peek(key) is not cEl:
+            continue  # Replaced in the meantime
+
+        if not cEl.is_loaded():
+            if cache_memory_footprint() > settings.CACHE_MEMORY_LIMIT:
+                logger.debug("Stopping warm_up_cache(). "
+                             "Memory limit reached.")
+                break
+
+            if not cEl.load_body():
+                update_cache(key, None)
+                continue
+            n_loaded += 1
+
+        if parse and n_parsed < n_parse and cEl.access_count:
+            try:
+                parse(key, cEl)
+            except Exception as e:
+                logger.error("Parsing of '{}' in warm up failed. "
+                             "Error was: {}".format(key, e))
+            n_parsed += 1
+
+        time.sleep(pause)
+
+    logger.info("Warm up of cache finished. Loaded {} feeds. "
+                "Parsed {} feeds.".format(n_loaded, n_parsed))
+    return n_loaded
 
-                if cEl:
-                    footprint += cEl.memory_footprint()
-                    if footprint > settings.CACHE_MEMORY_LIMIT:
-                        logger.debug("Stopping load_cache(). "\
-                                "\n{} requested.\n{} allowed".\
-                                format(bytes_str(footprint),
-                                    bytes_str(settings.CACHE_MEMORY_LIMIT)))
-                        return
 
-                    update_cache(filename, cEl, bFromDisk=True)
+def start_warm_up_cache(parse=None, n_parse=0):
+    t = Thread(target=warm_up_cache, name="CacheWarmUp",
+               kwargs={"parse": parse, "n_parse": n_parse})
+    t.daemon = True
+    t.start()
+    return t
 
 
 def cache_memory_footprint():
     # Return consumed bytes of cache elements
-    footprint = 0
-    for cEl in _CACHE.values():
-        footprint += cEl.memory_footprint()
+    return _CACHE.footprint
 
-    return footprint
 
 def cache_reduce_memory_footprint(upper_bound):
-    # Unload oldest elements
+    # Unload elements (order depends on CACHE_EVICTION_POLICY)
+    evict_from_memory(upper_bound)
 
-    # 1. Loop over Feed-Elements to build 'cEl->Feed' map for step 2.
-    #
-    #   Preimage of this map can be real subset of _CACHE.keys().
-    def get_size(obj, seen=None):
-        # Estimates memory consumption of nested dicts.
-        # Reduced variant from
-        #  https://github.com/bosswissam/pysize/blob/master/pysize.py
-        size = getsizeof(obj)
-        if seen is None:
-            seen = set()
-        obj_id = id(obj)
-        if obj_id in seen:
-            return 0
-
-        seen.add(obj_id)
-        if isinstance(obj, dict):
-            size += sum((get_size(v, seen) for v in obj.values()))
-            size += sum((get_size(k, seen) for k in obj.keys()))
-        elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
-            size += sum((get_size(i, seen) for i in obj))
-        return size
-
-    def create_filename_to_feed_map():
-        cache_map = {}  # filename->feed - map
-        footprint_feeds = 0
-        for feed in settings.all_feeds(settings):
-            filename = feed.cache_name()
-            if not filename in _CACHE and feed.context:
-                # Outdated feed?! Clear .context dict
-                logger.debug("Clean feed {} ".format(feed.name))
-                feed.context = {}
-
-            footprint_feeds += get_size(feed.context)
-            cache_map[filename] = feed
-
-        logger.debug("Footprint of all context-vars: {}".format(footprint_feeds))
-        return cache_map
-
-    cache_map = create_filename_to_feed_map()
-
-    # 2. Loop over cache sorted by timestamp.
-    footprint = 0
-    to_remove = []
-    for (filename, cEl) in sorted(_CACHE.items(),
-            key=lambda x: x[1].timestamp, reverse=True):
-        footprint2 = footprint + cEl.memory_footprint()
-        try:
-            feed = cache_map[filename]
-            footprint2 += len(feed.context)
-        except KeyError:
-            pass
+    # footprint of leftover elements
+    return _CACHE.footprint
 
-        if footprint2 > upper_bound:
-            to_remove.append(filename)
-        else:
-            footprint = footprint2
 
-    for filename in to_remove:
+def evict_from_memory(upper_bound):
+    # Returns number of evicted elements. Unsaved elements
+    # are written into the store.
+    evicted = _CACHE.evict(upper_bound)
+    for (filename, cEl) in evicted:
         logger.debug("Remove '{}' from loaded cached_requests: ".\
                 format(filename))
+        release_feed_contexts(filename)
+
+    if settings.CACHE_DIR:
+        # Written by the flusher thread. Without it, the
+        # caller has to wait on the write.
+        dirty = [(filename, cEl) for (filename, cEl) in evicted
+                 if not cEl.bSaved or not cEl.bMetaSaved]
+        write_dirty_elements([
+            (filename, cEl) for (filename, cEl) in dirty
+            if not _WRITE_BEHIND.add(filename, cEl, urgent=True)])
+
+    return len(evicted)
+
+
+def release_idle_feed_contexts(idle_time, now=None):
+    # Clears parsed contexts of elements which were not viewed for
+    # idle_time seconds (see CacheElement.idle_seconds()). They will be parsed again on next access.
+    # Returns number of released contexts.
+    now = now or time.time()
+    n_released = 0
+    for (key, cEl) in _CACHE.items():
+        if cEl.idle_seconds(now) < idle_time:
+            continue
+
+        with _CONTEXT_OWNERS_LOCK:
+            n_feeds = len(_CONTEXT_OWNERS.get(key, ()))
+        if n_feeds:
+            release_feed_contexts(key)
+            n_released += n_feeds
+
+    return n_released
+
+
+def compress_idle_elements(idle_time=None, now=None):
+    # Hot/cold tiering of the memory cache: Elements which were not
+    # viewed for idle_time seconds are compressed. Reading decompresses
+    # an element (see CacheElement.data()) and it stays uncompressed
+    # until it is idle again. Background refreshes do not keep elements
+    # uncompressed, see CacheElement.idle_seconds().
+    #
+    # Intended to run in the housekeeping thread.
+    if idle_time is None:
+        idle_time = settings.CACHE_COMPRESS_IDLE_S
+    if not idle_time:
+        return 0
+
+    now = now or time.time()
+    n_compressed = 0
+    for (key, cEl) in _CACHE.items():  # Least recently used first
+        if (cEl.bCompressed or not cEl.is_loaded()
+                or cEl.idle_seconds(now) < idle_time):
+            continue
+
+        # Idleness is checked again under the lock of the element.
+        # It could be viewed in the meantime.
+        if cEl.compress(idle_time, now):
+            n_compressed += 1
+
+    if n_compressed:
+        logger.debug("Compressed {} idle cache elements.".format(
+            n_compressed))
+    return n_compressed
+
+
+def _sample_bodies(load=False):
+    # Uncompressed bodies of cache elements. The elements itself
+    # keep their state.
+    #
+    # load: Read bodies of elements which are not loaded yet.
+    samples = []
+    for (key, cEl) in _CACHE.items():
+        if not cEl.is_loaded() and not (load and cEl.load_body()):
+            continue
+
+        with cEl._lock:
+            (body, bCompressed, codec) = (cEl.byte_str, cEl.bCompressed,
+                                          cEl.codec)
+        if not body:
+            continue
+
+        if bCompressed:
+            try:
+                body = cache_codecs.get_codec(codec).decompress(body)
+            except Exception as e:
+                logger.debug("Decompression of '{}' failed. "
+                             "Error was: {}".format(key, e))
+                continue
+
+        samples.append(body)
+
+    return samples
+
+
+def train_compression_dictionary():
+    # Trains dictionary for codec 'zstd-dict' on the cached feeds.
+    # New compressed elements will use it. Old dictionaries are
+    # kept as long as elements depend on them.
+    #
+    # Intended to run in the housekeeping thread.
+    if (settings.CACHE_COMPRESSION_CODEC != "zstd-dict"
+            or "zstd-dict" not in cache_codecs.available()):
+        return None
 
-        cEl = _CACHE[filename]
-        if not cEl.bSaved:
-            cEl.store(filename)
-        del _CACHE[filename]
+    result = cache_codecs.train_dictionary(_sample_bodies())
+    if result is None:
+        return None
 
-        try:
-            feed = cache_map[filename]
-            feed.context = {}
-        except KeyError:
-            pass
+    (tag, dict_data) = result
+    store = get_store()
+    if store is None:
+        return tag
 
+    try:
+        store.put_dictionary(tag, dict_data)
+        in_use = set((cEl.codec for (_, cEl) in _CACHE.items()))
+        in_use.add(tag)
+        store.delete_unused_dictionaries(keep=in_use)
+    except Exception as e:
+        logger.error("Writing of compression dictionary failed. "
+                     "Error was: {}".format(e))
 
-    # footprint of leftover elements
-    return footprint
+    return tag
 
 
-def cache_reduce_disk_footprint(upper_bound):
-    # Avoid infinite filling of disk by deleting oldest files
-    cache_dir = Path(gen_cache_dirname())
+def benchmark_codecs(names=None):
+    # Ratio and speed of the compression codecs for the
+    # cached feeds. See cache_codecs.benchmark().
+    samples = _sample_bodies(load=True)
+    logger.info("Benchmark compression codecs on {} feeds ({} bytes)"
+                "".format(len(samples), sum((len(s) for s in samples))))
+    return cache_codecs.benchmark(samples, names)
+
+
+def cache_disk_footprint():
+    # Return consumed bytes of stored cache elements, parsed feeds
+    # and compression dictionaries
+    store = get_store()
+    if store is None:
+        return 0
+
+    return store.disk_footprint()
 
-    # glob('*') is non-recursive , '**/*' recursive
-    cache_files = [f for f in cache_dir.glob('*') if f.is_file()]
-    consumed_bytes = 0
-    n_removed = 0
-    for f in sorted(cache_files,
-            key=lambda x: x.stat().st_mtime, reverse=True):
-        consumed_bytes += f.stat().st_size
-        if consumed_bytes > upper_bound:
-            logger.debug("Remove {} from cache dir.".format(f.name))
-
-            # To be sure to not remove files in a wrong folder,
-            # re-check if we're in the cache folder.
-            if f.absolute().parent.name == CACHE_DIR_NAME:
-                f.unlink(True)
-                n_removed += 1
-            else:
-                logger.debug("ATTENTION, {} IS NOT IN CACHE DIRECTORY." \
-                        "SKIP DELETION".format(f.name))
 
-    logger.info("Removed {} files from cache dir.".format(n_removed))
+def cache_reduce_disk_footprint(upper_bound):
+    # Avoid infinite filling of disk by deleting oldest elements
+    store = get_store()
+    if store is None:
+        return
+
+    n_removed = store.reduce_disk_footprint(upper_bound)
+    logger.info("Removed {} elements from cache store.".format(n_removed))
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
 
+    print("Read compressed response with changed tail…")
+    from gzip import compress as gzip_compress
+    from io import BytesIO
+    from urllib3.response import HTTPResponse
+    def gen_feed(first, last):
+        return (b"<rss><channel>" + b"".join(
+            b"<item><guid>%d</guid>%s</item>" % (i, b"-"*600)
+            for i in range(last, first-1, -1)) + b"</channel></rss>")
+
+    prev_data = gen_feed(1, 20)
+    new_data = gen_feed(2, 21)  # Oldest item dropped
+    gz_data = gzip_compress(new_data)
+    response = HTTPResponse(
+        BytesIO(gz_data), preload_content=False,
+        headers={"Content-Encoding": "gzip",
+                 "Content-Length": str(len(gz_data))})
+    cEl = CacheElement.from_response_streamed(response, prev_data)
+    assert cEl.byte_str == new_data and cEl.bytes_spliced == 0
+
     url = "https://www.deutschlandfunk.de/forschung-aktuell-102.xml"
     lfeeds = [Feed("Test feed", url)]
 
@@ -687,3 +1706,4 @@ if __name__ == "__main__":
     if dirname:
         print("Clear cache dir")
         cache_reduce_disk_footprint(0)
+        close_store()
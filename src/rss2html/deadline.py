@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Wall-clock deadline for requests to feed servers.
+#
+# The timeouts of urllib3 are applied to each socket operation and do not
+# cover the name resolution. Thus, a slow server (or DNS server) can block
+# a thread much longer than expected.
+#
+# A Deadline is bound to the current thread. Name resolution and connect
+# respect the remaining time (see dns_cache.py) and the registered
+# connections are shut down if the deadline is exceeded during the
+# transfer. Connections put back into the pool are unregistered.
+# Thus, connections used by other threads are never shut down.
+#
+
+import socket
+from time import time
+from threading import local, Lock, Timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+_LOCAL = local()
+
+
+class Deadline:
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = None
+        self.expired = False
+        self._lock = Lock()
+        self._connections = []
+        self._timer = None
+        self._previous = None  # Deadline of outer with-statement
+
+    # Define __enter__ and __exit__ for with-statement
+    def __enter__(self):
+        self.expires = time() + self.seconds
+        self._timer = Timer(self.seconds, self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+        self._previous = getattr(_LOCAL, "deadline", None)
+        _LOCAL.deadline = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._timer.cancel()
+        _LOCAL.deadline = self._previous
+        with self._lock:
+            self._connections = []
+
+    def remaining(self):
+        return max(self.expires - time(), 0.0)
+
+    def register(self, conn):
+        # conn: urllib3 connection object or socket. The socket
+        # will be shut down at expiration.
+        # Note: http.client drops the socket reference of the
+        #       connection object for some responses. Thus, new
+        #       sockets should be registered, too.
+        with self._lock:
+            self._connections.append(conn)
+
+    def unregister(self, conn):
+        # Connection (and its socket) is not used by this thread
+        # anymore, e.g. it was put back into the pool.
+        sock = getattr(conn, "sock", None)
+        with self._lock:
+            self._connections = [c for c in self._connections
+                                 if c is not conn and c is not sock]
+
+    def _expire(self):
+        with self._lock:
+            self.expired = True
+            connections = list(self._connections)
+
+        logger.debug("Deadline of {}s exceeded. Abort transfer.".format(
+            self.seconds))
+        for conn in connections:
+            if isinstance(conn, socket.socket):
+                sock = conn
+            else:
+                sock = getattr(conn, "sock", None)
+            if sock is None:
+                continue
+            try:
+                # Wakes up blocking reads of the request thread
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def current():
+    # Deadline of current thread or None
+    return getattr(_LOCAL, "deadline", None)
+
+
+def remaining(timeout=None):
+    # Minimum of timeout and remaining time of current deadline.
+    # Returns timeout if no deadline is set.
+    d = current()
+    if d is None:
+        return timeout
+
+    left = d.remaining()
+    if timeout is None or not isinstance(timeout, (int, float)):
+        return left  # timeout could be socket._GLOBAL_DEFAULT_TIMEOUT
+
+    return min(timeout, left)
@@ -59,19 +59,122 @@ USERS = {
 
 # Minimal time between two requests to the xml file of a feed
 CACHE_EXPIRE_TIME_S = 600
+# Maximal time between two requests. The actual value for each
+# feed depends on the headers of the feed server, the <ttl> of the
+# feed and how often it changed in the past.
+CACHE_EXPIRE_TIME_MAX_S = 86400
+
+# Refresh feeds of favorites and history in background threads before
+# CACHE_EXPIRE_TIME_S is reached. Feed pages will be served from the
+# cache without waiting on the feed server. (Outdated values will be
+# displayed once and updated in background.)
+CACHE_BACKGROUND_REFRESH = True
+CACHE_REFRESH_WORKERS = 2
+# Refresh starts randomly up to this number of seconds before expiration.
+# This spreads the requests, e.g. after a restart.
+CACHE_REFRESH_JITTER_S = 60
 
 # Maximal memory footprint of cache (and a few more internal objects)
 CACHE_MEMORY_LIMIT = 5E7 # 50 MB
 CACHE_DISK_LIMIT = 10 * CACHE_MEMORY_LIMIT  # Only required if CACHE_DIR is set
+# Order of unloading if CACHE_MEMORY_LIMIT is exceeded:
+# "lru": Least recently read feeds first.
+# "gdsf": Weighs access frequency, size and the measured time to fetch
+#         and parse a feed again. Big, rarely read feeds go first.
+# Hit ratios of both policies are shown on the statistic page.
+CACHE_EVICTION_POLICY = "gdsf"
+# CACHE_MEMORY_LIMIT is compared with an estimation which does not
+# cover parsed feeds. If CACHE_RSS_HIGH_WATER is set, the real memory
+# usage (RSS) of the process is checked, too. Parsed feeds and cached
+# files will be unloaded until the RSS is below CACHE_RSS_LOW_WATER
+# (Default: 80% of CACHE_RSS_HIGH_WATER).
+CACHE_RSS_HIGH_WATER = None  # e.g. 3E8 for 300 MB
+CACHE_RSS_LOW_WATER = None
+CACHE_RSS_CHECK_INTERVAL_S = 10
+# Under memory pressure, parsed feeds which were not viewed for this
+# number of seconds are released first. 0 disables it.
+CACHE_RSS_RELEASE_IDLE_S = 300
 
 # Save/load cached feed xmls on server stop/start.
 CACHE_DIR = '$HOME/.cache'
 # CACHE_DIR = None  # Disabled if None
 
+# Only the metadata of the cached feeds is loaded at startup.
+# If enabled, the feed xmls will be loaded in background
+# afterwards, most read feeds first. Otherwise, they are loaded
+# on first access.
+CACHE_WARM_UP = True
+# Number of most read feeds which are parsed during the warm up.
+CACHE_WARM_UP_PARSE = 10
+# Store parsed feeds in the cache dir. After a restart, the first
+# view of a feed does not need to parse the xml file again.
+CACHE_PARSED_FEEDS = True
+
+# Interval of maintenance tasks, e.g. check of CACHE_DISK_LIMIT.
+CACHE_HOUSEKEEPING_INTERVAL_S = 60
+
+# New or changed cache files are written in background if the oldest
+# unsaved file waits longer than CACHE_FLUSH_INTERVAL_S or the unsaved
+# files exceed CACHE_FLUSH_BYTES. This limits the loss after a crash.
+CACHE_FLUSH_INTERVAL_S = 30
+CACHE_FLUSH_BYTES = 5E6
+
 # Compress cache files on disk
 CACHE_COMPRESSION = True
+# Codec for compressed cache files: "brotli", "zlib", "lzma", "zstd" or
+# "zstd-dict". The latter uses a dictionary trained on the cached feeds
+# which captures the markup shared by all feeds of a publisher.
+# "zstd" and "zstd-dict" require the 'zstandard' package. Fallback is
+# "brotli". Already compressed files keep their codec.
+# Use 'rss_server --benchmark-codecs' to compare the codecs for your
+# cached feeds.
+CACHE_COMPRESSION_CODEC = "brotli"
+# Interval for retraining the dictionary of "zstd-dict".
+CACHE_DICTIONARY_TRAIN_INTERVAL_S = 86400
+# Cached feeds which were not viewed for this number of seconds are
+# compressed in memory by the housekeeping thread. 0 disables it.
+CACHE_COMPRESS_IDLE_S = 300
 
 MAX_FEED_BYTE_SIZE = 1E7
+
+# Limits for requests to feed servers (per host)
+FETCH_MAX_CONNECTIONS_PER_HOST = 4
+# Maximal waiting time on a free connection slot. Used if no cached
+# copy of the feed is available. (Otherwise, the cached copy is returned.)
+FETCH_HOST_WAIT_TIMEOUT_S = 30
+# After this number of consecutive failures (timeouts, refused
+# connections, …) the host is handled as down. Requests are answered
+# with the cached copy without any request to the host.
+FETCH_HOST_FAILURE_THRESHOLD = 3
+# Duration of the first block of a host. It doubles with every
+# further failure. Also used for 429 replies without Retry-After.
+FETCH_HOST_BACKOFF_S = 60
+FETCH_HOST_BACKOFF_MAX_S = 3600
+# Maximal duration of a feed request, including name resolution,
+# connect and the transfer of the data.
+FETCH_DEADLINE_S = 90
+# Resolved host names are cached for this number of seconds.
+DNS_CACHE_TTL_S = 300
+# Request only new items of a feed (RFC 3229, 'A-IM: feed').
+# Servers without support of this header send the whole feed.
+FETCH_RFC3229 = True
+# Temporary redirects (302, 303, 307) of feed urls are followed
+# directly for this number of seconds. Permanent redirects (301, 308)
+# update the stored feed url.
+FETCH_REDIRECT_TTL_S = 3600
+# Failed requests (e.g. 404, timeouts) and feeds with invalid xml are
+# not requested again for NEGATIVE_CACHE_TIME_S seconds. The time
+# doubles on each further failure up to NEGATIVE_CACHE_TIME_MAX_S.
+NEGATIVE_CACHE_TIME_S = 60
+NEGATIVE_CACHE_TIME_MAX_S = 3600
+# WebSub (PubSubHubbub): Feeds announcing a hub will be subscribed and
+# are not polled anymore. The hubs push new content to
+#   {WEBSUB_CALLBACK_URL}/websub/{id}
+# Thus, this url has to be reachable by the hubs,
+# e.g. "https://rss.example.com:8888". None disables WebSub.
+WEBSUB_CALLBACK_URL = None
+# Requested lease time of subscriptions. Renewed automatically.
+WEBSUB_LEASE_S = 864000
 ALLOWED_FILE_EXTENSIONS = [".css", ".png", ".jpg", ".svg", ".js"]
 
 # If <desciption> and <content:encoded>-field both set, use second entry for
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Early termination of feed downloads.
+#
+# Most feeds put new items at the top. Thus, after the new items
+# the response is equal to the tail of the previous version and the
+# download can be stopped.
+#
+# • Anchors are placed at the start of each <item>/<entry> of the
+#   previous version. The WINDOW_SIZE bytes after an anchor are stored
+#   in a dict (hashed by Python). Anchors with equal windows are dropped.
+# • The new data is scanned once for the same pattern. Each anchor is
+#   looked up in the dict.
+# • A splice requires several consecutive anchors with a consistent
+#   offset, a byte-wise comparison of all already read data after the
+#   first anchor and a matching Content-Length. Without a (decoded)
+#   Content-Length the spliced tail can not be verified and the whole
+#   response is read, e.g. for compressed or chunked responses.
+#
+# The size of the (decompressed) body is checked on each chunk.
+# An optional hasher (hashlib object) is updated with each chunk, too.
+# Thus, the content hash is available without a second pass.
+#
+# merge_partial_feed() handles the other way to save bandwidth:
+# Servers supporting RFC 3229 with 'A-IM: feed' reply with a
+# document containing just the new items (226 IM Used). WebSub hubs
+# could push such documents, too.
+#
+
+import re
+from threading import Lock
+
+import logging
+logger = logging.getLogger(__name__)
+
+WINDOW_SIZE = 512
+MIN_ANCHORS = 2
+READ_CHUNK_SIZE = 2**16
+
+_RE_ANCHOR = re.compile(rb"<(?:item|entry)[\s>]")
+_RE_ITEM = re.compile(rb"<(item|entry)[\s>].*?</\1\s*>\s*", re.S)
+_RE_ITEM_ID = re.compile(
+    rb"<(guid|id)(?:\s[^>]*)?>\s*(.*?)\s*</\1\s*>", re.S)
+
+
+class SizeExceeded(Exception):
+    pass
+
+
+def _check_size(buf, max_size):
+    if max_size is not None and len(buf) > max_size:
+        raise SizeExceeded("Feed file exceedes maximal size. {0} > {1}"
+                           "".format(len(buf), max_size))
+
+
+def read_all(res, max_size=None, read_chunk_size=READ_CHUNK_SIZE,
+             hasher=None):
+    # Reads (decoded) body of response 'res' chunk by chunk.
+    buf = bytearray()
+    while True:
+        chunk = res.read(read_chunk_size)
+        if not chunk:
+            break
+
+        buf += chunk
+        _check_size(buf, max_size)
+        if hasher:
+            hasher.update(chunk)
+
+    return bytes(buf)
+
+
+class AnchorIndex:
+    # Positions of anchors in previous version of feed
+
+    def __init__(self, data):
+        self.data = data
+        self.anchors = {}  # window -> position
+        ambiguous = set()
+        for m in _RE_ANCHOR.finditer(data):
+            pos = m.start()
+            window = data[pos:pos+WINDOW_SIZE]
+            if len(window) < WINDOW_SIZE:
+                break
+
+            if window in self.anchors:
+                ambiguous.add(window)
+            self.anchors[window] = pos
+
+        for window in ambiguous:
+            del self.anchors[window]
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def lookup(self, window):
+        return self.anchors.get(window)
+
+
+def read_with_delta(res, prev_data, content_length=None, max_size=None,
+                    read_chunk_size=READ_CHUNK_SIZE, hasher=None):
+    # Reads body of response 'res'. If the tail of the body
+    # matches prev_data, the reading stops and the tail of
+    # prev_data will be used.
+    #
+    # content_length: Expected length of (decoded) body or None.
+    #                 Nothing will be spliced if it is None.
+    # max_size: Raises SizeExceeded if body gets bigger.
+    #
+    # Returns (body, number of bytes taken from prev_data)
+    if content_length is None:
+        return (read_all(res, max_size, read_chunk_size, hasher), 0)
+
+    index = AnchorIndex(prev_data)
+
+    buf = bytearray()
+    scan_pos = 0   # Next position in buf to search anchors
+    matches = []   # Consecutive anchors (pos in buf, pos in prev_data)
+    enabled = len(index) >= MIN_ANCHORS
+
+    while True:
+        chunk = res.read(read_chunk_size)
+        if not chunk:
+            break
+
+        buf += chunk
+        _check_size(buf, max_size)
+        if hasher:
+            hasher.update(chunk)
+        if not enabled:
+            continue
+
+        for m in _RE_ANCHOR.finditer(buf, scan_pos):
+            pos = m.start()
+            if pos + WINDOW_SIZE > len(buf):
+                break  # Wait on more data
+
+            scan_pos = pos + 1
+            prev_pos = index.lookup(bytes(buf[pos:pos+WINDOW_SIZE]))
+            if prev_pos is None:
+                matches = []  # New or changed item
+                continue
+
+            if matches and (matches[0][1] - matches[0][0]
+                            != prev_pos - pos):
+                matches = []  # Inconsistent shift, e.g. reordered items
+
+            matches.append((pos, prev_pos))
+            if len(matches) < MIN_ANCHORS:
+                continue
+
+            result = _splice(buf, prev_data, matches[0], content_length)
+            if result is None:
+                # Verification failed. Read rest of response.
+                enabled = False
+                break
+
+            _check_size(result[0], max_size)
+            if hasher:
+                hasher.update(prev_data[len(prev_data)-result[1]:])
+            return result
+        else:
+            scan_pos = max(scan_pos, len(buf) - WINDOW_SIZE)
+
+    return (bytes(buf), 0)
+
+
+def _splice(buf, prev_data, first_match, content_length):
+    (pos, prev_pos) = first_match
+    end = len(buf)
+    prev_end = prev_pos + (end - pos)
+    if prev_end > len(prev_data):
+        return None
+
+    # All already read data after the first anchor has to match.
+    if buf[pos:end] != prev_data[prev_pos:prev_end]:
+        logger.debug("Delta: Anchors matched, but data differs.")
+        return None
+
+    tail = prev_data[prev_end:]
+    if end + len(tail) != content_length:
+        logger.debug("Delta: Length mismatch {} != {}".format(
+            end + len(tail), content_length))
+        return None
+
+    logger.debug("Delta: Fill up response after {} bytes with cached "
+                 "data. Position in cache: {}.".format(end, prev_end))
+    return (bytes(buf) + tail, len(tail))
+
+
+def _item_id(item):
+    m = _RE_ITEM_ID.search(item)
+    return m.group(2) if m else item
+
+
+def item_ids(data):
+    # Set of guid/id of all items of a feed document.
+    return set((_item_id(m.group(0)) for m in _RE_ITEM.finditer(data)))
+
+
+def merge_partial_feed(prev_data, partial_data, max_items=None):
+    # Merges reply of 'A-IM: feed' request with previous version.
+    # The channel header is taken from the partial document,
+    # followed by its items and the items of the previous version.
+    # Items of the previous version with the same guid/id
+    # are removed.
+    #
+    # max_items: Oldest items of the previous version are dropped
+    #            if the merged document would contain more items.
+    #
+    # Returns None if the previous version has no items.
+    new_items = [m.group(0) for m in _RE_ITEM.finditer(partial_data)]
+    if not new_items:
+        return prev_data
+
+    m_first_new = _RE_ITEM.search(partial_data)
+    m_first_prev = _RE_ANCHOR.search(prev_data)
+    if m_first_prev is None:
+        return None
+
+    new_ids = set((_item_id(item) for item in new_items))
+
+    # Cut out replaced (and surplus) items of previous version
+    parts = [partial_data[:m_first_new.start()]] + new_items
+    n_items = len(new_items)
+    pos = m_first_prev.start()
+    for m in _RE_ITEM.finditer(prev_data, pos):
+        if (_item_id(m.group(0)) in new_ids
+                or (max_items is not None and n_items >= max_items)):
+            parts.append(prev_data[pos:m.start()])
+            pos = m.end()
+        else:
+            n_items += 1
+    parts.append(prev_data[pos:])
+
+    return b"".join(parts)
+
+
+class TransferStatistic:
+    # Transfered bytes (wire), decoded bytes and bytes
+    # taken from the previous version (spliced) per feed.
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counter_responses = 0
+        self._counter_spliced = 0
+        self._totals = {"wire": 0, "decoded": 0, "saved": 0}
+        self._feeds = {}  # url -> dict like _totals
+
+    def record(self, url, wire_bytes, decoded_bytes, bytes_saved=0):
+        with self._lock:
+            self._counter_responses += 1
+            if bytes_saved > 0:
+                self._counter_spliced += 1
+
+            feed = self._feeds.setdefault(
+                url, {"wire": 0, "decoded": 0, "saved": 0})
+            for d in (feed, self._totals):
+                d["wire"] += wire_bytes
+                d["decoded"] += decoded_bytes
+                d["saved"] += bytes_saved
+
+    def statistic(self, top=10):
+        # Returns totals and the feeds with the most decoded bytes.
+        with self._lock:
+            return {
+                "responses": self._counter_responses,
+                "spliced": self._counter_spliced,
+                "bytes": dict(self._totals),
+                "feeds": dict(sorted(
+                    ((url, dict(d)) for (url, d) in self._feeds.items()),
+                    key=lambda x: x[1]["decoded"], reverse=True)[:top]),
+            }
+
+
+class ConditionalStatistic:
+    # Replies on conditional requests (If-None-Match/If-Modified-Since)
+    # per origin. Origins answering with 200 and an identical body
+    # ignore the conditional headers.
+
+    def __init__(self):
+        self._lock = Lock()
+        self._origins = {}  # netloc -> counters
+
+    def record(self, origin, outcome):
+        # outcome: 'not_modified', 'unchanged' (200 with identical
+        #          body) or 'changed'
+        with self._lock:
+            counters = self._origins.setdefault(
+                origin, {"not_modified": 0, "unchanged": 0, "changed": 0})
+            counters[outcome] += 1
+
+    def statistic(self, top=10):
+        # Returns the origins with the most unchanged replies.
+        with self._lock:
+            origins = sorted(
+                ((origin, dict(d)) for (origin, d) in self._origins.items()
+                 if d["unchanged"]),
+                key=lambda x: x[1]["unchanged"], reverse=True)[:top]
+            totals = {"not_modified": 0, "unchanged": 0, "changed": 0}
+            for d in self._origins.values():
+                for k in totals:
+                    totals[k] += d[k]
+
+        for (_, d) in origins:
+            d["ignore_ratio"] = d["unchanged"] / (
+                d["unchanged"] + d["not_modified"])
+
+        return {
+            "totals": totals,
+            "ignoring_origins": dict(origins),
+        }
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Cache for name resolution of feed servers.
+#
+# • Results of getaddrinfo() are kept for DNS_CACHE_TTL_S seconds.
+#   Many feeds are hosted on a few CDNs. Their names will not be
+#   resolved for every request.
+# • The lookup runs in a separate thread. Thus, the caller can give
+#   up after the remaining time of its deadline (see deadline.py).
+#   Concurrent lookups of the same name are coalesced.
+#
+# Connection pools using the cache are installed by install().
+#
+
+import socket
+from time import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, \
+        TimeoutError as FutureTimeout
+
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3 import connection as urllib3_connection
+from urllib3.util import connection as urllib3_util_connection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import deadline
+from . import default_settings as settings  # Overriden in load_config()
+
+N_RESOLVER_THREADS = 4
+
+
+class DNSCache:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}  # (host, port) -> (expires, addresses)
+        self._pending = {}  # (host, port) -> Future
+        self._executor = ThreadPoolExecutor(
+            max_workers=N_RESOLVER_THREADS, thread_name_prefix="DNS")
+
+        # Statistic
+        self._counter_hits = 0
+        self._counter_misses = 0
+        self._counter_timeouts = 0
+
+    def resolve(self, host, port, timeout=None):
+        # Returns list of (family, type, proto, canonname, sockaddr)
+        # Raises socket.timeout if the lookup took longer than timeout.
+        key = (host, port)
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._counter_hits += 1
+                return entry[1]
+
+            self._counter_misses += 1
+            future = self._pending.get(key)
+            if future is None:
+                future = self._executor.submit(self._lookup, key)
+                self._pending[key] = future
+
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._counter_timeouts += 1
+            # The lookup continues in background and
+            # its result will be cached.
+            raise socket.timeout("Name resolution of '{}' took longer "
+                                 "than {:.1f}s".format(host, timeout))
+
+    def _lookup(self, key):
+        (host, port) = key
+        try:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+        with self._lock:
+            self._entries[key] = (time() + settings.DNS_CACHE_TTL_S, addresses)
+            # Drop outdated entries
+            if len(self._entries) > 1000:
+                now = time()
+                for (k, entry) in list(self._entries.items()):
+                    if entry[0] < now:
+                        del self._entries[k]
+
+        return addresses
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def statistic(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._counter_hits,
+                "misses": self._counter_misses,
+                "timeouts": self._counter_timeouts,
+            }
+
+
+_DNS = DNSCache()
+
+
+def statistic():
+    return _DNS.statistic()
+
+
+class _CachedDNSConnectionMixin:
+    # Replaces urllib3.connection.HTTPConnection._new_conn()
+
+    def _new_conn(self):
+        extra_kw = {}
+        if self.source_address:
+            extra_kw["source_address"] = self.source_address
+
+        if self.socket_options:
+            extra_kw["socket_options"] = self.socket_options
+
+        host = getattr(self, "_dns_host", self.host)
+        timeout = deadline.remaining(self.timeout)
+        if not isinstance(timeout, (int, float)):
+            timeout = None  # socket._GLOBAL_DEFAULT_TIMEOUT
+        try:
+            addresses = _DNS.resolve(host, self.port, timeout)
+
+            err = None
+            for (_, _, _, _, sockaddr) in addresses:
+                try:
+                    sock = urllib3_util_connection.create_connection(
+                        sockaddr[:2], deadline.remaining(self.timeout),
+                        **extra_kw)
+                    d = deadline.current()
+                    if d is not None:
+                        d.register(sock)
+                    return sock
+                except socket.timeout:
+                    raise
+                except OSError as e:
+                    err = e
+
+            raise err or OSError("getaddrinfo returns an empty list")
+
+        except socket.timeout:
+            raise ConnectTimeoutError(
+                self,
+                "Connection to %s timed out. (connect timeout=%s)"
+                % (self.host, timeout),
+            )
+
+        except OSError as e:
+            raise NewConnectionError(
+                self, "Failed to establish a new connection: %s" % e
+            )
+
+
+class HTTPConnection(_CachedDNSConnectionMixin,
+                     urllib3_connection.HTTPConnection):
+    pass
+
+
+class HTTPSConnection(_CachedDNSConnectionMixin,
+                      urllib3_connection.HTTPSConnection):
+    pass
+
+
+class _DeadlinePoolMixin:
+    # Connections used by a thread with deadline will be
+    # shut down if the deadline is exceeded. Released connections
+    # could be used by other threads and are unregistered.
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        d = deadline.current()
+        if d is not None:
+            d.register(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        d = deadline.current()
+        if d is not None and conn is not None:
+            d.unregister(conn)
+        super()._put_conn(conn)
+
+
+class CachedDNSHTTPConnectionPool(_DeadlinePoolMixin, HTTPConnectionPool):
+    ConnectionCls = HTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(_DeadlinePoolMixin, HTTPSConnectionPool):
+    ConnectionCls = HTTPSConnection
+
+
+def install(pool_manager):
+    # Let pool_manager use the DNS cache and deadlines.
+    pool_manager.pool_classes_by_scheme = {
+        "http": CachedDNSHTTPConnectionPool,
+        "https": CachedDNSHTTPSConnectionPool,
+    }
+    return pool_manager
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    print(_DNS.resolve("localhost", 80, 1.0))
+    print(_DNS.resolve("localhost", 80, 1.0))
+    print(statistic())
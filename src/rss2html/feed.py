@@ -14,12 +14,12 @@ logger = logging.getLogger(__name__)
 from .validators import substitute_variable_value
 
 class Feed:
-    def __init__(self, name, url, title=None, uid=None):
+    def __init__(self, name, url, title=None, uid=None, public_id=None):
         self.name = name         # For url pattern /?feed=name
         self.url = unquote(url)  # Normalize into unquoted form
         self.title = title       # Title given by RSS or None
         self._uid = uid          # Unique id generated from above data
-        self._public_id = None   # Public unique id generated from uid
+        self._public_id = public_id  # Public unique id generated from uid
         self.items = []
         self.context = {}
 
@@ -27,14 +27,32 @@ class Feed:
         def escape_str(s):
             return s.replace('\\','\\\\').replace('"', '\\"')
 
-        return 'Feed("{name}", "{url}"{title}{uid})'.format(
+        # The public id is just stored if it was not generated
+        # from the uid, see update_url().
+        bOwnPublicId = (self._uid and self._public_id
+                        and self._public_id != gen_hash(self._uid))
+
+        return 'Feed("{name}", "{url}"{title}{uid}{public_id})'.format(
             name=escape_str(self.name),
             url=escape_str(self.url),
             title=', title="{}"'.format(escape_str(self.title)) if self.title else "",
             uid=', uid="{}"'.format(self._uid) if self._uid else "",
+            public_id=', public_id="{}"'.format(self._public_id) \
+                    if bOwnPublicId else "",
         )
 
 
+    def update_url(self, url):
+        # Feed has moved permanently. The uid (and thus the
+        # cache name) is regenerated from the new url.
+        # The public id is kept. Otherwise, links and bookmarks
+        # with ?feed=<public id> would not find the feed anymore.
+        public_id = self.public_id()
+        self.url = unquote(url)
+        self._uid = None
+        self.gen_uid()
+        self._public_id = public_id
+
     def cache_name(self):
         # Return assoziated cache filename
         return self.get_uid()
@@ -54,6 +72,8 @@ class Feed:
     def gen_uid(self):
         # Generate id for this feed. Should only be called once for
         # each feed. (The url of a feed can change in the future.)
+        # Exception: update_url() for moved feeds. The public id
+        # stays the same in this case.
         #
         # Prefer url as basis and use name, title as fallback
         candidates = [self.url, self.name, self.title]
@@ -4,12 +4,22 @@
 # Parse feed xml files into feed.context dict.
 # The context can be propagated into the html renderer.
 #
+# Parsed contexts can be serialized (see serialize_context()) and
+# restored without parsing the xml file again.
+#
+# update_feed() parses a new version of a feed in merge mode: Entries
+# whose guid is already known are taken from the current context with
+# their prepared content and actions. Just new entries are built.
+#
 
 import sys
 import os.path
 import re
+import json
 import hashlib
 from datetime import datetime
+from time import perf_counter
+from threading import Lock
 import locale
 try:
     from defusedxml import ElementTree
@@ -25,6 +35,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from .feed import Feed, bytes_str
+from .single_flight import SingleFlight
 from . import default_settings as settings  # Overriden in load_config()
 
 from .wordbreaker import WordBreaker
@@ -40,8 +51,21 @@ XML_NAMESPACES = {'content': 'http://purl.org/rss/1.0/modules/content/',
 ORIG_LOCALE = locale.getlocale()  # running user might be non-english
 EN_LOCALE = ("en_US", "utf-8")
 
-def parse_feed(feed, text):
+# Concurrent parsing of the same feed waiting on the first one.
+_PARSE_FLIGHTS = SingleFlight("parse_feed")
+
+# Increase if the structure of feed.context changes.
+CONTEXT_FORMAT_VERSION = 1
+
+# Statistic of update_feed()
+_MERGE_LOCK = Lock()
+_MERGE_COUNTERS = {"updates": 0, "entries_reused": 0, "entries_built": 0}
+
+def parse_feed(feed, text, known_entries=None):
+    # known_entries: Dict guid -> entry of previous context. Those
+    #                entries are reused (see update_feed()).
     logger.debug("Parsing XML file of {}".format(feed))
+    start = perf_counter()
 
     try:
         if isinstance(text, bytes):
@@ -52,16 +76,167 @@ def parse_feed(feed, text):
         logger.error("ParseError: '{}'".format(e))
         return False
 
-    find_feed_keyword_values(feed, tree)
+    find_feed_keyword_values(feed, tree, known_entries)
 
     feed.title = feed.context["title"]
     if feed.name == "":  # New feed got title as name
         feed.name = feed.context["title"]
 
+    # Cost of parsing, see cached_requests.register_feed_context()
+    feed.context["parse_time"] = perf_counter() - start
     return True
 
 
-def find_feed_keyword_values(feed, tree):
+def parse_feed_coalesced(feed, get_text):
+    # Like parse_feed(), but concurrent calls for the same feed
+    # wait on the first call and re-use its result.
+    #
+    # get_text: Callable returning the xml data. It will
+    #           only be invoked by the first call.
+    key = (feed.url, feed.name)
+
+    def _parse():
+        ok = parse_feed(feed, get_text())
+        return (ok, feed.context)
+
+    (ok, context) = _PARSE_FLIGHTS.do(key, _parse)
+    if ok and context is not feed.context:
+        # Other feed object with same url and name had been parsed.
+        feed.context = context.copy()
+        feed.context["feed2"] = feed
+        feed.title = context["title"]
+
+    return ok
+
+
+def merge_feed(feed, text):
+    # Adds entries of a partial feed document (reply of
+    # 'A-IM: feed' request) in front of the already parsed entries.
+    # Entries with the same guid are replaced.
+    partial = Feed(feed.name, feed.url)
+    if not parse_feed(partial, text):
+        return False
+
+    context = partial.context
+    new_guids = set((e["guid"] for e in context["entries"]))
+    entries = context["entries"] + [
+        e for e in feed.context.get("entries", [])
+        if e["guid"] not in new_guids]
+    if settings.CONTENT_MAX_ENTRIES > -1:
+        entries = entries[:settings.CONTENT_MAX_ENTRIES]
+
+    # Pages are shifted. Prepared entries are marked, see prepare_page().
+    context["entries"] = entries
+    context["prepared_pages"] = find_prepared_pages(entries)
+    context["feed2"] = feed
+    feed.context = context
+    feed.title = context["title"]
+    return True
+
+
+def update_feed(feed, text):
+    # Like parse_feed(), but entries of the current feed.context
+    # with known guid are reused. Pages which just contain reused
+    # entries need no preparation again.
+    #
+    # The context is replaced at once. Thus, concurrent readers
+    # see the old or the new state.
+    known = {e["guid"]: e for e in feed.context.get("entries", [])}
+    if not known:
+        return parse_feed(feed, text)
+
+    new = Feed(feed.name, feed.url)
+    if not parse_feed(new, text, known):
+        return False
+
+    context = new.context
+    entries = context["entries"]
+    context["prepared_pages"] = find_prepared_pages(entries)
+    context["feed2"] = feed
+    feed.context = context
+    feed.title = context["title"]
+
+    n_reused = sum((1 for e in entries if known.get(e["guid"]) is e))
+    with _MERGE_LOCK:
+        _MERGE_COUNTERS["updates"] += 1
+        _MERGE_COUNTERS["entries_reused"] += n_reused
+        _MERGE_COUNTERS["entries_built"] += len(entries) - n_reused
+
+    logger.debug("Updated feed {}. Reused {} of {} entries".format(
+        feed.name, n_reused, len(entries)))
+    return True
+
+
+def find_prepared_pages(entries):
+    # Pages whose entries are all prepared (see prepare_page()).
+    n_per_page = settings.ENTRIES_PER_PAGE
+    if not settings.ADAPT_FEED_CONTENT or n_per_page <= 0:
+        return []
+
+    return [i // n_per_page + 1 for i in range(0, len(entries), n_per_page)
+            if all((e.get("prepared") for e in entries[i:i + n_per_page]))]
+
+
+def context_fingerprint():
+    # Settings which affect the serialized context. Stored
+    # contexts with other fingerprint are outdated.
+    values = (CONTEXT_FORMAT_VERSION,
+              settings.ENTRIES_PER_PAGE,
+              settings.DETAIL_PAGE,
+              settings.ADAPT_FEED_CONTENT,
+              settings.CONTENT_MAX_ENTRIES,
+              settings.CONTENT_FULL_LEN_THRESH)
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()[:16]
+
+
+def serialize_context(context):
+    # Compact JSON of parsed (and prepared) context.
+    # Actions are omitted. They depend on the feed name, ACTIONS and
+    # ACTION_SECRET (random at each start) and are added again by
+    # restore_context().
+    def _entry(entry):
+        entry = {k: v for (k, v) in entry.items() if k != "actions"}
+        entry["enclosures"] = [
+            {k: v for (k, v) in e.items() if k != "actions"}
+            for e in entry["enclosures"]]
+        return entry
+
+    data = {k: v for (k, v) in context.items() if k != "feed2"}
+    data["entries"] = [_entry(entry) for entry in context["entries"]]
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def restore_context(feed, byte_str):
+    # Counterpart of serialize_context()
+    try:
+        context = json.loads(byte_str.decode("utf-8"))
+    except ValueError as e:
+        logger.error("Restore of parsed feed failed. Error was: {}".format(e))
+        return False
+
+    context["feed2"] = feed
+    feed.context = context
+    for entry in context["entries"]:
+        for e in entry["enclosures"]:
+            add_enclosure_actions(feed, e)
+        if len(entry["enclosures"]) == 0:
+            add_title_actions(feed, entry)
+
+    feed.title = context["title"]
+    if feed.name == "":  # New feed got title as name
+        feed.name = context["title"]
+
+    return True
+
+
+def statistic():
+    return {
+        "parsing": _PARSE_FLIGHTS.statistic(),
+        "merge_mode": dict(_MERGE_COUNTERS),
+    }
+
+
+def find_feed_keyword_values(feed, tree, known_entries=None):
 
     feed.context = feed.context if feed.context else {}
     context = feed.context
@@ -94,6 +269,19 @@ def find_feed_keyword_values(feed, tree):
     for atom_node in tree.findall('./channel/atom:link', XML_NAMESPACES):
         if search_href(): break
 
+    # WebSub: Hub and topic url announced by the feed (see websub.py)
+    hub, topic = None, None
+    for atom_node in (tree.findall('./channel/atom10:link', XML_NAMESPACES)
+                      + tree.findall('./channel/atom:link', XML_NAMESPACES)):
+        rel = atom_node.attrib.get("rel")
+        if rel == "hub" and hub is None:
+            hub = atom_node.attrib.get("href")
+        elif rel == "self" and topic is None:
+            topic = atom_node.attrib.get("href")
+
+    context["websub_hub"] = hub
+    context["websub_topic"] = topic
+
     # ATTENTION: 'if node:' evaluates to False even if node is a 'node instance'!
     # Check with 'if node is not None:'
     node = tree.find('./channel/title')
@@ -137,6 +325,18 @@ def find_feed_keyword_values(feed, tree):
         entry["guid"] = (str(entry["url"].__hash__()) if node is None \
                          else node.text)
 
+        # Merge mode: Reuse entry with prepared content and actions.
+        if known_entries and entry["guid"] in known_entries:
+            if ((entry_id-1) % settings.ENTRIES_PER_PAGE) == 0:
+                entries_len = 0
+            entry = known_entries[entry["guid"]]
+            entries.append(entry)
+            entries_len += len(entry["content_full"])
+            if (settings.CONTENT_MAX_ENTRIES > -1 and
+                settings.CONTENT_MAX_ENTRIES <= len(entries)):
+                break;
+            continue
+
         node = item_node.find('./description')
         content_short = "" if node is None else node.text
 
@@ -464,8 +664,11 @@ def prepare_page(feed, page):
     n_per_page = settings.ENTRIES_PER_PAGE
     i_first = ((page-1) * n_per_page if n_per_page > 0 else 0)
     for entry in feed.context["entries"][i_first:i_first + n_per_page]:
+        if entry.get("prepared"):
+            continue  # Entry was on other page before merge_feed()
         entry["content_short"] = search_long_lines(entry["content_short"])
         entry["content_full"] = search_long_lines(entry["content_full"])
+        entry["prepared"] = True
     
     prepared_pages.append(page)
 
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Background refresh of cached feed xml files.
+#
+# • All feeds of FAVORITES, USER_FAVORITES, HISTORY and USER_HISTORY
+#   (see settings.all_feeds()) will be fetched shortly before their
+#   cache entry expires. Thus, the request handler can reply with the
+#   cached value immediately (stale-while-revalidate).
+# • Feeds pushed by a WebSub hub are not fetched while the
+#   subscription is active (see websub.py).
+# • A random jitter spreads the requests. Without it, all feeds would be
+#   fetched at once after a restart.
+# • Feeds requested by a user can jump the queue (priority lane).
+#
+
+import os.path
+from time import time
+from random import uniform
+from heapq import heappush, heappop
+from itertools import count
+from collections import deque
+from threading import Thread, Condition
+from enum import Enum
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import cached_requests
+from . import freshness
+from . import websub
+from . import default_settings as settings  # Overriden in load_config()
+
+SchedulerState = Enum('SchedulerState', ['INIT', 'STARTED', 'STOPED'])
+
+N_WORKERS = 2             # Number of threads fetching the feeds
+JITTER_S = 60.0           # Refresh starts up to JITTER_S before expiration
+RESCAN_INTERVAL_S = 60.0  # Interval to look after new/removed feeds
+
+_RESCAN = object()  # Returned by _next_url() if a rescan is due
+
+
+class FeedScheduler:
+
+    def __init__(self, settings=None, *,
+                 workers=None,
+                 jitter=None,
+                 local_dir=None,
+                ):
+        self.workers = workers or N_WORKERS
+        self.jitter = JITTER_S if jitter is None else jitter
+
+        # Required by cached_requests.fetch_file() to read
+        # feeds of this server directly.
+        self.local_dir = local_dir or os.path.join(
+            os.path.dirname(__file__), "rss_server-page")
+
+        self._cond = Condition()
+        self._queue = []        # Heap of (due_time, seq, url)
+        self._seq = count()     # Tie breaker for heap entries
+        self._due = {}          # url -> due time of valid heap entry
+        self._urgent = deque()  # Priority lane
+        self._running = set()   # Urls currently fetched
+        self._feeds = {}        # url -> [Feed, …]
+        self._next_rescan = 0.0
+        self._threads = []
+
+        # Statistic
+        self._counter_refreshed = 0
+        self._counter_not_modified = 0
+        self._counter_failed = 0
+        self._counter_urgent = 0
+
+        self._state = SchedulerState.INIT
+
+    # Define __enter__ and __exit__ for with-statement
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        if self._state not in [SchedulerState.INIT, SchedulerState.STOPED]:
+            logger.error("Scheduler can not be started twice.")
+            return
+
+        self._state = SchedulerState.STARTED
+        self._next_rescan = 0.0
+        self._threads = []
+        for i in range(self.workers):
+            t = Thread(target=self._worker,
+                       name="FeedScheduler-{}".format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+        logger.info("FeedScheduler started")
+
+    def stop(self, timeout=5.0):
+        if self._state not in [SchedulerState.STARTED]:
+            logger.error("Scheduler is not started.")
+            return
+
+        with self._cond:
+            self._state = SchedulerState.STOPED
+            self._cond.notify_all()
+
+        # Running fetches will not be aborted. Just wait a moment.
+        for t in self._threads:
+            t.join(timeout=timeout)
+
+        logger.info("FeedScheduler stoped")
+
+    def is_running(self):
+        return self._state == SchedulerState.STARTED
+
+    def request_refresh(self, url):
+        # Priority lane for feeds requested by users.
+        with self._cond:
+            if url in self._running or url in self._urgent:
+                return
+
+            self._counter_urgent += 1
+            self._urgent.append(url)
+            self._cond.notify()
+
+    def statistic(self):
+        with self._cond:
+            return {
+                "feeds": len(self._feeds),
+                "queued": len(self._due),
+                "urgent": len(self._urgent),
+                "running": len(self._running),
+                "refreshed": self._counter_refreshed,
+                "not_modified": self._counter_not_modified,
+                "failed": self._counter_failed,
+                "requested_by_users": self._counter_urgent,
+            }
+
+    def _due_time(self, url, now, failed=False):
+        # Next time where url should be fetched.
+        jitter = uniform(0.0, self.jitter)
+        cEl = cached_requests.peek_file(url, load_body=False)
+        if cEl is None:
+            if failed:
+                # Do not hassle server directly again.
+                return now + settings.CACHE_EXPIRE_TIME_S + jitter
+            return now + jitter
+
+        due = cEl.timestamp + freshness.lifetime(cEl, now) - jitter
+        # Spread feeds which are already expired, e.g. after a restart.
+        # Omit requests which would be rejected due host limits.
+        # Pushed feeds are checked again after the end of the lease.
+        return max(due, now + jitter,
+                   cached_requests.host_blocked_until(url) + jitter,
+                   websub.pushed_until(url) + jitter)
+
+    def _schedule(self, url, due):
+        # Note: Outdated entries of url in the heap will be
+        #       skipped by _next_url().
+        self._due[url] = due
+        heappush(self._queue, (due, next(self._seq), url))
+        self._cond.notify()
+
+    def _rescan(self, now):
+        # Called without lock. The lookups in the cache could read
+        # the cache store and would block request_refresh().
+        feeds = {}
+        for feed in settings.all_feeds(settings):
+            if feed.url:
+                feeds.setdefault(feed.url, []).append(feed)
+
+        with self._cond:
+            new_urls = [url for url in feeds
+                        if url not in self._due and url not in self._running]
+
+        due_times = [(url, self._due_time(url, now)) for url in new_urls]
+
+        with self._cond:
+            for (url, due) in due_times:
+                if url not in self._due and url not in self._running:
+                    self._schedule(url, due)
+
+            # Forget removed feeds
+            for url in list(self._due.keys()):
+                if url not in feeds:
+                    del self._due[url]
+
+            self._feeds = feeds
+
+    def _next_url(self):
+        # Blocks until an url is due. Returns None if the
+        # scheduler was stopped and _RESCAN if the caller
+        # should look after new/removed feeds.
+        with self._cond:
+            while self._state == SchedulerState.STARTED:
+                now = time()
+                if now >= self._next_rescan:
+                    self._next_rescan = now + RESCAN_INTERVAL_S
+                    return _RESCAN
+
+                if self._urgent:
+                    url = self._urgent.popleft()
+                    self._due.pop(url, None)  # Invalidates heap entry
+                    self._running.add(url)
+                    return url
+
+                while self._queue:
+                    (due, _, url) = self._queue[0]
+                    if self._due.get(url) != due:
+                        heappop(self._queue)  # Outdated entry
+                        continue
+
+                    if due > now:
+                        break
+
+                    heappop(self._queue)
+                    del self._due[url]
+                    if url in self._running:
+                        continue  # Already fetched by other worker
+
+                    self._running.add(url)
+                    return url
+
+                wait_until = self._next_rescan
+                if self._queue:
+                    wait_until = min(wait_until, self._queue[0][0])
+
+                self._cond.wait(timeout=max(wait_until - now, 0.1))
+
+        return None
+
+    def _worker(self):
+        while True:
+            url = self._next_url()
+            if url is None:
+                return
+
+            if url is _RESCAN:
+                self._rescan(time())
+                continue
+
+            failed = True
+            try:
+                failed = not self._refresh(url)
+            except Exception as e:
+                logger.error("Refresh of '{}' failed. Error was: {}".format(
+                    url, e))
+                with self._cond:
+                    self._counter_failed += 1
+            finally:
+                # Lookup of due time without lock, see _rescan().
+                due = None
+                if url in self._feeds and self.is_running():
+                    due = self._due_time(url, time(), failed)
+
+                with self._cond:
+                    self._running.discard(url)
+                    if (due is not None and url in self._feeds
+                            and url not in self._due and self.is_running()):
+                        self._schedule(url, due)
+
+    def _refresh(self, url):
+        if websub.pushed_until(url) > time():
+            # Lease was renewed in the meantime.
+            logger.debug("Skip refresh of pushed feed '{}'".format(url))
+            return True
+
+        logger.debug("Refresh '{}'".format(url))
+
+        # max_age=0 forces request, but headers for 304 replies
+        # are still send.
+        # Note: New data is merged into the parsed content of feeds
+        # by cached_requests.update_cache(). Feeds where this fails
+        # are reset.
+        (cEl, code) = cached_requests.fetch_file(
+            url, True, self.local_dir, max_age=0)
+
+        with self._cond:
+            if code == 200:
+                self._counter_refreshed += 1
+            elif code == 304:
+                self._counter_not_modified += 1
+            else:
+                self._counter_failed += 1
+
+        return code in [200, 304]
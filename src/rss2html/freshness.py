@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Per-feed freshness lifetime of cached feed xml files.
+#
+# Sources:
+# • Cache-Control: max-age and Expires headers of the feed server.
+# • <ttl> and sy:updatePeriod/sy:updateFrequency elements of the feed.
+# • Observed history of changes (200) and no changes (304).
+#
+# The lifetime is clamped to [CACHE_EXPIRE_TIME_S, CACHE_EXPIRE_TIME_MAX_S].
+# Thus, a feed server is never requested more often than before.
+#
+
+import re
+from time import time
+from email.utils import parsedate_to_datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import default_settings as settings  # Overriden in load_config()
+
+# Only the channel header is searched for <ttl>, etc.
+HEADER_SEARCH_LEN = 2**14
+
+# Weight of new observation for the average change interval
+CHANGE_INTERVAL_ALPHA = 0.3
+
+_SY_PERIODS = {
+    "hourly": 3600,
+    "daily": 86400,
+    "weekly": 7 * 86400,
+    "monthly": 30 * 86400,
+    "yearly": 365 * 86400,
+}
+
+_RE_MAX_AGE = re.compile(r"(?:^|[,\s])max-age\s*=\s*\"?(\d+)", re.I)
+_RE_NO_CACHE = re.compile(r"(?:^|[,\s])(?:no-cache|no-store)", re.I)
+_RE_TTL = re.compile(rb"<ttl>\s*(\d+)\s*</ttl>", re.I)
+_RE_SY_PERIOD = re.compile(rb"<(?:\w+:)?updatePeriod>\s*(\w+)\s*<", re.I)
+_RE_SY_FREQUENCY = re.compile(rb"<(?:\w+:)?updateFrequency>\s*(\d+)\s*<",
+                              re.I)
+_RE_FIRST_ITEM = re.compile(rb"<(?:item|entry)[\s>]", re.I)
+
+
+def header_lifetime(headers, now=None):
+    # Lifetime in seconds announced by the HTTP headers or None.
+    if not headers:
+        return None
+
+    # Header names in cache elements are not normalized.
+    headers = {k.lower(): v for (k, v) in headers.items()}
+
+    cache_control = headers.get("cache-control", "")
+    if _RE_NO_CACHE.search(cache_control):
+        return 0
+
+    m = _RE_MAX_AGE.search(cache_control)
+    if m:
+        return int(m.group(1))
+
+    if "expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["expires"]).timestamp()
+            if "date" in headers:
+                date = parsedate_to_datetime(headers["date"]).timestamp()
+            else:
+                date = now or time()
+        except (TypeError, ValueError, IndexError):
+            return 0  # Invalid dates are handled as 'already expired'
+
+        return max(int(expires - date), 0)
+
+    return None
+
+
+def feed_lifetime(byte_str):
+    # Lifetime in seconds announced in the channel header of
+    # the feed or None.
+    if not byte_str:
+        return None
+
+    head = byte_str[:HEADER_SEARCH_LEN]
+    m = _RE_FIRST_ITEM.search(head)
+    if m:
+        head = head[:m.start()]
+
+    lifetimes = []
+    m = _RE_TTL.search(head)
+    if m:
+        lifetimes.append(60 * int(m.group(1)))  # Minutes
+
+    m = _RE_SY_PERIOD.search(head)
+    if m:
+        period = _SY_PERIODS.get(m.group(1).decode('ascii').lower())
+        m2 = _RE_SY_FREQUENCY.search(head)
+        frequency = max(int(m2.group(1)), 1) if m2 else 1
+        if period:
+            lifetimes.append(period // frequency)
+
+    return max(lifetimes) if lifetimes else None
+
+
+def update(cEl, prev=None, status=200, now=None):
+    # Updates freshness information of cEl after a request.
+    #
+    # status: 200 if new data arrived, 304 if unchanged.
+    # prev: Previous cache element if cEl is a new one.
+    if now is None:
+        now = int(time())
+
+    info = dict(prev.freshness) if prev is not None else {}
+    info.update(cEl.freshness)
+
+    if status == 200:
+        info["n_changed"] = info.get("n_changed", 0) + 1
+        info["feed_lifetime"] = feed_lifetime(cEl.byte_str
+                                              if not cEl.bCompressed
+                                              else None)
+        last_change = info.get("last_change")
+        if last_change is not None and now > last_change:
+            interval = now - last_change
+            avg = info.get("change_interval")
+            info["change_interval"] = interval if avg is None else int(
+                (1 - CHANGE_INTERVAL_ALPHA) * avg
+                + CHANGE_INTERVAL_ALPHA * interval)
+        info["last_change"] = now
+
+    elif status == 304:
+        info["n_unchanged"] = info.get("n_unchanged", 0) + 1
+        info.setdefault("last_change", cEl.timestamp)
+
+    info["header_lifetime"] = header_lifetime(cEl.headers, now)
+    cEl.freshness = info
+
+
+def history_lifetime(info, now=None):
+    # Estimation based on observed changes or None.
+    last_change = info.get("last_change")
+    avg = info.get("change_interval")
+    if last_change is None or avg is None:
+        return None
+
+    if now is None:
+        now = int(time())
+
+    # If the feed has not changed for a longer time than usual,
+    # take this period into account.
+    interval = max(avg, now - last_change)
+    # Poll twice per interval to notice changes in time.
+    return interval // 2
+
+
+def lifetime(cEl, now=None):
+    # Freshness lifetime of cEl in seconds
+    info = cEl.freshness
+    hints = [l for l in (info.get("header_lifetime"),
+                         info.get("feed_lifetime"))
+             if l is not None]
+    estimated = history_lifetime(info, now)
+
+    if hints:
+        # The feed server knows it best. But if it announces a lifetime
+        # which is far too short, our observations help.
+        seconds = max(hints)
+        if estimated is not None:
+            seconds = max(seconds, estimated)
+    elif estimated is not None:
+        seconds = estimated
+    else:
+        seconds = settings.CACHE_EXPIRE_TIME_S
+
+    return int(min(max(seconds, settings.CACHE_EXPIRE_TIME_S),
+                   settings.CACHE_EXPIRE_TIME_MAX_S))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    print(header_lifetime({"Cache-Control": "public, max-age=3600"}))
+    print(header_lifetime({"Expires": "Thu, 01 Dec 2094 16:00:00 GMT",
+                           "Date": "Thu, 01 Dec 2094 15:00:00 GMT"}))
+    print(feed_lifetime(b"<rss><channel><ttl>30</ttl><item></item>"))
+    print(feed_lifetime(b"<rss><channel><sy:updatePeriod>daily"
+                        b"</sy:updatePeriod><sy:updateFrequency>4"
+                        b"</sy:updateFrequency><item></item>"))
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Per-host limits for requests to feed servers.
+#
+# • At most FETCH_MAX_CONNECTIONS_PER_HOST concurrent requests per host.
+# • Replies with 429 (or 503) and Retry-After block the host
+#   for the given time.
+# • After FETCH_HOST_FAILURE_THRESHOLD consecutive failures (timeouts,
+#   connection errors) the host is marked as down (circuit breaker).
+#   The blocking time doubles with every further failure.
+#
+# Requests to blocked hosts fail immediately with HostUnavailable.
+# Thus, the caller can reply with the cached copy directly.
+#
+
+from time import time
+from threading import Lock, BoundedSemaphore
+from email.utils import parsedate_to_datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import default_settings as settings  # Overriden in load_config()
+
+
+class HostUnavailable(Exception):
+    pass
+
+
+class _Host:
+    def __init__(self, name):
+        self.name = name
+        self.slots = BoundedSemaphore(settings.FETCH_MAX_CONNECTIONS_PER_HOST)
+        self.active = 0
+        self.consecutive_failures = 0
+        self.blocked_until = 0.0
+        self.block_reason = ""
+
+        # Statistic
+        self.counter_requests = 0
+        self.counter_failures = 0
+        self.counter_throttled = 0
+        self.counter_rejected = 0
+
+
+class _Slot:
+    # Context manager returned by HostLimiter.acquire()
+    def __init__(self, limiter, host):
+        self.limiter = limiter
+        self.host = host
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.limiter._release(self.host)
+
+
+class HostLimiter:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._hosts = {}  # name -> _Host
+
+    def _get(self, name):
+        # Lock is already hold by caller
+        host = self._hosts.get(name)
+        if host is None:
+            host = _Host(name)
+            self._hosts[name] = host
+        return host
+
+    def acquire(self, name, timeout=None):
+        # Returns context manager for a request to host 'name'.
+        # Raises HostUnavailable if the host is blocked or all
+        # slots are still used after timeout seconds.
+        with self._lock:
+            host = self._get(name)
+            now = time()
+            if host.blocked_until > now:
+                host.counter_rejected += 1
+                raise HostUnavailable("Host '{}' blocked for {:.0f}s ({})"
+                                      "".format(name, host.blocked_until - now,
+                                                host.block_reason))
+
+        if not host.slots.acquire(timeout=timeout):
+            with self._lock:
+                host.counter_rejected += 1
+            raise HostUnavailable("Host '{}' has no free connection slot"
+                                  "".format(name))
+
+        with self._lock:
+            host.active += 1
+            host.counter_requests += 1
+
+        return _Slot(self, host)
+
+    def _release(self, host):
+        with self._lock:
+            host.active -= 1
+        host.slots.release()
+
+    def blocked_until(self, name):
+        # Timestamp until requests to this host are rejected.
+        with self._lock:
+            host = self._hosts.get(name)
+            return host.blocked_until if host else 0.0
+
+    def report_success(self, name):
+        with self._lock:
+            host = self._get(name)
+            if host.consecutive_failures >= settings.FETCH_HOST_FAILURE_THRESHOLD:
+                logger.info("Host '{}' is reachable again.".format(name))
+            host.consecutive_failures = 0
+
+    def report_failure(self, name):
+        with self._lock:
+            host = self._get(name)
+            host.counter_failures += 1
+            host.consecutive_failures += 1
+            n = (host.consecutive_failures
+                 - settings.FETCH_HOST_FAILURE_THRESHOLD)
+            if n < 0:
+                return
+
+            # Exponential backoff
+            backoff = min(settings.FETCH_HOST_BACKOFF_S * 2**n,
+                          settings.FETCH_HOST_BACKOFF_MAX_S)
+            host.blocked_until = time() + backoff
+            host.block_reason = "{} failures".format(
+                host.consecutive_failures)
+
+        logger.info("Host '{}' marked as down for {}s.".format(
+            name, backoff))
+
+    def report_throttled(self, name, retry_after=None):
+        # Server replied with 429 Too Many Requests (or 503).
+        # retry_after: Value of Retry-After header
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = settings.FETCH_HOST_BACKOFF_S
+        delay = min(delay, settings.FETCH_HOST_BACKOFF_MAX_S)
+
+        with self._lock:
+            host = self._get(name)
+            host.counter_throttled += 1
+            host.blocked_until = max(host.blocked_until, time() + delay)
+            host.block_reason = "throttled"
+
+        logger.info("Host '{}' throttles requests. Wait {}s.".format(
+            name, delay))
+
+    def statistic(self):
+        now = time()
+        with self._lock:
+            return {name: {
+                "active": host.active,
+                "requests": host.counter_requests,
+                "failures": host.counter_failures,
+                "consecutive_failures": host.consecutive_failures,
+                "throttled": host.counter_throttled,
+                "rejected": host.counter_rejected,
+                "blocked_for": max(host.blocked_until - now, 0.0),
+                "block_reason": (host.block_reason
+                                 if host.blocked_until > now else ""),
+            } for (name, host) in self._hosts.items()}
+
+
+def parse_retry_after(value, now=None):
+    # Retry-After is given in seconds or as http date.
+    # Returns delay in seconds or None.
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    try:
+        date = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+    return max(int(date - (now or time())), 0)
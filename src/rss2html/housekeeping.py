@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Background thread for periodic maintenance tasks.
+#
+# Tasks which are too expensive for the request handlers, e.g.
+# enforcing the disk limit of the cache, are registered here and
+# run in their own interval.
+#
+
+from time import time
+from threading import Thread, Condition
+from enum import Enum
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import cached_requests
+from . import websub
+from . import memory_pressure
+from . import default_settings as settings  # Overriden in load_config()
+
+HousekeepingState = Enum('HousekeepingState', ['INIT', 'STARTED', 'STOPED'])
+
+INTERVAL_S = 60.0  # Default interval of tasks
+
+
+class _Task:
+    def __init__(self, name, f, interval):
+        self.name = name
+        self.f = f
+        self.interval = interval
+        self.next_run = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.duration = 0.0  # Of last run
+
+
+class Housekeeping:
+
+    def __init__(self, settings=None, *, interval=None):
+        self.interval = interval or INTERVAL_S
+        self._cond = Condition()
+        self._tasks = []
+        self._thread = None
+        self._state = HousekeepingState.INIT
+
+    # Define __enter__ and __exit__ for with-statement
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def add_task(self, name, f, interval=None, delay=None):
+        # f will be called every interval seconds. The
+        # first call happens after delay seconds.
+        task = _Task(name, f, interval or self.interval)
+        task.next_run = time() + (task.interval if delay is None else delay)
+        with self._cond:
+            self._tasks.append(task)
+            self._cond.notify()
+
+    def start(self):
+        if self._state not in [HousekeepingState.INIT,
+                               HousekeepingState.STOPED]:
+            logger.error("Housekeeping can not be started twice.")
+            return
+
+        self._state = HousekeepingState.STARTED
+        self._thread = Thread(target=self._run, name="Housekeeping")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Housekeeping started")
+
+    def stop(self, timeout=5.0):
+        if self._state not in [HousekeepingState.STARTED]:
+            logger.error("Housekeeping is not started.")
+            return
+
+        with self._cond:
+            self._state = HousekeepingState.STOPED
+            self._cond.notify_all()
+
+        self._thread.join(timeout=timeout)
+        logger.info("Housekeeping stoped")
+
+    def is_running(self):
+        return self._state == HousekeepingState.STARTED
+
+    def statistic(self):
+        with self._cond:
+            return {task.name: {
+                "runs": task.runs,
+                "failures": task.failures,
+                "last_duration": task.duration,
+            } for task in self._tasks}
+
+    def _next_task(self):
+        # Blocks until a task is due. Returns None if
+        # housekeeping was stopped.
+        with self._cond:
+            while self._state == HousekeepingState.STARTED:
+                now = time()
+                due = [t for t in self._tasks if t.next_run <= now]
+                if due:
+                    task = min(due, key=lambda t: t.next_run)
+                    task.next_run = now + task.interval
+                    return task
+
+                wait_until = min((t.next_run for t in self._tasks),
+                                 default=now + self.interval)
+                self._cond.wait(timeout=max(wait_until - now, 0.1))
+
+        return None
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+
+            start = time()
+            try:
+                task.f()
+            except Exception as e:
+                logger.error("Housekeeping task '{}' failed. "
+                             "Error was: {}".format(task.name, e))
+                task.failures += 1
+            task.runs += 1
+            task.duration = time() - start
+
+
+def trim_disk_cache():
+    # The footprint is tracked by the cache store. Thus, this
+    # check is cheap and the removal just visits the evicted elements.
+    if not settings.CACHE_DIR:
+        return
+
+    if cached_requests.cache_disk_footprint() > settings.CACHE_DISK_LIMIT:
+        cached_requests.cache_reduce_disk_footprint(settings.CACHE_DISK_LIMIT)
+
+
+def save_feed_contexts():
+    # Parsed feeds for a fast start. See CACHE_PARSED_FEEDS.
+    if not settings.CACHE_DIR:
+        return
+
+    cached_requests.store_feed_contexts(settings.all_feeds(settings))
+
+
+def create_housekeeping(settings):
+    housekeeping = Housekeeping(
+        settings, interval=settings.CACHE_HOUSEKEEPING_INTERVAL_S)
+    housekeeping.add_task("trim_disk_cache", trim_disk_cache)
+    housekeeping.add_task("check_memory_pressure", memory_pressure.check,
+                          interval=settings.CACHE_RSS_CHECK_INTERVAL_S)
+    housekeeping.add_task("compress_idle_cache_elements",
+                          cached_requests.compress_idle_elements)
+    housekeeping.add_task("train_compression_dictionary",
+                          cached_requests.train_compression_dictionary,
+                          interval=settings.CACHE_DICTIONARY_TRAIN_INTERVAL_S)
+    housekeeping.add_task("save_feed_contexts", save_feed_contexts)
+    housekeeping.add_task("renew_websub_subscriptions",
+                          websub.renew_subscriptions, delay=0)
+    return housekeeping
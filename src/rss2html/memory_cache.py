@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Thread safe in-memory cache for cached_requests.
+#
+# • Elements are ordered by their last access (LRU). Eviction
+#   of an element is O(1). Accesses are counted by record_access()
+#   or get(). Lookups by peek() and replacements of elements do not
+#   change the order or the frequency.
+# • The memory footprint of all elements is updated on insert,
+#   replace, removal and if an element changes its size, e.g. due
+#   (de-)compression. Thus, no loop over all elements is needed to
+#   check the memory limit.
+# • Bytes of compressed and uncompressed elements are counted
+#   separately. Both count toward the footprint.
+# • Eviction policies:
+#   'lru': Least recently used elements first.
+#   'gdsf': GreedyDual-Size-Frequency. Each element gets the priority
+#           L + frequency * cost / size, where cost is the measured
+#           time to fetch and parse it again (element.cost()) and L is
+#           the priority of the last evicted element (aging). Thus,
+#           big feeds read by nobody leave before small, often read
+#           or expensive feeds.
+#   The bookkeeping of both policies is always done. Thus, the policy
+#   can be switched at any time.
+# • Hits and misses are counted per active policy. Misses of recently
+#   evicted keys are counted separately. They show bad decisions
+#   of the policy.
+#
+
+from collections import OrderedDict
+from functools import partial
+from heapq import heappush, heappop, heapify
+from itertools import count
+from threading import RLock
+
+import logging
+logger = logging.getLogger(__name__)
+
+POLICIES = ("lru", "gdsf")
+DEFAULT_POLICY = "lru"
+DEFAULT_COST = 1.0   # For elements without cost() method
+MAX_GHOSTS = 1000    # Number of remembered evicted keys
+
+
+class MemoryCache:
+
+    def __init__(self, policy=DEFAULT_POLICY):
+        self._lock = RLock()
+        self._elements = OrderedDict()  # key -> element, LRU first
+        self._sizes = {}                # key -> (accounted size, compressed)
+        self.footprint = 0
+        self.footprint_compressed = 0
+        self.policy = DEFAULT_POLICY
+        self.set_policy(policy)
+
+        # GDSF state
+        self._freq = {}       # key -> number of accesses
+        self._heap = []       # Heap of (priority, seq, key)
+        self._entry = {}      # key -> seq of valid heap entry
+        self._seq = count()
+        self._inflation = 0.0  # L, priority of last evicted element
+
+        # Statistic
+        self._counter_hits = 0
+        self._counter_misses = 0
+        self._counter_evicted = 0
+        self._policy_counters = {}  # policy -> [hits, misses, ghost hits]
+        self._ghosts = OrderedDict()  # Recently evicted keys
+
+    def __len__(self):
+        return len(self._elements)
+
+    def __contains__(self, key):
+        return key in self._elements
+
+    def __getitem__(self, key):
+        el = self.get(key)
+        if el is None:
+            raise KeyError(key)
+        return el
+
+    def __setitem__(self, key, el):
+        # New keys are added as most recently used. A new version
+        # of an element keeps the position and frequency of its key.
+        with self._lock:
+            prev = self._elements.get(key)
+            if prev is not None and prev is not el:
+                self._unlink(key, prev)
+
+            self._elements[key] = el
+            self._account(key, el)
+            el.set_size_listener(partial(self._resized, key, el))
+            # Elements from disk bring their persisted access count.
+            self._freq[key] = max(self._freq.get(key, 0),
+                                  getattr(el, "access_count", 0), 1)
+            self._prioritize(key, el)
+
+    def __delitem__(self, key):
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        # Lookup marks element as recently used.
+        with self._lock:
+            el = self._elements.get(key)
+            self.record_access(key, hit=(el is not None))
+            return default if el is None else el
+
+    def record_access(self, key, hit=True):
+        # Counts an access of key, e.g. the view of a feed.
+        #
+        # hit: False if the element had to be loaded again.
+        #      (Statistic only.)
+        with self._lock:
+            counters = self._policy_counters.setdefault(self.policy,
+                                                        [0, 0, 0])
+            if self._ghosts.pop(key, None) and not hit:
+                counters[2] += 1
+            if hit:
+                self._counter_hits += 1
+                counters[0] += 1
+            else:
+                self._counter_misses += 1
+                counters[1] += 1
+
+            el = self._elements.get(key)
+            if el is None:
+                return
+
+            self._elements.move_to_end(key)
+            self._freq[key] = self._freq.get(key, 0) + 1
+            self._prioritize(key, el)
+
+    def peek(self, key, default=None):
+        # Lookup without change of LRU order.
+        return self._elements.get(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            el = self._elements.pop(key, None)
+            if el is None:
+                return default
+
+            self._unlink(key, el)
+            self._forget(key)
+            return el
+
+    def items(self):
+        with self._lock:
+            return list(self._elements.items())
+
+    def values(self):
+        with self._lock:
+            return list(self._elements.values())
+
+    def set_policy(self, policy):
+        if policy not in POLICIES:
+            logger.error("Unknown eviction policy '{}'. Use '{}'".format(
+                policy, DEFAULT_POLICY))
+            policy = DEFAULT_POLICY
+
+        self.policy = policy
+
+    def evict(self, upper_bound):
+        # Remove elements until the footprint is below upper_bound.
+        # The order depends on the policy.
+        # Returns list of removed (key, element) pairs.
+        evicted = []
+        with self._lock:
+            while self.footprint > upper_bound and self._elements:
+                if self.policy == "gdsf":
+                    key = self._pop_lowest_priority()
+                    el = self._elements.pop(key)
+                else:
+                    (key, el) = self._elements.popitem(last=False)
+                self._unlink(key, el)
+                self._forget(key)
+                evicted.append((key, el))
+
+                self._ghosts[key] = True
+                if len(self._ghosts) > MAX_GHOSTS:
+                    self._ghosts.popitem(last=False)
+
+            self._counter_evicted += len(evicted)
+
+        return evicted
+
+    def statistic(self):
+        with self._lock:
+            lookups = self._counter_hits + self._counter_misses
+            return {
+                "elements": len(self._elements),
+                "footprint": self.footprint,
+                "footprint_compressed": self.footprint_compressed,
+                "footprint_uncompressed": (self.footprint
+                                           - self.footprint_compressed),
+                "hits": self._counter_hits,
+                "misses": self._counter_misses,
+                "hit_ratio": (self._counter_hits / lookups
+                              if lookups else None),
+                "evicted": self._counter_evicted,
+                "policy": self.policy,
+                "policies": {policy: {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_ratio": (hits / (hits + misses)
+                                  if hits + misses else None),
+                    "misses_after_eviction": ghost_hits,
+                } for (policy, (hits, misses, ghost_hits))
+                    in self._policy_counters.items()},
+            }
+
+    def _account(self, key, el):
+        # Lock is already hold by caller
+        (old_size, old_compressed) = self._sizes.get(key, (0, False))
+        size = el.memory_footprint()
+        compressed = bool(getattr(el, "bCompressed", False))
+        self.footprint += size - old_size
+        self.footprint_compressed += ((size if compressed else 0)
+                                      - (old_size if old_compressed else 0))
+        self._sizes[key] = (size, compressed)
+
+    def _unlink(self, key, el):
+        # Lock is already hold by caller
+        el.set_size_listener(None)
+        (size, compressed) = self._sizes.pop(key, (0, False))
+        self.footprint -= size
+        if compressed:
+            self.footprint_compressed -= size
+
+    def _resized(self, key, el):
+        # Called by element if its size has changed.
+        with self._lock:
+            if self._elements.get(key) is not el:
+                return  # Element was already replaced
+
+            self._account(key, el)
+            self._prioritize(key, el)
+
+    def _prioritize(self, key, el):
+        # Updates GDSF priority of element. Lock is already hold
+        # by caller.
+        # Note: Outdated entries in the heap are skipped by
+        #       _pop_lowest_priority().
+        cost = el.cost() if hasattr(el, "cost") else DEFAULT_COST
+        size = max(self._sizes.get(key, (0, False))[0], 1)
+        priority = self._inflation + self._freq.get(key, 1) * cost / size
+        seq = next(self._seq)
+        self._entry[key] = seq
+        heappush(self._heap, (priority, seq, key))
+
+        if len(self._heap) > 4 * len(self._elements) + 64:
+            self._heap = [e for e in self._heap
+                          if self._entry.get(e[2]) == e[1]]
+            heapify(self._heap)
+
+    def _pop_lowest_priority(self):
+        # Lock is already hold by caller
+        while True:
+            (priority, seq, key) = heappop(self._heap)
+            if self._entry.get(key) == seq:
+                self._inflation = priority
+                return key
+
+    def _forget(self, key):
+        # Removes GDSF state of key. Lock is already hold by caller
+        self._entry.pop(key, None)
+        self._freq.pop(key, None)
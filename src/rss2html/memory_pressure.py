@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Eviction driven by the real memory usage (RSS) of the process.
+#
+# CACHE_MEMORY_LIMIT is compared with an estimation of the cache
+# footprint. Parsed feed contexts and allocator overhead are not
+# covered by it. If CACHE_RSS_HIGH_WATER is set, the housekeeping
+# thread samples the RSS of the process and frees memory until the
+# RSS is below CACHE_RSS_LOW_WATER:
+#
+# • First, parsed contexts of cache elements which were not viewed for
+#   CACHE_RSS_RELEASE_IDLE_S seconds are released.
+# • Then, cache elements are evicted (see CACHE_EVICTION_POLICY).
+#
+# Memory freed by Python objects is not always returned to the
+# operating system. Thus, the eviction stops if it does not lower
+# the RSS anymore.
+#
+# The bytes freed by each step are recorded for the estimated
+# footprint and for the RSS. Their ratio shows how well the estimation
+# matches the real footprint.
+#
+
+import gc
+from time import time
+from threading import Lock
+
+import psutil
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import cached_requests
+from . import default_settings as settings  # Overriden in load_config()
+
+MAX_STEPS = 4
+MIN_EFFECT = 0.1  # Stop if RSS drops less than 10% of evicted bytes
+
+
+class MemoryMonitor:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._process = psutil.Process()
+        self._last_rss = 0
+        self._last_check = 0.0
+
+        # Statistic
+        self._counter_checks = 0
+        self._counter_pressure = 0      # Checks above high-water mark
+        self._counter_contexts = 0      # Released parsed contexts
+        self._counter_evicted = 0       # Evicted cache elements
+        self._freed_estimated = 0       # Sum of evicted estimated bytes
+        self._freed_rss = 0             # Sum of RSS decrease by evictions
+
+    def rss(self):
+        return self._process.memory_info().rss
+
+    def high_water(self):
+        return settings.CACHE_RSS_HIGH_WATER
+
+    def low_water(self):
+        return settings.CACHE_RSS_LOW_WATER or 0.8 * self.high_water()
+
+    def check(self):
+        # Samples RSS and frees memory if high-water mark is exceeded.
+        # Returns RSS after the check.
+        if not self.high_water():
+            return None
+
+        rss = self.rss()
+        with self._lock:
+            self._counter_checks += 1
+            self._last_rss = rss
+            self._last_check = time()
+
+        if rss <= self.high_water():
+            return rss
+
+        logger.info("Process memory {} exceeds high-water mark {}".format(
+            rss, self.high_water()))
+        with self._lock:
+            self._counter_pressure += 1
+
+        rss = self._release_contexts(rss)
+        for _ in range(MAX_STEPS):
+            if rss <= self.low_water():
+                break
+
+            (rss, effective) = self._evict(rss)
+            if not effective:
+                logger.info("Eviction does not lower process memory. "
+                            "Stop at {} bytes.".format(rss))
+                break
+
+        with self._lock:
+            self._last_rss = rss
+        return rss
+
+    def _release_contexts(self, rss):
+        if not settings.CACHE_RSS_RELEASE_IDLE_S:
+            return rss
+
+        n = cached_requests.release_idle_feed_contexts(
+            settings.CACHE_RSS_RELEASE_IDLE_S)
+        if not n:
+            return rss
+
+        gc.collect()
+        with self._lock:
+            self._counter_contexts += n
+
+        return self.rss()
+
+    def _evict(self, rss):
+        # Returns (new rss, True if the eviction had an effect)
+        footprint = cached_requests.cache_memory_footprint()
+        target = max(footprint - (rss - self.low_water()), 0)
+        n = cached_requests.evict_from_memory(target)
+        if not n:
+            return (rss, False)
+
+        gc.collect()
+        new_rss = self.rss()
+        freed_estimated = footprint - cached_requests.cache_memory_footprint()
+        freed_rss = max(rss - new_rss, 0)
+        with self._lock:
+            self._counter_evicted += n
+            self._freed_estimated += freed_estimated
+            self._freed_rss += freed_rss
+
+        return (new_rss, freed_rss >= MIN_EFFECT * freed_estimated)
+
+    def statistic(self):
+        estimated = cached_requests.cache_memory_footprint()
+        with self._lock:
+            return {
+                "enabled": bool(self.high_water()),
+                "rss": self._last_rss,
+                "last_check": self._last_check,
+                "estimated_cache_footprint": estimated,
+                "high_water": self.high_water(),
+                "low_water": self.low_water() if self.high_water() else None,
+                "checks": self._counter_checks,
+                "pressure": self._counter_pressure,
+                "released_contexts": self._counter_contexts,
+                "evicted": self._counter_evicted,
+                "freed_estimated": self._freed_estimated,
+                "freed_rss": self._freed_rss,
+                # RSS bytes freed per estimated byte of evicted elements
+                "estimate_accuracy": (self._freed_rss / self._freed_estimated
+                                      if self._freed_estimated else None),
+            }
+
+
+_MONITOR = MemoryMonitor()
+
+
+def check():
+    return _MONITOR.check()
+
+
+def statistic():
+    return _MONITOR.statistic()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Cache of failed feed requests.
+#
+# Without it, every view of a broken feed (404, timeouts, invalid xml)
+# repeats the whole fetch and parse attempt. Failures are stored per url
+# with their kind and a backoff period. The period starts with
+# NEGATIVE_CACHE_TIME_S and doubles on each further failure of the url
+# up to NEGATIVE_CACHE_TIME_MAX_S.
+#
+# Entries are removed if the url delivers new data again.
+#
+
+from time import time
+from threading import Lock
+from enum import Enum
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import default_settings as settings  # Overriden in load_config()
+
+FailureKind = Enum('FailureKind',
+                   ['HTTP_ERROR', 'TIMEOUT', 'NETWORK', 'TOO_LARGE', 'PARSE'])
+
+MAX_ENTRIES = 1000
+
+
+class Failure:
+    def __init__(self, kind, detail, timestamp, backoff, count):
+        self.kind = kind
+        self.detail = detail
+        self.timestamp = timestamp
+        self.backoff = backoff
+        self.count = count      # Consecutive failures of url
+
+    def expires(self):
+        return self.timestamp + self.backoff
+
+    def __repr__(self):
+        return "Failure({}, '{}', count={})".format(
+            self.kind.name, self.detail, self.count)
+
+
+class NegativeCache:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._failures = {}  # url -> Failure
+
+        # Statistic
+        self._counter_added = 0
+        self._counter_hits = 0
+
+    def add(self, url, kind, detail="", now=None):
+        now = now or time()
+        with self._lock:
+            prev = self._failures.get(url)
+            count = prev.count + 1 if prev else 1
+            backoff = min(settings.NEGATIVE_CACHE_TIME_S * 2**(count - 1),
+                          settings.NEGATIVE_CACHE_TIME_MAX_S)
+            failure = Failure(kind, detail, now, backoff, count)
+            self._failures[url] = failure
+            self._counter_added += 1
+
+            if len(self._failures) > MAX_ENTRIES:
+                self._drop_expired(now)
+
+        logger.debug("Cache failure of '{}' for {}s: {}".format(
+            url, backoff, failure))
+        return failure
+
+    def get(self, url, now=None):
+        # Returns Failure if the backoff period of url is not over.
+        with self._lock:
+            failure = self._failures.get(url)
+            if failure is None or failure.expires() <= (now or time()):
+                # Note: Expired entries are kept to extend the
+                #       backoff if the next attempt fails, too.
+                return None
+
+            self._counter_hits += 1
+            return failure
+
+    def remove(self, url, kinds=None):
+        # kinds: Only remove failures of these kinds.
+        with self._lock:
+            failure = self._failures.get(url)
+            if failure and (kinds is None or failure.kind in kinds):
+                del self._failures[url]
+
+    def _drop_expired(self, now):
+        # Lock is already hold by caller
+        for (url, failure) in list(self._failures.items()):
+            if failure.expires() <= now:
+                del self._failures[url]
+
+    def statistic(self):
+        now = time()
+        with self._lock:
+            active = [f for f in self._failures.values()
+                      if f.expires() > now]
+            return {
+                "entries": len(self._failures),
+                "active": len(active),
+                "added": self._counter_added,
+                "hits": self._counter_hits,
+                "kinds": {kind.name: sum((1 for f in active
+                                          if f.kind == kind))
+                          for kind in FailureKind},
+            }
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Redirects of feed urls.
+#
+# urllib3 follows redirects on its own. Without this map, a moved
+# feed would pay the whole redirect chain on every refresh.
+#
+# • Permanent redirects (301, 308) are kept until the server restarts.
+#   Feeds with such an url are rewritten in the favorites/history
+#   files (see rss_server.py) and the cache element gets the key of
+#   the new url (see cached_requests.py).
+# • Temporary redirects (302, 303, 307) are kept for
+#   FETCH_REDIRECT_TTL_S seconds. The cache key stays the same.
+#
+
+from time import time
+from threading import Lock
+from urllib.parse import urljoin
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import default_settings as settings  # Overriden in load_config()
+
+PERMANENT_STATUS = (301, 308)
+MAX_CHAIN_LENGTH = 20  # Guard against cycles
+
+
+class RedirectMap:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._permanent = {}  # url -> new url
+        self._temporary = {}  # url -> (expires, location)
+
+        # Statistic
+        self._counter_permanent_hits = 0
+        self._counter_temporary_hits = 0
+
+    def note(self, url, request_url, history):
+        # Evaluates the redirects of a request.
+        #
+        # url: Url of the feed. (After resolve())
+        # request_url: Requested url. (After location())
+        # history: Tuple of urllib3.util.retry.RequestHistory
+        #
+        # Returns the new url of the feed if it was moved permanently,
+        # otherwise url.
+        bPermanent = (request_url == url)
+        bRedirected = False
+        target = url
+        location = request_url
+        for h in history:
+            if not h.redirect_location:
+                continue  # Retry after error
+
+            bRedirected = True
+            location = urljoin(h.url, h.redirect_location)
+            bPermanent = bPermanent and h.status in PERMANENT_STATUS
+            if bPermanent:
+                target = location
+
+        with self._lock:
+            if target != url:
+                logger.info("Feed '{}' moved permanently to '{}'".format(
+                    url, target))
+                self._permanent[url] = target
+                self._temporary.pop(url, None)
+
+            if not bRedirected:
+                pass  # Keep expiration time of used temporary redirect
+            elif location != target:
+                self._temporary[target] = (
+                    time() + settings.FETCH_REDIRECT_TTL_S, location)
+            else:
+                self._temporary.pop(target, None)
+
+        return target
+
+    def resolve(self, url):
+        # Applies permanent redirects on url.
+        with self._lock:
+            for _ in range(MAX_CHAIN_LENGTH):
+                new_url = self._permanent.get(url)
+                if new_url is None or new_url == url:
+                    break
+                self._counter_permanent_hits += 1
+                url = new_url
+
+        return url
+
+    def moved_to(self, url):
+        # New url of a permanently moved feed or None.
+        new_url = self.resolve(url)
+        return new_url if new_url != url else None
+
+    def location(self, url):
+        # Url to request for a (resolved) feed url.
+        with self._lock:
+            entry = self._temporary.get(url)
+            if entry is None:
+                return url
+
+            if entry[0] < time():
+                del self._temporary[url]
+                return url
+
+            self._counter_temporary_hits += 1
+            return entry[1]
+
+    def statistic(self):
+        with self._lock:
+            return {
+                "permanent": len(self._permanent),
+                "temporary": len(self._temporary),
+                "permanent_hits": self._counter_permanent_hits,
+                "temporary_hits": self._counter_temporary_hits,
+            }
@@ -51,8 +51,13 @@ from . import feed_parser
 from . import templates
 from . import icon_searcher
 from . import cached_requests
+from . import feed_scheduler
+from . import housekeeping
+from . import websub
+from . import memory_pressure
 
 from .session import LoginType, init_session
+from .negative_cache import FailureKind
 
 from .static_content import action_icon_dummy_classes
 
@@ -87,11 +92,19 @@ class ViewType(Enum):
     SYSTEM_ICON = auto()
     PROVIDE_FILE = auto()
     SHOW_EXTRAS = auto()
+    CACHE_STATS = auto()
     YT_SCRIPT = auto()
+    WEBSUB_CALLBACK = auto()
 
 # To spawn actions of users a pool of processes is used
 actions_pool = None
 
+# Refreshes cached feeds in background (if CACHE_BACKGROUND_REFRESH is set)
+feed_refresher = None
+
+# Periodic maintenance tasks, e.g. check of CACHE_DISK_LIMIT
+housekeeper = None
+
 # TIMEZONE = str(datetime.now(timezone(timedelta(0))).astimezone().tzinfo)
 # DATE_HEADER_FORMAT = "%a, %d %h %Y %T {}".format(TIMEZONE)
 
@@ -390,6 +403,10 @@ class MyHandler(HTTPCompressionRequestHandler):
         set_gettext(self.server.html_renderer, self.context)
 
     def do_POST(self):
+        if self.path.startswith(websub.CALLBACK_PATH):
+            # Content pushed by WebSub hub. No session involved.
+            return self.handle_websub_push()
+
         self.session.load()
         self.save_session = False
 
@@ -538,6 +555,8 @@ class MyHandler(HTTPCompressionRequestHandler):
             return self.handle_show_feed_from_file(query_components)
         elif view == ViewType.ACTION_ICONS_CSS:
             return action_icon_dummy_classes(self)
+        elif view == ViewType.CACHE_STATS:
+            return self.show_cache_stats()
         elif view == ViewType.SYSTEM_ICON:
             return self.system_icon()
         elif view == ViewType.INDEX_PAGE:
@@ -546,6 +565,8 @@ class MyHandler(HTTPCompressionRequestHandler):
             return self.show_extras()
         elif view == ViewType.YT_SCRIPT:
             return self.handle_youtube(query_components)
+        elif view == ViewType.WEBSUB_CALLBACK:
+            return self.handle_websub_verify(query_components)
         elif view == ViewType.PROVIDE_FILE:
             # self.path = MyHandler.directory + self.path  # for Python 3.4
             self.log_message("Provide %s", self.path)
@@ -606,12 +627,16 @@ class MyHandler(HTTPCompressionRequestHandler):
             return ViewType.CHANGE_STYLE
         elif self.path.startswith("/action"):
             return ViewType.USER_ACTION
+        elif self.path.startswith(websub.CALLBACK_PATH):
+            return ViewType.WEBSUB_CALLBACK
         elif feed_key:
             return ViewType.SHOW_FEED
         elif filepath:
             return ViewType.SHOW_FEED_FROM_FILE
         elif self.path == "/css/action_icons.css":
             return ViewType.ACTION_ICONS_CSS
+        elif self.path == "/stats":
+            return ViewType.CACHE_STATS
         elif self.path.startswith("/icons/system/"):
             return ViewType.SYSTEM_ICON
         elif self.path in ["/", "/index.html"]:
@@ -899,9 +924,42 @@ class MyHandler(HTTPCompressionRequestHandler):
                             error=True, display_settings=False,
                             redirect_url=self.path)
 
+            # Recently failed feeds are not fetched and parsed again
+            # until their backoff period is over. (cache=0 forces it.)
+            failure = cached_requests.get_failure(feed_url) \
+                    if bUseCache else None
+            if failure:
+                logger.debug("Skip feed due previous failure: {}".format(
+                    failure))
+                if failure.kind == FailureKind.PARSE:
+                    error_msg = _('Parsing of Feed XML failed.')
+                else:
+                    error_msg = _('Cannot fetch data for this feed.')
+                return self.show_msg(error_msg, True)
+
             res = None
-            (cEl, code) = cached_requests.fetch_file(
-                    feed_url, bUseCache, self.directory)
+            cEl = None
+            bPeeked = False
+            if (bUseCache and feed_refresher
+                    and feed_refresher.is_running()):
+                # Reply with cached value immediately. Outdated values
+                # will be updated in background (stale-while-revalidate).
+                cEl = cached_requests.peek_file(feed_url)
+                if cEl:
+                    # New versions fetched by the scheduler are merged
+                    # into feed.context (see update_feed_contexts()).
+                    # Thus, the context could be current while the
+                    # user had seen an older version.
+                    bPeeked = True
+                    code = 304 if (feed and
+                            cached_requests.has_current_context(feed)) \
+                            else 200
+                    if cached_requests.is_expired(cEl):
+                        feed_refresher.request_refresh(feed_url)
+
+            if cEl is None:
+                (cEl, code) = cached_requests.fetch_file(
+                        feed_url, bUseCache, self.directory)
 
             if cEl is None:
                 if code == 500:
@@ -910,6 +968,16 @@ class MyHandler(HTTPCompressionRequestHandler):
                     error_msg = _('No feed found for this URI arguments.')
                 return self.show_msg(error_msg, True)
 
+            # Replace stored url if the feed has moved permanently.
+            # The cache element was already moved to the new url.
+            new_feed_url = cached_requests.moved_url(feed_url)
+            if new_feed_url:
+                if feed:
+                    feed.update_url(new_feed_url)
+                    self.save_feed_change(feed)
+                feed_url = new_feed_url
+
+            cached_requests.record_access(feed_url, cEl)
 
             # Parse 'page' uri argument (affects etag!)
             page = int(query_components.setdefault("page", ['1'])[-1])
@@ -923,7 +991,7 @@ class MyHandler(HTTPCompressionRequestHandler):
             etag_location = None
             browser_etag = self.headers.get("If-None-Match", "")
             location = f"/feed/{feed.get_uid()}"
-            if code == 304:
+            if code == 304 and not bPeeked:
                 # Our data hasn't changed. Check if users etag is already
                 # the current one.
                 etag_location = self.get_etag(location)
@@ -940,13 +1008,23 @@ class MyHandler(HTTPCompressionRequestHandler):
                 return self._write_304(etag, max_age=10)
 
             # Generate new output page
-            if code == 304 and len(feed.context)>0:
+            if len(feed.context) > 0 and (
+                    code == 304 or cached_requests.has_current_context(feed)):
+                # Note: New entries of partial feed responses (RFC 3229)
+                #       and of refreshed feeds were already merged
+                #       into feed.context.
                 logger.debug("Skip parsing of feed and re-use previous")
             else:
-                if not feed_parser.parse_feed(feed, cEl.data()):
+                if cached_requests.load_feed_context(feed, cEl):
+                    logger.debug("Restored parsed feed from cache store")
+                elif not feed_parser.parse_feed_coalesced(feed, cEl.data):
+                    cached_requests.add_failure(feed_url, FailureKind.PARSE)
                     error_msg = _('Parsing of Feed XML failed.')
                     return self.show_msg(error_msg, True)
 
+                cached_requests.register_feed_context(feed)
+                websub.discover(feed_url, feed.context)
+
             # Preparing feed.context on current side by updating
             # some of its values. This is to be done here because
             # processing all feed entries in feed_parser.parse_feed
@@ -1092,6 +1170,49 @@ class MyHandler(HTTPCompressionRequestHandler):
         # self._write_1_1(html, etag=etag, max_age=10)
         self._write_compressed(html, 'text/html', etag=etag, max_age=10)
 
+    def show_cache_stats(self):
+        # Counters of the cache/fetch subsystems for monitoring.
+        stats = {
+            "cached_requests": cached_requests.statistic(),
+            "feed_parser": feed_parser.statistic(),
+        }
+        if feed_refresher:
+            stats["feed_scheduler"] = feed_refresher.statistic()
+        if housekeeper:
+            stats["housekeeping"] = housekeeper.statistic()
+        stats["websub"] = websub.statistic()
+        stats["memory_pressure"] = memory_pressure.statistic()
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self._write_1_1(json.dumps(stats, indent=2))
+
+    def handle_websub_verify(self, query_components):
+        # Hub checks intent of (un)subscription
+        sid = urlparse(self.path).path[len(websub.CALLBACK_PATH):]
+        (code, body) = websub.verify(sid, query_components)
+        self.send_response(code)
+        self.send_header('Content-type', 'text/plain')
+        self._write_1_1(body)
+
+    def handle_websub_push(self):
+        # Hub delivers new content of subscribed feed
+        sid = urlparse(self.path).path[len(websub.CALLBACK_PATH):]
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = 0
+
+        if content_length < 0:
+            return self.send_error(400)
+        if content_length > settings.MAX_FEED_BYTE_SIZE:
+            return self.send_error(413)
+
+        body = self.rfile.read(content_length)
+        code = websub.receive(sid, body, self.headers)
+        self.send_response(code)
+        self._write_1_1("")
+
     def system_icon(self):
         image = icon_searcher.get_cached_file(self.path)
         if not image:
@@ -1129,6 +1250,7 @@ class MyHandler(HTTPCompressionRequestHandler):
             ViewType.CHANGE_STYLE,
             ViewType.ACTION_ICONS_CSS,
             ViewType.SYSTEM_ICON,
+            ViewType.WEBSUB_CALLBACK,
             # ViewType.SHOW_EXTRAS,
             # ViewType.YT_SCRIPT,
         ]
@@ -1509,6 +1631,7 @@ class MyHandler(HTTPCompressionRequestHandler):
             # this fields into new instance
             feed_new.name = feed.name
             feed_new._uid = feed._uid
+            feed_new._public_id = feed._public_id
 
             # If a new url is found, save feed immediately, but not
             # at end of program.
@@ -1587,6 +1710,51 @@ def set_logger_levels():
         logging.getLogger(key).setLevel(numeric_level)
 
 
+def preparse_feed(key, cEl):
+    # Called by the warm up of the cache for the most read feeds.
+    # The first request of these feeds can skip the parsing.
+    for feed in settings.all_feeds(settings):
+        if (feed.cache_name() != key or
+                cached_requests.has_current_context(feed, key)):
+            continue
+
+        if (cached_requests.load_feed_context(feed, cEl, key) or
+                feed_parser.parse_feed_coalesced(feed, cEl.data)):
+            cached_requests.register_feed_context(feed, key)
+            websub.discover(feed.url, feed.context)
+
+
+def benchmark_codecs():
+    # Prints ratio and speed of the compression codecs for the
+    # cached feeds. The server is not started.
+    if not settings.CACHE_DIR:
+        print("Benchmark needs CACHE_DIR.")
+        return 1
+
+    settings.CACHE_DIR = os.path.expandvars(settings.CACHE_DIR)
+    cached_requests.load_cache(
+        settings.FAVORITES, settings.HISTORY,
+        *(settings.USER_FAVORITES.values()),
+        *(settings.USER_HISTORY.values()))
+    results = cached_requests.benchmark_codecs()
+    cached_requests.close_store()
+    if not results:
+        print("No cached feeds found.")
+        return 1
+
+    print("{:<10} {:>7} {:>12} {:>14} {:>16}".format(
+        "Codec", "Ratio", "Bytes", "Compr. MB/s", "Decompr. MB/s"))
+    for (name, r) in results.items():
+        if "error" in r:
+            print("{:<10} {}".format(name, r["error"]))
+            continue
+        print("{:<10} {:>7.2f} {:>12} {:>14.1f} {:>16.1f}".format(
+            name, r["ratio"], r["bytes"], r["compress_mb_s"] or 0.0,
+            r["decompress_mb_s"] or 0.0))
+
+    return 0
+
+
 def main():
     # Workaround...
     set_start_method("spawn")
@@ -1606,6 +1774,9 @@ def main():
     parser = create_argument_parser()
     args = parser.parse_args()
 
+    if args.benchmark_codecs:
+        return benchmark_codecs()
+
     if not args.multiple and check_process_already_running():
         logger.info("Server process is already running.")
         return 0
@@ -1637,9 +1808,12 @@ def main():
         settings.CACHE_DIR = os.path.expandvars(settings.CACHE_DIR)
         __l1 = len(cached_requests._CACHE)
         cached_requests.gen_cache_dirname(True)
-        cached_requests.load_cache(settings.FAVORITES, settings.HISTORY)
-        cached_requests.load_cache(*(settings.USER_FAVORITES.values()))
-        cached_requests.load_cache(*(settings.USER_HISTORY.values()))
+        # Just the metadata. Bodies are loaded on demand.
+        cached_requests.load_cache(
+            settings.FAVORITES, settings.HISTORY,
+            *(settings.USER_FAVORITES.values()),
+            *(settings.USER_HISTORY.values()))
+        websub.load_subscriptions()
         __l2 = len(cached_requests._CACHE)
         logger.info("Loaded {} feeds from disk into cache.".format(__l2 - __l1))
 
@@ -1647,6 +1821,10 @@ def main():
         __l3 = len(cached_requests._CACHE)
         logger.info("Trim on {} elements in cache.".format(__l3))
 
+        if settings.CACHE_WARM_UP:
+            cached_requests.start_warm_up_cache(
+                parse=preparse_feed, n_parse=settings.CACHE_WARM_UP_PARSE)
+
 
     global actions_pool
     actions_pool = ActionPool(settings,
@@ -1656,6 +1834,25 @@ def main():
     logger.info("Start action pool")
     actions_pool.start()
 
+    global feed_refresher
+    if settings.CACHE_BACKGROUND_REFRESH:
+        feed_refresher = feed_scheduler.FeedScheduler(
+            settings,
+            workers=settings.CACHE_REFRESH_WORKERS,
+            jitter=settings.CACHE_REFRESH_JITTER_S)
+        logger.info("Start feed scheduler")
+        feed_refresher.start()
+        # Feeds with unusable pushed content are polled again.
+        websub.set_poll_listener(feed_refresher.request_refresh)
+
+    logger.info("Start write-behind of cache")
+    cached_requests.start_write_behind()
+
+    global housekeeper
+    housekeeper = housekeeping.create_housekeeping(settings)
+    logger.info("Start housekeeping")
+    housekeeper.start()
+
     try:
         httpd = genMyHTTPServer()((settings.HOST, settings.PORT), MyHandler, settings)
     except OSError:
@@ -1720,11 +1917,26 @@ def main():
             httpd.shutdown()
             raise
 
+    if feed_refresher:
+        logger.info("Stop feed scheduler")
+        feed_refresher.stop()
+
+    logger.info("Stop housekeeping")
+    housekeeper.stop()
+
+    logger.info("Stop write-behind of cache")
+    cached_requests.stop_write_behind()
+
     if settings.CACHE_DIR:
         logger.info("Save cache on disk")
-        cached_requests.store_cache(settings.FAVORITES, settings.HISTORY)
-        cached_requests.store_cache(*(settings.USER_FAVORITES.values()))
-        cached_requests.store_cache(*(settings.USER_HISTORY.values()))
+        # One call => One transaction
+        cached_requests.store_cache(
+            settings.FAVORITES, settings.HISTORY,
+            *(settings.USER_FAVORITES.values()),
+            *(settings.USER_HISTORY.values()))
+        cached_requests.store_feed_contexts(settings.all_feeds(settings))
+        cached_requests.close_store()
+        websub.save_subscriptions()
 
     logger.info("Stop action pool")
     actions_pool.stop()
@@ -1746,6 +1958,9 @@ def create_argument_parser():
                         help="Override default hostname.")
     parser.add_argument('-s', '--ssl', type=bool, # Default is None
                         help="Override SSL option.")
+    parser.add_argument('--benchmark-codecs', action='store_true',
+                        help="Compare compression codecs on cached feeds"
+                        " and exit.")
     return parser
 
 if __name__ == "__main__":
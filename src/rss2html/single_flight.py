@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Coalescing of concurrent function calls.
+#
+# If several threads call SingleFlight.do() with the same key,
+# only the first one invokes the function. The other threads
+# wait on this call and get the same result (or exception).
+#
+
+from threading import Lock, Event
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+        self.num_waiting = 0
+
+
+class SingleFlight:
+
+    def __init__(self, name=""):
+        self.name = name
+        self._lock = Lock()
+        self._calls = {}  # key -> _Call
+
+        # Statistic
+        self._counter_calls = 0
+        self._counter_coalesced = 0
+
+    def do(self, key, f, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self._counter_calls += 1
+                leader = True
+            else:
+                call.num_waiting += 1
+                self._counter_coalesced += 1
+                leader = False
+
+        if not leader:
+            logger.debug("{}: Wait on running call for '{}'".format(
+                self.name, key))
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = f(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+    def statistic(self):
+        with self._lock:
+            return {
+                "calls": self._counter_calls,
+                "coalesced": self._counter_coalesced,
+                "in_flight": len(self._calls),
+                "waiting": sum((c.num_waiting for c in self._calls.values())),
+            }
@@ -0,0 +1,503 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# WebSub (PubSubHubbub) subscriptions of feeds.
+#
+# Feeds announcing a hub by <atom:link rel="hub"> are subscribed if
+# WEBSUB_CALLBACK_URL is set. The hub verifies the intent with a GET
+# request on the callback url and pushes new content by POST requests
+# on the same url. See https://www.w3.org/TR/websub/
+#
+# • Pushed content goes directly into the cache
+#   (see cached_requests.push_file()).
+# • Feeds with an active subscription are not polled by the
+#   scheduler until the lease expires. If pushed content was not
+#   usable, the feed is polled again until the next valid push.
+# • Each subscription has its own callback url and secret. Pushed
+#   content without valid signature is ignored.
+# • Leases are renewed by the housekeeping thread. Subscriptions of
+#   removed feeds are not renewed.
+#
+
+import os.path
+import json
+import hmac
+import hashlib
+import secrets
+from time import time
+from threading import Lock
+from enum import Enum
+
+from urllib3 import Timeout, Retry
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import cached_requests
+from . import default_settings as settings  # Overriden in load_config()
+
+SubscriptionState = Enum('SubscriptionState',
+                         ['PENDING', 'ACTIVE', 'DENIED', 'UNSUBSCRIBING'])
+
+CALLBACK_PATH = "/websub/"
+STATE_FILENAME = "websub.json"
+RETRY_S = 600            # Delay after failed subscription requests
+RENEW_MARGIN = 0.1       # Renew if less than 10% of lease remains
+SIGNATURE_ALGORITHMS = ("sha1", "sha256", "sha384", "sha512")
+
+
+class Subscription:
+    def __init__(self, feed_url, hub, topic, sid=None, secret=None):
+        self.feed_url = feed_url
+        self.hub = hub
+        self.topic = topic
+        self.sid = sid or secrets.token_urlsafe(16)
+        self.secret = secret or secrets.token_hex(20)
+        self.state = SubscriptionState.PENDING
+        self.lease_expires = 0.0
+        self.next_request = 0.0  # Time for (re-)subscription
+        self.push_rejected = False  # Last pushed content not usable
+
+    def callback_url(self):
+        return settings.WEBSUB_CALLBACK_URL.rstrip("/") \
+                + CALLBACK_PATH + self.sid
+
+    def is_active(self, now=None):
+        return (self.state == SubscriptionState.ACTIVE
+                and self.lease_expires > (now or time()))
+
+    def is_pushing(self, now=None):
+        # True if the feed does not need to be polled.
+        return self.is_active(now) and not self.push_rejected
+
+    def to_dict(self):
+        return {
+            "feed_url": self.feed_url,
+            "hub": self.hub,
+            "topic": self.topic,
+            "sid": self.sid,
+            "secret": self.secret,
+            "state": self.state.name,
+            "lease_expires": self.lease_expires,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sub = cls(d["feed_url"], d["hub"], d["topic"],
+                  d["sid"], d["secret"])
+        sub.state = SubscriptionState[d["state"]]
+        sub.lease_expires = d["lease_expires"]
+        if sub.state == SubscriptionState.ACTIVE:
+            sub.next_request = sub.lease_expires - RENEW_MARGIN * \
+                    settings.WEBSUB_LEASE_S
+        return sub
+
+
+class WebSubClient:
+
+    def __init__(self):
+        self._lock = Lock()
+        self._subscriptions = {}  # sid -> Subscription
+        self._by_url = {}         # feed url -> Subscription
+        self._poll_listener = None
+
+        # Statistic
+        self._counter_requests = 0
+        self._counter_request_failures = 0
+        self._counter_verified = 0
+        self._counter_pushed = 0
+        self._counter_rejected = 0
+
+    def discover(self, feed_url, context):
+        # Registers subscription for hub announced in parsed
+        # feed context. The request to the hub is sent by
+        # renew_subscriptions().
+        hub = context.get("websub_hub")
+        if not settings.WEBSUB_CALLBACK_URL or not hub:
+            return
+
+        topic = context.get("websub_topic") or feed_url
+        with self._lock:
+            sub = self._by_url.get(feed_url)
+            if sub and sub.hub == hub and sub.topic == topic:
+                return
+
+            if sub:
+                self._subscriptions.pop(sub.sid, None)
+
+            logger.info("Feed '{}' announces WebSub hub '{}'".format(
+                feed_url, hub))
+            sub = Subscription(feed_url, hub, topic)
+            self._subscriptions[sub.sid] = sub
+            self._by_url[feed_url] = sub
+
+    def set_poll_listener(self, listener):
+        # The listener will be called with the feed url if a pushed
+        # feed has to be polled again, e.g. after a rejected push.
+        self._poll_listener = listener
+
+    def pushed_until(self, feed_url):
+        # End of lease of active subscription or 0.0
+        with self._lock:
+            sub = self._by_url.get(feed_url)
+            if sub is None or not sub.is_pushing():
+                return 0.0
+            return sub.lease_expires
+
+    def renew_subscriptions(self, now=None):
+        # Sends (re-)subscription requests which are due.
+        if not settings.WEBSUB_CALLBACK_URL:
+            return
+
+        now = now or time()
+        feed_urls = set((feed.url for feed in settings.all_feeds(settings)))
+        with self._lock:
+            due, obsolete = [], []
+            for sub in list(self._subscriptions.values()):
+                if sub.state == SubscriptionState.UNSUBSCRIBING:
+                    if sub.next_request <= now:
+                        self._remove(sub)  # Hub did not confirm in time
+                elif sub.feed_url not in feed_urls:
+                    # Feed removed.
+                    if sub.is_active(now):
+                        sub.state = SubscriptionState.UNSUBSCRIBING
+                        sub.next_request = now + RETRY_S
+                        obsolete.append(sub)
+                    else:
+                        self._remove(sub)
+                elif (sub.next_request <= now and
+                      sub.state != SubscriptionState.DENIED):
+                    sub.next_request = now + RETRY_S
+                    due.append(sub)
+
+        for sub in due:
+            self._request(sub, "subscribe")
+
+        for sub in obsolete:
+            self._request(sub, "unsubscribe")
+
+    def _remove(self, sub):
+        # Lock is already hold by caller
+        self._subscriptions.pop(sub.sid, None)
+        if self._by_url.get(sub.feed_url) is sub:
+            del self._by_url[sub.feed_url]
+
+    def _request(self, sub, mode):
+        fields = {
+            "hub.mode": mode,
+            "hub.topic": sub.topic,
+            "hub.callback": sub.callback_url(),
+            "hub.lease_seconds": str(settings.WEBSUB_LEASE_S),
+            "hub.secret": sub.secret,
+        }
+        try:
+            res = cached_requests._HTTP.request(
+                "POST", sub.hub, fields=fields, encode_multipart=False,
+                headers={'User-Agent': 'Mozilla/5.0'},
+                timeout=Timeout(connect=5.2, read=30.0),
+                retries=Retry(2, redirect=5))
+            ok = res.status in (202, 204)
+        except Exception as e:
+            logger.debug("WebSub request to '{}' failed. Error was: {}"
+                         "".format(sub.hub, e))
+            ok = False
+
+        with self._lock:
+            self._counter_requests += 1
+            if not ok:
+                self._counter_request_failures += 1
+
+        if not ok:
+            logger.info("Hub '{}' rejected {} of '{}'".format(
+                sub.hub, mode, sub.topic))
+        return ok
+
+    def verify(self, sid, query):
+        # Verification of intent by the hub (GET on callback url).
+        #
+        # query: Dict of parse_qs() on the query string.
+        # Returns (status code, body).
+        def q(name):
+            return query.get(name, [""])[-1]
+
+        mode = q("hub.mode")
+        with self._lock:
+            sub = self._subscriptions.get(sid)
+            if sub is None or q("hub.topic") != sub.topic:
+                return (404, "")
+
+            if mode == "denied":
+                logger.info("Hub '{}' denied subscription of '{}': {}"
+                            "".format(sub.hub, sub.topic, q("hub.reason")))
+                sub.state = SubscriptionState.DENIED
+                return (200, "")
+
+            if mode == "subscribe" and \
+                    sub.state != SubscriptionState.UNSUBSCRIBING:
+                try:
+                    lease = int(q("hub.lease_seconds"))
+                except ValueError:
+                    lease = settings.WEBSUB_LEASE_S
+
+                now = time()
+                sub.state = SubscriptionState.ACTIVE
+                sub.lease_expires = now + lease
+                sub.next_request = now + (1.0 - RENEW_MARGIN) * lease
+                self._counter_verified += 1
+                logger.info("WebSub subscription of '{}' verified. "
+                            "Lease: {}s".format(sub.topic, lease))
+                return (200, q("hub.challenge"))
+
+            if mode == "unsubscribe" and \
+                    sub.state == SubscriptionState.UNSUBSCRIBING:
+                self._remove(sub)
+                return (200, q("hub.challenge"))
+
+        return (404, "")
+
+    def receive(self, sid, body, headers):
+        # Content pushed by the hub (POST on callback url).
+        #
+        # headers: Dict-like object of the request headers.
+        # Returns status code.
+        with self._lock:
+            sub = self._subscriptions.get(sid)
+
+        if sub is None:
+            return 410  # Gone. The hub should remove the subscription.
+
+        if not _valid_signature(sub.secret, body,
+                                headers.get("X-Hub-Signature", "")):
+            # Acknowledged, but ignored (see WebSub spec, 8. Content
+            # Distribution).
+            logger.info("Invalid signature of WebSub content for '{}'"
+                        "".format(sub.topic))
+            with self._lock:
+                self._counter_rejected += 1
+            return 202
+
+        content_type = headers.get("Content-Type")
+        if not cached_requests.push_file(
+                sub.feed_url, body,
+                {"Content-Type": content_type} if content_type else {}):
+            logger.info("Pushed content for '{}' not usable. Poll feed "
+                        "again.".format(sub.feed_url))
+            with self._lock:
+                self._counter_rejected += 1
+                sub.push_rejected = True
+            listener = self._poll_listener
+            if listener:
+                listener(sub.feed_url)
+            return 202
+
+        with self._lock:
+            self._counter_pushed += 1
+            sub.push_rejected = False
+
+        logger.debug("WebSub content for '{}' stored".format(sub.feed_url))
+        return 202
+
+    def save(self, dirname):
+        if not dirname:
+            return
+
+        with self._lock:
+            subs = [sub.to_dict() for sub in self._subscriptions.values()
+                    if sub.state != SubscriptionState.DENIED]
+
+        path = os.path.join(dirname, STATE_FILENAME)
+        try:
+            with open(path, "w") as f:
+                json.dump(subs, f, indent=1)
+        except OSError as e:
+            logger.error("Writing of '{}' failed. Error was: {}".format(
+                path, e))
+
+    def load(self, dirname):
+        path = os.path.join(dirname or "", STATE_FILENAME)
+        if not dirname or not os.path.exists(path):
+            return
+
+        try:
+            with open(path, "r") as f:
+                subs = [Subscription.from_dict(d) for d in json.load(f)]
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("Reading of '{}' failed. Error was: {}".format(
+                path, e))
+            return
+
+        with self._lock:
+            for sub in subs:
+                self._subscriptions[sub.sid] = sub
+                self._by_url[sub.feed_url] = sub
+
+    def statistic(self):
+        now = time()
+        with self._lock:
+            return {
+                "subscriptions": len(self._subscriptions),
+                "active": sum((1 for sub in self._subscriptions.values()
+                               if sub.is_active(now))),
+                "requests": self._counter_requests,
+                "request_failures": self._counter_request_failures,
+                "verified": self._counter_verified,
+                "pushed": self._counter_pushed,
+                "rejected": self._counter_rejected,
+            }
+
+
+def _valid_signature(secret, body, signature):
+    # signature: Value of X-Hub-Signature header, e.g. 'sha256=…'
+    (method, _, digest) = signature.partition("=")
+    if method not in SIGNATURE_ALGORITHMS:
+        return False
+
+    expected = hmac.new(secret.encode("utf-8"), body,
+                        getattr(hashlib, method)).hexdigest()
+    return hmac.compare_digest(expected, digest.strip().lower())
+
+
+_CLIENT = WebSubClient()
+
+
+def discover(feed_url, context):
+    return _CLIENT.discover(feed_url, context)
+
+
+def set_poll_listener(listener):
+    return _CLIENT.set_poll_listener(listener)
+
+
+def pushed_until(feed_url):
+    return _CLIENT.pushed_until(feed_url)
+
+
+def renew_subscriptions():
+    return _CLIENT.renew_subscriptions()
+
+
+def verify(sid, query):
+    return _CLIENT.verify(sid, query)
+
+
+def receive(sid, body, headers):
+    return _CLIENT.receive(sid, body, headers)
+
+
+def save_subscriptions():
+    return _CLIENT.save(cached_requests.gen_cache_dirname(True))
+
+
+def load_subscriptions():
+    return _CLIENT.load(cached_requests.gen_cache_dirname())
+
+
+def statistic():
+    return _CLIENT.statistic()
+
+
+if __name__ == "__main__":
+    # Local hub stand-in. Subscribes a feed, lets the hub verify the
+    # intent and pushes whole and partial feed documents.
+    #
+    # Usage: python3 -m rss2html.websub
+    import threading
+    import urllib.request
+    from urllib.parse import urlparse, urlencode, parse_qs, parse_qsl
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from .feed import Feed
+
+    logging.basicConfig(level=logging.INFO)
+
+    FEED_URL = "http://127.0.0.1/hub_test.xml"
+
+    def feed_document(*guids):
+        items = "".join(("<item><title>Item {0}</title><guid>{0}</guid>"
+                         "</item>".format(guid) for guid in guids))
+        return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+                '<title>Hub test</title>{}</channel></rss>'
+                '').format(items).encode("utf-8")
+
+    PUSHES = [
+        ("whole feed", feed_document(1, 2)),
+        ("whole feed", feed_document(2, 3)),  # Item 1 removed upstream
+        ("new items only", feed_document(4)),
+        ("too large", b" " * int(settings.MAX_FEED_BYTE_SIZE + 1)),
+    ]
+
+    class CallbackHandler(BaseHTTPRequestHandler):
+        # Stands in for the callback of rss_server.MyHandler
+        def do_GET(self):
+            sid = urlparse(self.path).path[len(CALLBACK_PATH):]
+            (code, body) = verify(sid, parse_qs(urlparse(self.path).query))
+            self.send_response(code)
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+
+        def do_POST(self):
+            sid = urlparse(self.path).path[len(CALLBACK_PATH):]
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            self.send_response(receive(sid, body, self.headers))
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class HubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            self.send_response(202)
+            self.end_headers()
+            threading.Thread(target=self.hub_worker,
+                             args=(dict(parse_qsl(body.decode())),)).start()
+
+        def hub_worker(self, fields):
+            # Verification of intent
+            callback = fields["hub.callback"]
+            query = urlencode({"hub.mode": fields["hub.mode"],
+                               "hub.topic": fields["hub.topic"],
+                               "hub.challenge": "challenge-123",
+                               "hub.lease_seconds": "3600"})
+            with urllib.request.urlopen(callback + "?" + query) as res:
+                print("Hub: Verification reply '{}'".format(
+                    res.read().decode()))
+
+            # Content distribution
+            for (label, body) in PUSHES:
+                signature = hmac.new(fields["hub.secret"].encode("utf-8"),
+                                     body, hashlib.sha256).hexdigest()
+                req = urllib.request.Request(callback, data=body, headers={
+                    "Content-Type": "application/rss+xml",
+                    "X-Hub-Signature": "sha256=" + signature})
+                urllib.request.urlopen(req).close()
+                cEl = cached_requests.peek_file(FEED_URL)
+                print("Hub: Pushed {:<14} -> Cached items {}, pushed "
+                      "until {:.0f}".format(
+                          label, sorted(cached_requests.delta.item_ids(
+                              cEl.data())) if cEl else None,
+                          pushed_until(FEED_URL)))
+            done.set()
+
+        def log_message(self, *args):
+            pass
+
+    done = threading.Event()
+    callback_server = ThreadingHTTPServer(("127.0.0.1", 0), CallbackHandler)
+    hub_server = ThreadingHTTPServer(("127.0.0.1", 0), HubHandler)
+    for server in (callback_server, hub_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    settings.CACHE_DIR = None  # Memory cache only
+    settings.WEBSUB_CALLBACK_URL = "http://127.0.0.1:{}".format(
+        callback_server.server_port)
+    settings.FAVORITES = [Feed("Hub test", FEED_URL)]
+    set_poll_listener(lambda url: print("Poll '{}' again".format(url)))
+
+    discover(FEED_URL, {"websub_hub": "http://127.0.0.1:{}/hub".format(
+        hub_server.server_port)})
+    renew_subscriptions()
+    done.wait(timeout=10)
+    print(statistic())
+
+    callback_server.shutdown()
+    hub_server.shutdown()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Background persistence of changed cache elements (write-behind).
+#
+# Without it, new feed data is written on eviction or at the end of the
+# program. A crash loses everything fetched since the start and the
+# eviction writes on the request thread.
+#
+# • Changed elements are marked as dirty. A flusher thread writes them
+#   if the oldest dirty element waits longer than CACHE_FLUSH_INTERVAL_S
+#   or the dirty bytes exceed CACHE_FLUSH_BYTES.
+# • Evicted elements are handed over, too, and flushed immediately.
+#   Until they are written, pending() returns them for lookups.
+# • Elements whose write failed are queued again and retried with the
+#   next flush.
+# • One flush is one transaction of the cache store. Thus, the write
+#   of a batch is atomic and needs just one fsync (see write function
+#   in cached_requests).
+# • stop() drains the queue.
+#
+
+from time import time, perf_counter
+from collections import OrderedDict
+from threading import Thread, Condition
+from enum import Enum
+
+import logging
+logger = logging.getLogger(__name__)
+
+from . import default_settings as settings  # Overriden in load_config()
+
+WriteBehindState = Enum('WriteBehindState', ['INIT', 'STARTED', 'STOPED'])
+
+
+class WriteBehind:
+
+    def __init__(self, write):
+        # write: Callable getting list of (key, element) pairs.
+        #        Returns the pairs which could not be written.
+        self._write = write
+        self._cond = Condition()
+        self._dirty = OrderedDict()  # key -> element, oldest first
+        self._in_flight = {}         # key -> element, written by flush()
+        self._dirty_bytes = 0
+        self._oldest = None          # Time of oldest dirty element
+        self._urgent = False
+        self._thread = None
+
+        # Statistic
+        self._counter_flushes = 0
+        self._counter_written = 0
+        self._counter_failed = 0
+        self._last_duration = 0.0
+
+        self._state = WriteBehindState.INIT
+
+    def start(self):
+        if self._state not in [WriteBehindState.INIT,
+                               WriteBehindState.STOPED]:
+            logger.error("Write-behind can not be started twice.")
+            return
+
+        self._state = WriteBehindState.STARTED
+        self._thread = Thread(target=self._run, name="WriteBehind")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Write-behind started")
+
+    def stop(self, timeout=30.0):
+        if self._state not in [WriteBehindState.STARTED]:
+            logger.error("Write-behind is not started.")
+            return
+
+        with self._cond:
+            self._state = WriteBehindState.STOPED
+            self._cond.notify_all()
+
+        self._thread.join(timeout=timeout)
+        self.flush()  # Elements added in the meantime
+        logger.info("Write-behind stoped")
+
+    def is_running(self):
+        return self._state == WriteBehindState.STARTED
+
+    def add(self, key, el, urgent=False):
+        # Marks element as dirty.
+        # Returns False if the flusher is not running. The caller
+        # has to write the element on its own.
+        with self._cond:
+            if not self.is_running():
+                return False
+
+            prev = self._dirty.pop(key, None)
+            if prev is not None:
+                self._dirty_bytes -= prev.memory_footprint()
+            self._dirty[key] = el
+            self._dirty_bytes += el.memory_footprint()
+            if self._oldest is None:
+                self._oldest = time()
+                self._cond.notify()  # Flusher waits for first element
+
+            if urgent or self._dirty_bytes > settings.CACHE_FLUSH_BYTES:
+                self._urgent = True
+                self._cond.notify()
+
+        return True
+
+    def pending(self, key):
+        # Dirty element of key or None. Elements of a running
+        # flush are returned until they are written.
+        with self._cond:
+            el = self._dirty.get(key)
+            if el is None:
+                el = self._in_flight.get(key)
+            return el
+
+    def flush(self):
+        with self._cond:
+            items = list(self._dirty.items())
+            self._in_flight.update(items)
+            self._dirty.clear()
+            self._dirty_bytes = 0
+            self._oldest = None
+            self._urgent = False
+
+        if not items:
+            return 0
+
+        start = perf_counter()
+        try:
+            failed = self._write(items) or []
+        except Exception as e:
+            logger.error("Flush of {} cache elements failed. "
+                         "Error was: {}".format(len(items), e))
+            failed = items
+
+        with self._cond:
+            for (key, el) in items:
+                if self._in_flight.get(key) is el:
+                    del self._in_flight[key]
+
+            self._requeue(failed)
+            self._counter_flushes += 1
+            self._counter_written += len(items) - len(failed)
+            self._counter_failed += len(failed)
+            self._last_duration = perf_counter() - start
+
+        if failed:
+            logger.error("Flush of {} cache elements failed. They are "
+                         "queued again.".format(len(failed)))
+        logger.debug("Flushed {} cache elements".format(
+            len(items) - len(failed)))
+        return len(items) - len(failed)
+
+    def _requeue(self, failed):
+        # Puts elements of failed write in front of the queue.
+        # Newer versions added during the flush are kept.
+        # Requires self._cond.
+        for (key, el) in reversed(failed):
+            if key in self._dirty:
+                continue
+
+            self._dirty[key] = el
+            self._dirty.move_to_end(key, last=False)
+            self._dirty_bytes += el.memory_footprint()
+
+        if self._dirty and self._oldest is None:
+            # Retry with the regular interval, not immediately.
+            self._oldest = time()
+            self._cond.notify()
+
+    def statistic(self):
+        with self._cond:
+            return {
+                "dirty": len(self._dirty),
+                "dirty_bytes": self._dirty_bytes,
+                "in_flight": len(self._in_flight),
+                "oldest_dirty_age": (time() - self._oldest
+                                     if self._oldest else None),
+                "flushes": self._counter_flushes,
+                "written": self._counter_written,
+                "failed": self._counter_failed,
+                "last_duration": self._last_duration,
+            }
+
+    def _wait_for_flush(self):
+        # Blocks until a flush is due. Returns False if the
+        # flusher was stopped.
+        with self._cond:
+            while self._state == WriteBehindState.STARTED:
+                now = time()
+                if self._urgent:
+                    return True
+
+                if self._oldest is not None:
+                    due = self._oldest + settings.CACHE_FLUSH_INTERVAL_S
+                    if due <= now:
+                        return True
+                    self._cond.wait(timeout=max(due - now, 0.1))
+                else:
+                    self._cond.wait()
+
+        return False
+
+    def _run(self):
+        while self._wait_for_flush():
+            self.flush()